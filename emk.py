@@ -6,11 +6,20 @@ import imp
 if sys.version_info[0] < 3:
     _string_type = basestring
     import __builtin__ as builtins
+    import Queue as queue
+    import BaseHTTPServer as http_server
+    import SocketServer as socketserver
+    from pipes import quote as _shell_quote
 else:
     _string_type = str
     import builtins
+    import queue
+    import http.server as http_server
+    import socketserver
+    from shlex import quote as _shell_quote
 import logging
 import collections
+import copy
 import errno
 import traceback
 import time
@@ -20,8 +29,72 @@ import shutil
 import multiprocessing
 import re
 import hashlib
+import binascii
+import sqlite3
+import socket
+import tarfile
+import tempfile
+import select
+import struct
+import subprocess
+import ctypes
+import ctypes.util
+import json
 
-_module_path = os.path.realpath(__file__)
+import emk_client
+
+def _source_path(path):
+    # the .py file for a module path that may be a compiled file (eg when emk.py was imported from emk.pyc)
+    base, ext = os.path.splitext(path)
+    if ext in (".pyc", ".pyo"):
+        return base + ".py"
+    return path
+
+_module_path = _source_path(os.path.realpath(__file__))
+
+_fast_hash = getattr(hashlib, "blake2b", hashlib.md5)
+_hash_block_size = 1 << 20
+
+_cache_format = 2
+_db_format = 3
+_db_compact_interval = 100
+_graph_format = 1
+_graph_ignored_options = set(["log", "style", "emk_dev", "threads", "trace", "trace_unchanged", "persist_graph", "changed_from", "ninja_stamp"])
+_query_options = set(["depth", "format", "weak"])
+_ninja_files = set(["build.ninja", ".ninja_log", ".ninja_deps"]) # files written by ninja (or for it) that are not part of the listings
+_ninja_run_options = ["log=warning", "threads=1", "lazy_dirs=yes"] # options added to the 'emk :ninja-run' calls in an exported build.ninja
+_graph_ignored_env = set(["_", "PWD", "OLDPWD", "SHLVL", "WINDOWID", "TERM_SESSION_ID", "ITERM_SESSION_ID", "SECURITYSESSIONID",
+    "TMUX_PANE", "SSH_CLIENT", "SSH_CONNECTION", "SSH_TTY"])
+
+if sys.version_info[0] < 3:
+    _db_blob = buffer
+else:
+    _db_blob = bytes
+
+_snapshot_racy_interval = 2.0 # directory listings are only stored if the directory was not modified this recently
+
+_scandir = getattr(os, "scandir", None)
+if _scandir is None:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
+_empty_set = frozenset() # shared default for sets that are usually empty (replaced by a new set when something is added)
+
+def _private_set_property(name):
+    # A public set attribute whose value is stored in the given slot. Internally the slot may hold a frozenset that is shared
+    # between objects (eg _empty_set); it is replaced by a private copy when the attribute is accessed, so that callers can
+    # still modify the set in place.
+    def get(self):
+        value = getattr(self, name)
+        if type(value) is frozenset:
+            value = set(value)
+            setattr(self, name, value)
+        return value
+    def set_value(self, value):
+        setattr(self, name, value)
+    return property(get, set_value)
 
 class _Target(object):
     """
@@ -35,6 +108,9 @@ class _Target(object):
       abs_path  -- The canonical path of the target.
       attached  -- The set of targets (canonical paths) that have been attached to this target. Only usable when a rule is executing.
     """
+    __slots__ = ("orig_path", "rule", "abs_path", "_attached", "_rebuild_if_changed", "_required_by", "_built", "_visited",
+        "_virtual_modtime", "_edges")
+    
     def __init__(self, local_path, rule):
         self.orig_path = local_path
         self.rule = rule
@@ -43,15 +119,31 @@ class _Target(object):
         else:
             self.abs_path = local_path
             
-        self.attached = set()
+        self._attached = _empty_set
         
         self._rebuild_if_changed = False
         
-        self._required_by = set()
+        self._required_by = _empty_set
         self._built = False
         self._visited = False
         
         self._virtual_modtime = None
+        self._edges = None
+    
+    def _add_required_by(self, rule):
+        if not self._required_by:
+            self._required_by = set()
+        self._required_by.add(rule)
+    
+    def _edge(self, weak):
+        # The (target, weak) tuple used in rule requirement lists. The tuples are shared by all rules that require this target,
+        # so each requirement only costs a list slot.
+        edges = self._edges
+        if edges is None:
+            edges = self._edges = ((self, False), (self, True))
+        return edges[weak]
+    
+    attached = _private_set_property("_attached")
 
 class _Rule(object):
     """
@@ -76,6 +168,10 @@ class _Rule(object):
       has_changed -- The function to execute to determine if a requirement or product has changed. Uses emk.default_has_changed by default.
                      The function should take a single argument which is the absolute path of the thing to check to see if it has changed.
                      When this function is executing, emk.current_rule and emk.rule_cache() are available.
+      idempotent  -- Whether or not executing the rule again has no effect when its requirements and products have not changed (True or False).
+                     Specified when the rule was created.
+      command     -- The function that describes the command lines that the rule runs, for exporting the build graph (see 'emk :ninja'),
+                     or None. Specified when the rule was created.
                           
       stack       -- The stack of where the rule was defined (a list of strings).
     
@@ -88,6 +184,10 @@ class _Rule(object):
                         All secondary dependencies of a rule are built before the rule is built. If a secondary dependency does not
                         exist, a build error is raised.
     """
+    __slots__ = ("func", "produces", "requires", "args", "cwd_safe", "ex_safe", "has_changed", "idempotent", "command", "scope", "_key", "_cache",
+        "_cache_entry", "_file_table", "_file_versions", "_digest_versions", "_untouched", "_secondary_deps", "_weak_deps", "_required_targets",
+        "_weak_set", "_remaining_unbuilt_reqs", "_want_build", "_built", "_ran_func", "stack", "_req_trace")
+    
     def __init__(self, requires, args, func, cwd_safe, ex_safe, has_changed, scope):
         self.func = func
         self.produces = []
@@ -96,25 +196,55 @@ class _Rule(object):
         self.cwd_safe = cwd_safe
         self.ex_safe = ex_safe
         self.has_changed = has_changed
+        self.idempotent = False
+        self.command = None
         
         self.scope = scope
         
         self._key = None
         self._cache = None
-        self._untouched = set()
+        self._cache_entry = None
+        self._file_table = None
+        self._file_versions = None
+        self._digest_versions = None
+        self._untouched = _empty_set
         
-        self._lock = threading.Lock()
-        
-        self.secondary_deps = set()
-        self.weak_deps = set()
+        self._secondary_deps = _empty_set
+        self._weak_deps = _empty_set
         
-        self._required_targets = []
+        self._required_targets = [] # (target, weak) requirements, except for the shared weak dependency set
+        self._weak_set = None # the shared _DepSet for the weak dependencies of this rule
         self._remaining_unbuilt_reqs = 0
         self._want_build = False
         self._built = False
         self._ran_func = False
         self.stack = []
-        self._req_trace = {}
+        self._req_trace = None # map required target -> changed status; only recorded when tracing
+    
+    def _all_required(self):
+        # all (target, weak) requirements of this rule, including the shared weak dependency set
+        if self._weak_set is None:
+            return self._required_targets
+        return self._required_targets + self._weak_set.edges
+    
+    secondary_deps = _private_set_property("_secondary_deps")
+    weak_deps = _private_set_property("_weak_deps")
+
+class _DepSet(object):
+    """
+    A set of weak dependencies that is shared by all rules with the same weak dependencies (eg object files that include
+    the same headers). Rules refer to the shared set instead of each having a requirement edge for every dependency, and the
+    state of the dependencies is computed once per build phase; each rule then only compares the combined state with the
+    state that it saw in its last build.
+    """
+    __slots__ = ("paths", "edges", "_generated", "_examined", "_signatures")
+    
+    def __init__(self, paths, targets):
+        self.paths = paths
+        self.edges = [t._edge(True) for t in targets]
+        self._generated = () # the dependencies that are produced by rules
+        self._examined = False
+        self._signatures = None # map (file table, use digests) -> combined state of the dependencies, or None
 
 class _ScopeData(object):
     def __init__(self, parent, scope_type, scope_dir, proj_dir):
@@ -124,7 +254,15 @@ class _ScopeData(object):
         self.proj_dir = proj_dir
         self.has_rules_file = False
         
-        self._cache = None
+        self._cache = None # the generic scope cache; loaded when first needed
+        self._cache_data = None # the pickled scope cache, as loaded from the project database
+        self._cache_loaded = False
+        self._cache_touched = False # True if the scope cache may have been modified since it was last written
+        self._rule_caches = {} # map rule key -> rule cache entry; each entry is loaded when first needed
+        self._dirty_rule_caches = set() # keys of rule caches that have been modified since they were last written
+        self._pending_rules = 0 # number of rules in this scope that are waiting to be built in the current phase
+        self._db = None
+        self._file_table = None
         self._do_later_funcs = []
         
         if parent:
@@ -144,10 +282,42 @@ class _ScopeData(object):
         self.weak_modules = {}
         
         self.targets = {} # map original target name->target for the current scope
+        self._records = None # what the scope added to the graph, for rules scopes of a resident graph (see _GraphRecords)
     
     def prepare_do_later(self):
         self._do_later_funcs = []
 
+class _GraphRecords(object):
+    """
+    What the rules files, modules and prebuild functions of a scope added to the build graph, when the graph is kept in memory
+    between builds (see _ResidentGraph). When some directories are loaded again, their rules are replaced, and the rest of the
+    graph is rebuilt from the records of all scopes (see EMK_Base._relink_graph()).
+    """
+    def __init__(self):
+        self.aliases = [] # list of (alias, target)
+        self.depends = [] # list of (target, dependencies)
+        self.weak_depends = [] # list of (target, dependencies)
+        self.attached = [] # list of (target, attached targets)
+        self.auto_targets = []
+        self.requires_rule = []
+        self.rebuild_if_changed = []
+        self.recursed = set() # canonical directories that the scope recursed into
+        self.inputs = {} # map path -> signature of each file or directory that the scope was loaded from
+
+class _PrebuildTask(object):
+    """
+    A cwd-safe prebuild function, when prebuild functions are run in parallel. The rules, prebuild/postbuild functions and
+    recursed directories that it creates are collected here, and merged into the build in the original order once all tasks are done.
+    """
+    def __init__(self, scope, func):
+        self.scope = scope
+        self.func = func
+        self.rules = []
+        self.prebuild_funcs = []
+        self.postbuild_funcs = []
+        self.recurse_dirs = set()
+        self.error = None
+
 class _RuleQueue(object):
     """
     A threadsafe queue, servicing 1 "special" thread and 0 or more "normal" threads.
@@ -249,13 +419,902 @@ class _RuleQueue(object):
                 self.queue.append(self.STOP)
                 self.cond.notify()
     
-    def error(self, err):
+    def error(self, err):
+        with self.lock:
+            self.errors.append(err)
+            self.join_cond.notifyAll()
+
+class _StatCache(object):
+    """
+    A threadsafe cache of file metadata (ie, os.stat() results) that is shared by the whole build.
+
+    Paths that do not exist are cached as well (as None), so repeated existence checks for missing
+    files (eg weak dependencies) are also cheap. Entries must be invalidated whenever a path may have been
+    modified; emk does this automatically for the products of a rule after the rule has been executed.
+    Negative entries are also dropped at the start of each build phase, since prebuild and postbuild
+    functions may create files.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def stat(self, path):
+        try:
+            return self._stats[path]
+        except KeyError:
+            pass
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+        with self._lock:
+            self._stats[path] = st
+        return st
+
+    def exists(self, path):
+        return self.stat(path) is not None
+
+    def getmtime(self, path):
+        st = self.stat(path)
+        if st is None:
+            raise OSError(errno.ENOENT, "No such file or directory", path)
+        return st.st_mtime
+
+    def invalidate(self, paths):
+        with self._lock:
+            for path in paths:
+                self._stats.pop(path, None)
+
+    def keep_dirs(self, dirs):
+        # forget all entries for paths that are not directly in one of the given directories
+        with self._lock:
+            self._stats = dict([(path, st) for path, st in self._stats.items() if os.path.dirname(path) in dirs])
+
+    def forget_missing(self):
+        with self._lock:
+            self._stats = dict([(path, st) for path, st in self._stats.items() if st is not None])
+
+    def clear(self):
+        with self._lock:
+            self._stats = {}
+
+    def entries(self, dirs):
+        # the entries for paths that are directly in one of the given directories (eg to pass them to another process)
+        with self._lock:
+            return dict([(path, st) for path, st in self._stats.items() if os.path.dirname(path) in dirs])
+
+    def update(self, entries):
+        with self._lock:
+            self._stats.update(entries)
+
+class _InotifyWatcher(object):
+    """
+    Watches a set of directories for changes using the Linux inotify API (through ctypes).
+    
+    read() returns a list of (path, listing) tuples, where listing is True if the entry was created, removed or renamed
+    (ie, the directory listing changed). A path of None means that events were lost, so anything may have changed.
+    """
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    
+    _listing_mask = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+    _mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | _listing_mask
+    _header = struct.Struct("iIII")
+    
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._dirs = {} # map directory -> watch descriptor
+        self._wds = {} # map watch descriptor -> directory
+    
+    def set_dirs(self, dirs):
+        dirs = set(dirs)
+        for d in set(self._dirs.keys()) - dirs:
+            wd = self._dirs.pop(d)
+            self._wds.pop(wd, None)
+            self._libc.inotify_rm_watch(self._fd, wd)
+        for d in dirs - set(self._dirs.keys()):
+            path = d.encode(sys.getfilesystemencoding()) if not isinstance(d, bytes) else d
+            wd = self._libc.inotify_add_watch(self._fd, path, self._mask)
+            if wd >= 0:
+                self._dirs[d] = wd
+                self._wds[wd] = d
+    
+    def read(self, timeout):
+        r, w, x = select.select([self._fd], [], [], timeout)
+        if not r:
+            return []
+        try:
+            data = os.read(self._fd, 1 << 16)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        
+        events = []
+        pos = 0
+        while pos + self._header.size <= len(data):
+            wd, mask, cookie, length = self._header.unpack_from(data, pos)
+            pos += self._header.size
+            name = data[pos:pos + length].rstrip(b"\0")
+            pos += length
+            if mask & self.IN_Q_OVERFLOW:
+                events.append((None, True))
+                continue
+            d = self._wds.get(wd)
+            if d is None:
+                continue
+            if mask & self.IN_IGNORED:
+                # the directory was removed
+                self._wds.pop(wd, None)
+                self._dirs.pop(d, None)
+                continue
+            if not isinstance(name, str):
+                name = name.decode(sys.getfilesystemencoding())
+            events.append((os.path.join(d, name) if name else d, bool(mask & self._listing_mask)))
+        return events
+    
+    def close(self):
+        os.close(self._fd)
+
+class _PollWatcher(object):
+    """
+    Watches a set of directories for changes by periodically listing them and checking the signature of each entry.
+    Used when inotify is not available. Has the same interface as _InotifyWatcher.
+    """
+    interval = 0.5
+    
+    def __init__(self):
+        self._snapshots = {} # map directory -> {name: signature}
+    
+    def _snapshot(self, d):
+        try:
+            names = os.listdir(d)
+        except OSError:
+            return None
+        return dict([(name, _graph_sig(os.path.join(d, name))) for name in names])
+    
+    def set_dirs(self, dirs):
+        old = self._snapshots
+        self._snapshots = {}
+        for d in dirs:
+            self._snapshots[d] = old[d] if d in old else self._snapshot(d)
+    
+    def read(self, timeout):
+        end = time.time() + timeout
+        while True:
+            events = []
+            for d, snapshot in self._snapshots.items():
+                current = self._snapshot(d)
+                if current == snapshot:
+                    continue
+                self._snapshots[d] = current
+                if current is None or snapshot is None:
+                    events.append((d, True))
+                    continue
+                for name in set(snapshot.keys()) | set(current.keys()):
+                    if name not in snapshot or name not in current:
+                        events.append((os.path.join(d, name), True))
+                    elif snapshot[name] != current[name]:
+                        events.append((os.path.join(d, name), False))
+            now = time.time()
+            if events or now >= end:
+                return events
+            time.sleep(min(self.interval, end - now))
+    
+    def close(self):
+        pass
+
+def _make_watcher():
+    if sys.platform.startswith("linux"):
+        try:
+            return _InotifyWatcher()
+        except (OSError, AttributeError):
+            pass
+    return _PollWatcher()
+
+def _graph_sig(path):
+    # the signature of a file or directory that the persisted build graph depends on (None if it does not exist)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size, st.st_ino)
+
+def _list_files(path):
+    # the sorted names of the regular files (or symlinks to regular files) in a directory
+    if _scandir is not None:
+        return sorted([entry.name for entry in _scandir(path) if entry.is_file()])
+    return sorted([name for name in os.listdir(path) if os.path.isfile(os.path.join(path, name))])
+
+def _update_ninja_listings(stamp, dirs=None):
+    # Write the file listings of the given directories (or of the directories recorded in the stamp) into the given stamp
+    # file of an exported build.ninja, unless it already holds the same listings (so ninja only regenerates build.ninja when
+    # a listing has really changed). The files that ninja itself writes are not included. Returns True if the stamp was written.
+    try:
+        with open(stamp) as f:
+            old = f.read()
+    except IOError:
+        old = None
+    if dirs is None:
+        try:
+            dirs = list(json.loads(old).keys())
+        except (TypeError, ValueError, AttributeError):
+            dirs = []
+    listings = {}
+    for d in dirs:
+        try:
+            listings[d] = [name for name in _list_files(d) if name not in _ninja_files]
+        except OSError:
+            listings[d] = None
+    new = json.dumps(listings, sort_keys=True, indent=0)
+    if new == old:
+        return False
+    stamp_dir = os.path.dirname(stamp)
+    if not os.path.isdir(stamp_dir):
+        os.makedirs(stamp_dir)
+    with open(stamp, "w") as f:
+        f.write(new)
+    return True
+
+def _hash_file(path):
+    h = _fast_hash()
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(_hash_block_size)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+class _DirSnapshot(object):
+    """
+    A snapshot of the regular files in a directory (see emk.dir_snapshot()).
+
+    Attributes:
+      path   -- The canonical path of the directory.
+      files  -- The sorted list of the names of the regular files (including symlinks to regular files) in the directory.
+      by_ext -- A dict mapping each extension (the part of a name from its last '.', eg ".c"; "" for names without a '.')
+                to the sorted list of the file names with that extension.
+    """
+    __slots__ = ["path", "files", "by_ext"]
+
+    def __init__(self, path, files):
+        self.path = path
+        self.files = files
+        self.by_ext = {}
+        for name in files:
+            i = name.rfind('.')
+            ext = name[i:] if i >= 0 else ""
+            names = self.by_ext.get(ext)
+            if names is None:
+                self.by_ext[ext] = [name]
+            else:
+                names.append(name)
+
+    def with_exts(self, exts):
+        """
+        Returns the sorted list of the file names that end with any of the given extensions (eg [".c", ".h"]).
+        """
+        result = set()
+        for ext in exts:
+            if ext.rfind('.') == 0:
+                result.update(self.by_ext.get(ext, ()))
+            else:
+                result.update([name for name in self.files if name.endswith(ext)])
+        return sorted(result)
+
+class _RealpathCache(object):
+    """
+    Memoized os.path.realpath() for absolute paths. The real path of each directory is resolved once, and file names
+    are then joined onto it. The file itself is still checked for being a symlink (with a single lstat), unless
+    file_symlinks is False.
+    """
+    def __init__(self):
+        self._dirs = {}
+        self.file_symlinks = True
+    
+    def realpath(self, path):
+        d, name = os.path.split(path)
+        if not name or name == "." or name == "..":
+            return os.path.realpath(path)
+        real_dir = self._dirs.get(d)
+        if real_dir is None:
+            real_dir = self._dirs[d] = os.path.realpath(d)
+        result = os.path.join(real_dir, name)
+        if self.file_symlinks and os.path.islink(result):
+            return os.path.realpath(result)
+        return result
+
+class _FileStateTable(object):
+    """
+    Table of file states, shared by all rules in a project.
+
+    Each file that is checked by a has_changed function is assigned a compact integer id. The table stores the
+    last seen state of each file (its modtime, and its stat key and content digest if content hashing is used),
+    along with a version number that is incremented whenever that state changes. Rule caches only need to store
+    the version of each file that they last saw (keyed by file id), instead of a copy of the path and state.
+
+    The token identifies this table; rule caches that were recorded against a different table (eg because
+    the table was removed by a clean) are discarded.
+    """
+    def __init__(self):
+        self.token = binascii.hexlify(os.urandom(8))
+        self.paths = [] # map id -> path
+        self.modtimes = []
+        self.versions = []
+        self.stat_keys = []
+        self.digests = []
+        self.digest_versions = []
+
+        self._ids = {} # map path -> id
+        self._lock = threading.Lock()
+        self._changed = set() # ids of files whose state has not been written yet
+
+    def __getstate__(self):
+        return (self.token, self.paths, self.modtimes, self.versions, self.stat_keys, self.digests, self.digest_versions)
+
+    def __setstate__(self, state):
+        self.token, self.paths, self.modtimes, self.versions, self.stat_keys, self.digests, self.digest_versions = state
+        self._ids = dict([(path, i) for i, path in enumerate(self.paths)])
+        self._lock = threading.Lock()
+        self._changed = set(range(len(self.paths)))
+
+    def load_rows(self, token, rows):
+        """
+        Initialize the table from database rows of (id, path, modtime, version, stat key, digest, digest version).
+        The rows must be ordered by id, and the ids must be contiguous from 0. Returns False if they are not.
+        """
+        self.token = token
+        for fid, path, modtime, version, stat_key, digest, digest_version in rows:
+            if fid != len(self.paths):
+                return False
+            self._ids[path] = fid
+            self.paths.append(path)
+            self.modtimes.append(modtime)
+            self.versions.append(version)
+            self.stat_keys.append(pickle.loads(bytes(stat_key)) if stat_key is not None else None)
+            self.digests.append(digest)
+            self.digest_versions.append(digest_version)
+        return True
+
+    def take_changes(self):
+        """
+        Returns the database rows for all files whose state has changed since the last call.
+        """
+        with self._lock:
+            rows = []
+            for fid in sorted(self._changed):
+                stat_key = self.stat_keys[fid]
+                if stat_key is not None:
+                    stat_key = _db_blob(pickle.dumps(stat_key, -1))
+                rows.append((fid, self.paths[fid], self.modtimes[fid], self.versions[fid], stat_key,
+                    self.digests[fid], self.digest_versions[fid]))
+            self._changed = set()
+            return rows
+
+    def _file_id(self, path):
+        # must be called with the lock held
+        fid = self._ids.get(path)
+        if fid is None:
+            fid = len(self.paths)
+            self._ids[path] = fid
+            self.paths.append(path)
+            self.modtimes.append(None)
+            self.versions.append(0)
+            self.stat_keys.append(None)
+            self.digests.append(None)
+            self.digest_versions.append(0)
+            self._changed.add(fid)
+        return fid
+
+    def modtime_version(self, path, modtime):
+        """
+        Update the modtime of the given path. Returns (file id, current modtime version).
+        """
+        with self._lock:
+            fid = self._file_id(path)
+            if self.modtimes[fid] != modtime:
+                self.modtimes[fid] = modtime
+                self.versions[fid] += 1
+                self._changed.add(fid)
+            return fid, self.versions[fid]
+
+    def restamp(self, path, old_modtime, new_modtime):
+        """
+        Replace the recorded modtime of the given path if it is old_modtime, without changing its version (eg when
+        the file has been restored from an archive that cannot reproduce its exact modtime).
+        """
+        with self._lock:
+            fid = self._ids.get(path)
+            if fid is not None and self.modtimes[fid] == old_modtime and old_modtime != new_modtime:
+                self.modtimes[fid] = new_modtime
+                self._changed.add(fid)
+
+    def digest_version(self, path, stat_key):
+        """
+        Update the content digest of the given path; the file is only hashed if the stat key differs from
+        the stored stat key. Returns (file id, current digest version).
+        """
+        with self._lock:
+            fid = self._file_id(path)
+            if self.stat_keys[fid] == stat_key and self.digests[fid] is not None:
+                return fid, self.digest_versions[fid]
+
+        digest = _hash_file(path)
+        with self._lock:
+            self.stat_keys[fid] = stat_key
+            if self.digests[fid] != digest:
+                self.digests[fid] = digest
+                self.digest_versions[fid] += 1
+            self._changed.add(fid)
+            return fid, self.digest_versions[fid]
+
+class _ProjectDB(object):
+    """
+    The build database for a project (an sqlite file named __emk_db__ in the project build dir).
+
+    The database contains the file state table for the project, the generic cache of each rules scope (keyed by
+    the scope directory), the cache of each rule (keyed by the scope directory and the rule key), and the persisted
+    build graphs (keyed by the directory and arguments that emk was run with; see the persist_graph option). Caches are
+    read individually when they are first needed, so only the part of the graph that is actually examined is loaded.
+    Only the caches and file states that have changed are written back; each write is a single transaction. The caches
+    for a scope are written in the background as soon as the rules in that scope have been built. The database is compacted
+    every _db_compact_interval builds that modify it, or when it contains too much free space.
+
+    Paths stored in the database (including paths in the pickled caches) are relative to the database root
+    (ie, the project dir), so that the database can be moved along with the project (see the cache-export command).
+
+    Caches from older versions of emk (the per-directory __emk_cache__<hash> files and the __emk_files__ table)
+    are migrated into the database when they are found, and removed once the database has been written.
+    """
+    root_placeholder = "$:proj:$"
+
+    def __init__(self, db_dir, root):
+        self.dir = db_dir
+        self.path = os.path.join(db_dir, "__emk_db__")
+        self.root = root
+
+        self._conn = None
+        self._lock = threading.Lock()
+        self._table = None
+        self._reset = False
+        self._legacy_paths = []
+        self._written = False
+
+    def _connect(self, create):
+        # must be called with the lock held
+        if self._conn is None:
+            if not create and not os.path.isfile(self.path):
+                return None
+            if not os.path.isdir(self.dir):
+                os.makedirs(self.dir)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.text_factory = str
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)")
+            conn.execute("CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, path TEXT NOT NULL, modtime REAL, "
+                "version INTEGER, stat_key BLOB, digest TEXT, digest_version INTEGER)")
+            conn.execute("CREATE TABLE IF NOT EXISTS scopes (dir TEXT PRIMARY KEY, build_dir TEXT NOT NULL, data BLOB NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS rules (dir TEXT NOT NULL, key TEXT NOT NULL, data BLOB NOT NULL, PRIMARY KEY (dir, key))")
+            conn.execute("CREATE TABLE IF NOT EXISTS graphs (key TEXT PRIMARY KEY, data BLOB NOT NULL)")
+            conn.commit()
+            if self._get_meta(conn, "format") != _db_format:
+                # the database was created by a different version of emk, so all of its contents must be discarded
+                self._reset = True
+            self._conn = conn
+        return self._conn
+
+    def _relocate(self, obj, old, new):
+        # replace the old prefix with the new prefix in all strings in the given object
+        if isinstance(obj, _string_type):
+            if obj.startswith(old) and (len(obj) == len(old) or obj[len(old)] == os.sep):
+                return new + obj[len(old):]
+            return obj
+        elif isinstance(obj, dict):
+            items = [(self._relocate(k, old, new), self._relocate(v, old, new)) for k, v in obj.items()]
+            if type(obj) is dict:
+                return dict(items)
+            # keep the type and any extra state of dict subclasses (eg the order of an OrderedDict, or the default factory of a defaultdict)
+            result = copy.copy(obj)
+            result.clear()
+            result.update(items)
+            return result
+        elif isinstance(obj, tuple):
+            items = [self._relocate(item, old, new) for item in obj]
+            if hasattr(obj, "_make"): # namedtuple
+                return obj._make(items)
+            return tuple(items) if type(obj) is tuple else type(obj)(items)
+        elif isinstance(obj, (list, set, frozenset)):
+            return type(obj)([self._relocate(item, old, new) for item in obj])
+        return obj
+
+    def db_path(self, path):
+        """
+        Convert an absolute path into the form that is stored in the database (relative to the root if possible).
+        """
+        return self._relocate(path, self.root, self.root_placeholder)
+
+    def abs_path(self, path):
+        """
+        Convert a path that was stored in the database back into an absolute path.
+        """
+        return self._relocate(path, self.root_placeholder, self.root)
+
+    def pack(self, obj):
+        """
+        Pickle a cache object for storage in the database.
+        """
+        return pickle.dumps(self._relocate(obj, self.root, self.root_placeholder), -1)
+
+    def unpack(self, data):
+        """
+        Unpickle a cache object that was stored in the database.
+        """
+        return self._relocate(pickle.loads(data), self.root_placeholder, self.root)
+
+    def _get_meta(self, conn, key, default=None):
+        row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return default
+        return row[0]
+
+    def file_table(self):
+        """
+        Get the file state table for the project, loading it if necessary.
+        """
+        with self._lock:
+            if self._table is not None:
+                return self._table
+
+            table = _FileStateTable()
+            conn = self._connect(False)
+            if conn and not self._reset and self._get_meta(conn, "token"):
+                rows = conn.execute("SELECT id, path, modtime, version, stat_key, digest, digest_version FROM files ORDER BY id")
+                rows = [(row[0], self.abs_path(row[1])) + tuple(row[2:]) for row in rows]
+                if not table.load_rows(self._get_meta(conn, "token"), rows):
+                    table = _FileStateTable()
+                    self._reset = True
+            else:
+                self._reset = conn is not None
+                legacy_path = os.path.join(self.dir, "__emk_files__")
+                try:
+                    with open(legacy_path, "rb") as f:
+                        table = pickle.load(f)
+                    self._legacy_paths.append(legacy_path)
+                except Exception:
+                    pass
+            self._table = table
+            return table
+
+    def _load(self, query, args):
+        with self._lock:
+            conn = self._connect(False)
+            if conn is None or self._reset:
+                return None
+            row = conn.execute(query, args).fetchone()
+            if row is None:
+                return None
+            return bytes(row[0])
+
+    def load_scope(self, scope_dir):
+        """
+        Get the pickled generic cache for the given scope directory, or None if there is no cache for that directory.
+        """
+        return self._load("SELECT data FROM scopes WHERE dir = ?", (self.db_path(scope_dir),))
+
+    def load_rule(self, scope_dir, key):
+        """
+        Get the pickled cache for the given rule key in the given scope directory, or None if there is no cache for that rule.
+        """
+        return self._load("SELECT data FROM rules WHERE dir = ? AND key = ?", (self.db_path(scope_dir), key))
+
+    def load_graph(self, key):
+        """
+        Get the pickled build graph for the given key, or None if there is no graph for that key.
+        """
+        return self._load("SELECT data FROM graphs WHERE key = ?", (key,))
+
+    def load_graphs(self):
+        """
+        Get all of the pickled build graphs (and other data stored with them, eg the target index), as a list of (key, data).
+        """
+        with self._lock:
+            conn = self._connect(False)
+            if conn is None or self._reset:
+                return []
+            return [(key, bytes(data)) for key, data in conn.execute("SELECT key, data FROM graphs")]
+
+    def write_graph(self, key, data):
+        """
+        Store the pickled build graph for the given key. If data is None, the graph for that key is removed.
+        """
+        with self._lock:
+            conn = self._connect(data is not None)
+            if conn is None or self._reset:
+                return
+            with conn:
+                if data is None:
+                    conn.execute("DELETE FROM graphs WHERE key = ?", (key,))
+                else:
+                    conn.execute("INSERT OR REPLACE INTO graphs (key, data) VALUES (?, ?)", (key, _db_blob(data)))
+
+    def add_legacy_path(self, path):
+        """
+        Add an old cache file that should be removed once the database has been written.
+        """
+        with self._lock:
+            self._legacy_paths.append(path)
+
+    def remove_scopes(self, scope_dirs):
+        """
+        Remove the caches for the given scope dirs from the database (if the database still exists).
+        """
+        with self._lock:
+            if self._conn is not None:
+                # the database file may have been removed (eg by cleaning the project build dir)
+                self._conn.close()
+                self._conn = None
+            conn = self._connect(False)
+            if conn is not None:
+                dirs = [(self.db_path(d),) for d in scope_dirs]
+                with conn:
+                    conn.executemany("DELETE FROM scopes WHERE dir = ?", dirs)
+                    conn.executemany("DELETE FROM rules WHERE dir = ?", dirs)
+                    conn.execute("DELETE FROM graphs")
+
+    def write(self, scopes, rules):
+        """
+        Write the changed file states and the given caches to the database in a single transaction.
+
+        Arguments:
+          scopes -- A list of (scope dir, build dir, pickled cache) tuples for the generic scope caches.
+          rules  -- A list of (scope dir, rule key, pickled cache) tuples for the rule caches. If the pickled cache
+                    is None, the cache for that rule is removed from the database.
+        """
+        with self._lock:
+            file_rows = []
+            if self._table is not None:
+                file_rows = [(row[0], self.db_path(row[1])) + row[2:] for row in self._table.take_changes()]
+            if not (file_rows or scopes or rules or self._legacy_paths or self._reset):
+                return
+            conn = self._connect(True)
+            with conn:
+                if self._reset:
+                    for table in ("files", "scopes", "rules", "graphs", "meta"):
+                        conn.execute("DELETE FROM %s" % table)
+                    self._reset = False
+                conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('format', ?)", (_db_format,))
+                if self._table is not None:
+                    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('token', ?)", (self._table.token,))
+                    conn.executemany("INSERT OR REPLACE INTO files (id, path, modtime, version, stat_key, digest, digest_version) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)", file_rows)
+                conn.executemany("INSERT OR REPLACE INTO scopes (dir, build_dir, data) VALUES (?, ?, ?)",
+                    [(self.db_path(d), self.db_path(build_dir), _db_blob(data)) for d, build_dir, data in scopes])
+                conn.executemany("INSERT OR REPLACE INTO rules (dir, key, data) VALUES (?, ?, ?)",
+                    [(self.db_path(d), key, _db_blob(data)) for d, key, data in rules if data is not None])
+                conn.executemany("DELETE FROM rules WHERE dir = ? AND key = ?",
+                    [(self.db_path(d), key) for d, key, data in rules if data is None])
+
+            self._written = True
+
+            for path in self._legacy_paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._legacy_paths = []
+
+    def finish(self):
+        """
+        Called at the end of each build. Compacts the database if necessary (only if anything was written during the build).
+        """
+        with self._lock:
+            if not self._written:
+                return
+            self._written = False
+            conn = self._conn
+            with conn:
+                runs = self._get_meta(conn, "runs", 0) + 1
+                conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('runs', ?)", (runs,))
+            
+            free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            total_pages = conn.execute("PRAGMA page_count").fetchone()[0]
+            if runs % _db_compact_interval == 0 or free_pages * 2 > total_pages > 64:
+                self._compact(conn)
+
+    def _compact(self, conn):
+        # must be called with the lock held. Removes the caches for directories that no longer exist, and rebuilds the database file.
+        with conn:
+            gone = [(d,) for d, in conn.execute("SELECT dir FROM scopes") if not os.path.isdir(self.abs_path(d))]
+            conn.executemany("DELETE FROM scopes WHERE dir = ?", gone)
+            conn.executemany("DELETE FROM rules WHERE dir = ?", gone)
+        conn.execute("VACUUM")
+
+    def build_dirs(self):
+        """
+        Returns a list of the build dirs (absolute paths) of all the scopes that have caches in the database.
+        """
+        with self._lock:
+            conn = self._connect(False)
+            if conn is None or self._reset:
+                return []
+            dirs = set()
+            for d, build_dir in conn.execute("SELECT dir, build_dir FROM scopes"):
+                dirs.add(os.path.normpath(os.path.join(self.abs_path(d), self.abs_path(build_dir))))
+            return sorted(dirs)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+_artifact_key_regex = re.compile(r'^[0-9a-f]{40}$')
+class _ArtifactRequestHandler(http_server.BaseHTTPRequestHandler):
+    """
+    Request handler for the reference remote artifact cache server (see 'emk :cache-server' and utils.RemoteArtifactCache).
+    
+    Values are stored as files in <root>/ac/<key> and <root>/cas/<digest>; content-addressed values are verified on upload.
+    """
+    protocol_version = "HTTP/1.1"
+    
+    def _entry_path(self):
+        parts = self.path.split('/')
+        if len(parts) != 3 or parts[0] != "" or parts[1] not in ("ac", "cas") or not _artifact_key_regex.match(parts[2]):
+            self._respond(400)
+            return None, None
+        return parts[1], os.path.join(self.server.root, parts[1], parts[2][:2], parts[2])
+    
+    def _respond(self, status, data=b""):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+    
+    def do_GET(self):
+        kind, path = self._entry_path()
+        if path is None:
+            return
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except IOError:
+            self._respond(404)
+            return
+        self._respond(200, data)
+    
+    do_HEAD = do_GET
+    
+    def do_PUT(self):
+        try:
+            length = int(self.headers.get("Content-Length"))
+        except (TypeError, ValueError):
+            self._respond(411)
+            return
+        data = self.rfile.read(length)
+        kind, path = self._entry_path()
+        if path is None:
+            return
+        if kind == "cas" and hashlib.sha1(data).hexdigest() != os.path.basename(path):
+            self._respond(400)
+            return
+        
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.rename(tmp, path)
+        self._respond(201)
+    
+    def log_message(self, format, *args):
+        self.server.log.debug("%s: %s", self.client_address[0], format % args)
+
+class _ArtifactServer(socketserver.ThreadingMixIn, http_server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def _native_strings(value):
+    # convert the unicode strings decoded from JSON into native strings (for python 2)
+    if isinstance(value, dict):
+        return dict([(_native_strings(k), _native_strings(v)) for k, v in value.items()])
+    if isinstance(value, list):
+        return [_native_strings(v) for v in value]
+    if not isinstance(value, str) and not isinstance(value, bytes) and hasattr(value, "encode"):
+        return value.encode("utf-8")
+    return value
+
+class _ServerOutput(object):
+    """
+    File-like object that sends everything written to it to a build server client (in emk_client frames).
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.disconnected = False
+    
+    def write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
         with self.lock:
-            self.errors.append(err)
-            self.join_cond.notifyAll()
+            if self.disconnected:
+                return
+            try:
+                emk_client.write_frame(self.conn, b"o", data)
+            except socket.error:
+                self.disconnected = True
+    
+    def flush(self):
+        pass
+    
+    def isatty(self):
+        return False
 
 class _Container(object):
-    pass
+    """
+    A simple attribute container. Module instances (and containers within them) also use it to inherit configuration
+    properties from the parent scope with copy-on-write semantics: see inherit().
+    """
+    _shared = None
+
+    def __getattr__(self, name):
+        # only called when the attribute is not set on this instance; the first access makes a private copy
+        shared = self.__dict__.get("_shared")
+        if shared is None or name not in shared:
+            raise AttributeError(name)
+        value = shared[name]
+        value = value.copy() if isinstance(value, (dict, set)) else list(value)
+        self.__dict__[name] = value
+        return value
+
+    def inherit(self, parent, *names):
+        """
+        Inherit the given list/dict/set properties from the parent container without copying them.
+
+        The values are shared with the parent (and any other children) until they are accessed; the first access
+        in a scope gives that container its own copy, so the properties can still be modified in place
+        (eg using append() or update()). Values that are not accessed in a scope are never copied.
+        """
+        parent_dict = parent.__dict__
+        shared = parent._shared
+        owned = [name for name in names if name in parent_dict]
+        if owned:
+            shared = dict(shared) if shared else {}
+            for name in owned:
+                shared[name] = parent_dict.pop(name)
+            parent._shared = shared
+        self._shared = shared
+
+    def peek(self, name):
+        """
+        Get the value of a property without making a private copy of an inherited value. The returned value must not be modified.
+        """
+        values = self.__dict__
+        if name in values:
+            return values[name]
+        shared = self._shared
+        if shared and name in shared:
+            return shared[name]
+        return getattr(self, name)
 
 _clean_log = logging.getLogger("emk.clean")
 class _Clean_Module(object):
@@ -290,6 +1349,7 @@ class _Clean_Module(object):
     
     def clean_func(self, produces, requires):
         build_dir = os.path.realpath(os.path.join(emk.scope_dir, emk.build_dir))
+        emk._remove_scope_cache(emk.scope)
         if self.remove_build_dir:
             if os.path.commonprefix([build_dir, emk.scope_dir]) == emk.scope_dir:
                 _clean_log.info("Removing directory %s", build_dir)
@@ -618,12 +1678,12 @@ def _make_target_abspath(rel_path, scope):
     if os.path.isabs(scope.build_dir):
         start, sep, end = rel_path.partition(emk.build_dir_placeholder)
         if sep:
-            path = os.path.realpath(scope.build_dir + end)
+            path = scope.build_dir + end
         else:
             path = rel_path
     else:
         path = rel_path.replace(emk.build_dir_placeholder, scope.build_dir)
-    return os.path.realpath(_make_abspath(path, scope))
+    return emk._realpath(_make_abspath(path, scope))
 
 def _make_require_abspath(rel_path, scope):
     """
@@ -636,7 +1696,7 @@ def _make_require_abspath(rel_path, scope):
 
     if rel_path.startswith(emk.proj_dir_placeholder):
         rel_path = rel_path.replace(emk.proj_dir_placeholder, scope.proj_dir, 1)
-    return os.path.realpath(_make_abspath(rel_path, scope))
+    return emk._realpath(_make_abspath(rel_path, scope))
 
 class EMK_Base(object):
     """
@@ -655,6 +1715,7 @@ class EMK_Base(object):
         self.formatter = _Formatter("%(name)s (%(levelname)s): %(message)s")
         handler.setFormatter(self.formatter)
         self.log.addHandler(handler)
+        self._log_handler = handler
         self.log.propagate = False
         
         self.build_dir_placeholder = "$:build:$"
@@ -666,7 +1727,7 @@ class EMK_Base(object):
         self._local = threading.local()
         self._local.current_rule = None
         
-        self._prebuild_funcs = [] # list of (scope, func)
+        self._prebuild_funcs = [] # list of (scope, func, cwd_safe)
         self._postbuild_funcs = [] # list of (scope, func)
         
         self._targets = {} # map absolute target name -> target
@@ -691,8 +1752,14 @@ class EMK_Base(object):
         self._rebuild_if_changed = set()
         
         self._fixed_aliases = {}
+        self._unresolved_aliases = set() # aliases that do not refer to a rule product (yet)
         self._fixed_auto_targets = []
         self._must_build = []
+        self._fixed_rule_count = 0 # number of rules (from the start of self._rules) whose requirements have been fixed up
+        self._dirty_rules = set() # fixed rules whose requirements must be fixed up again (eg because dependencies were added)
+        self._replaced_targets = [] # artificial targets that have been replaced by rule products since the last fix up
+        self._visited_targets = [] # targets that have been examined in the current build phase
+        self._examined_dep_sets = [] # weak dependency sets that have been examined in the current build phase
         
         self._done_build = False
         self._added_rule = False
@@ -705,6 +1772,42 @@ class EMK_Base(object):
         
         self._lock = threading.Lock()
         
+        self._stat_cache = _StatCache()
+        self._realpath_cache = _RealpathCache()
+        self._realpath = self._realpath_cache.realpath
+        self._dbs = {} # map database dir -> _ProjectDB
+        self._cache_lock = threading.Lock() # protects loading of scope and rule caches
+        self._ready_lock = threading.Lock() # protects the unbuilt requirement counts of rules
+        self._dep_sets = {} # map frozenset of weak dependency paths -> shared _DepSet
+        self._immutable_dirs = {} # map directory -> version stamp, as set by the user
+        self._immutable_roots = {} # map canonical directory -> version stamp, resolved for the current build phase
+        self._immutable_lookup = {} # map directory -> (immutable root, stamp) or None
+        self._changed_from = None # the source of the list of changed paths (the changed_from option), or None to check every dependency
+        self._changed_paths = None # set of canonical paths that have changed since the last build, when using changed_from
+        self._affected_rules = None # set of rules that may be affected by the changed paths, when using changed_from
+        self._lazy_dirs = False
+        self._keep_target_index = False # True if the target index is maintained (the lazy_dirs option is set)
+        self._run_path = None # the directory that emk was run in
+        self._deferred_dirs = {} # map directory -> scope to handle it in, for directories that have not been loaded yet in lazy mode
+        self._target_index = None # map target path -> directory that produces it, from the persisted target index
+        self._stored_target_index = None # the persisted target index (map directory -> sorted target paths), once loaded
+        self._dir_snapshots = {} # map canonical directory -> _DirSnapshot taken in this build
+        self._stored_snapshots = {} # map _ProjectDB -> {directory: (signature, file names)} as stored in that database
+        self._new_snapshots = {} # map _ProjectDB -> {directory: (signature, file names)} to store at the end of the build
+        self._removed_caches = [] # scopes whose caches were removed by the clean rule
+        self._persist_graph = False
+        self._graph_inputs = {} # map path -> signature of each file or directory that the build graph depends on
+        self._graph_args = None # the options and explicit targets that the build graph depends on
+        self._reused_graph = False
+        self._watching = False # True if emk is running in watch mode
+        self._ninja_mode = None # "export" when writing build.ninja, "run" when called back from build.ninja, otherwise None
+        self._cancelled = False
+        self._buildable_rules = None
+        self._config_records = None # records of the config scopes when the graph is resident (see _GraphRecords), otherwise None
+        self._prepared = False # True if the first build phase of a resident graph has already been prepared
+        self._trusted_rules = None # products of the rules that a resident build may trust (see _ResidentGraph), or None
+        self._written_scopes = set() # directories whose scope caches have been modified, when the graph is resident
+        
         # parse args
         log_levels = {"debug":logging.DEBUG, "info":logging.INFO, "warning":logging.WARNING, "error":logging.ERROR, "critical":logging.CRITICAL}
         
@@ -726,6 +1829,14 @@ class EMK_Base(object):
         self._trace_unchanged = False
         self._options["trace_unchanged"] = "no"
         
+        self._options["has_changed"] = "modtime"
+        
+        self._options["persist_graph"] = "no"
+        
+        self._options["file_symlinks"] = "yes"
+        
+        self._options["lazy_dirs"] = "no"
+        
         self._explicit_targets = set()
         for arg in args:
             if '=' in arg:
@@ -759,6 +1870,20 @@ class EMK_Base(object):
                         self.traces = set(val.split(','))
                     elif key == "trace_unchanged" and val == "yes":
                         self._trace_unchanged = True
+                    elif key == "has_changed":
+                        if val == "hash":
+                            self.default_has_changed = self.hash_has_changed
+                        elif val != "modtime":
+                            self.log.error("Unknown has_changed option '%s'", val)
+                            val = "modtime"
+                    elif key == "persist_graph":
+                        self._persist_graph = (val == "yes")
+                    elif key == "file_symlinks":
+                        self._realpath_cache.file_symlinks = (val != "no")
+                    elif key == "changed_from":
+                        self._changed_from = val
+                    elif key == "lazy_dirs":
+                        self._lazy_dirs = self._keep_target_index = (val == "yes")
                             
                     self._options[key] = val
             else:
@@ -782,8 +1907,13 @@ class EMK_Base(object):
         oldpath = os.getcwd()
         fp = None
         try:
-            fp, pathname, description = imp.find_module(name, fixed_paths)
+            try:
+                fp, pathname, description = imp.find_module(name, fixed_paths)
+            except ImportError:
+                self._note_import(fixed_paths, name, None, local=True)
+                raise
             mpath = os.path.realpath(pathname)
+            self._note_import(fixed_paths, name, mpath, local=True)
             d, tail = os.path.split(mpath)
             os.chdir(d)
             if description[2] == imp.PY_COMPILED and not os.path.isfile(name + ".py"):
@@ -830,7 +1960,7 @@ class EMK_Base(object):
                 if d in self._known_build_dirs:
                     bd = self._known_build_dirs[d]
                     if os.path.isabs(bd):
-                        n = os.path.realpath(bd + end)
+                        n = self._realpath(bd + end)
                     else:
                         n = begin + bd + end
                     updated_paths.append(n)
@@ -853,54 +1983,99 @@ class EMK_Base(object):
             fixed_traces.add(_make_target_abspath(trace, self.scope))
         self.traces = fixed_traces
     
-    def _remove_artificial_targets(self):
-        real_targets = {}
-        for path, target in self._targets.items():
-            if target.rule:
-                real_targets[path] = target
-        self._targets = real_targets
-
-    def _fix_aliases(self):
-        unfixed_aliases = self._aliases.copy()
-        fixed_aliases = {}
-        did_fix = True
-        while unfixed_aliases and did_fix:
-            unfixed = {}
-            did_fix = False
-            for alias, target in unfixed_aliases.items():
-                t = self._targets.get(target)
-                if t is not None:
-                    did_fix = True
-                    fixed_aliases[alias] = t
-                    self.log.debug("Fixed alias %s => %s", alias, t.abs_path)
-                elif target in fixed_aliases:
-                    did_fix = True
-                    fixed_aliases[alias] = fixed_aliases[target]
-                    self.log.debug("Fixed alias %s => %s", alias, fixed_aliases[target].abs_path)
-                else:
-                    unfixed[alias] = target
-            unfixed_aliases = unfixed
+    def _retire_target(self, old, new):
+        # Any rule that refers to the old target must have its requirements fixed up again to refer to the new target.
+        self._dirty_rules.update(old._required_by)
+        if old in self._toplevel_examined_targets:
+            self._toplevel_examined_targets.discard(old)
+            if new is not None:
+                self._toplevel_examined_targets.add(new)
+    
+    def _fix_replaced_targets(self):
+        # Artificial targets (for paths without a rule) are kept between build phases; when a rule for one of those paths
+        # is added, the rules that required the artificial target are fixed up again.
+        replaced = self._replaced_targets
+        if not replaced:
+            return
+        self._replaced_targets = []
+        
+        paths = set()
+        for old in replaced:
+            paths.add(old.abs_path)
+            self._retire_target(old, self._targets.get(old.abs_path))
+        
+        stale_sets = set()
+        for node in self._dep_sets.values():
+            if not paths.isdisjoint(node.paths):
+                node.edges = [self._get_target(path, create_new=True)._edge(True) for path in sorted(node.paths)]
+                node._generated = [t for t, weak in node.edges if t.rule] or ()
+                stale_sets.add(node)
+        if stale_sets:
+            self._dirty_rules.update([rule for rule in self._rules if rule._weak_set in stale_sets])
 
-        # can't fix any more, so assume the rest refer to files with no rules
-        for alias, target in unfixed_aliases.items():
-            self.log.debug("could not fix alias %s => %s", alias, target)
-            t = _Target(target, None)
-            self._targets[target] = t
-            fixed_aliases[alias] = t
+    def _resolve_alias(self, alias):
+        # Follow the chain of aliases to a rule product; every alias on the way is resolved to the same target (path compression).
+        # If the chain does not end at a rule product, the aliases are resolved to an artificial target for the last path in the chain.
+        chain = [alias]
+        path = self._aliases[alias]
+        while True:
+            t = self._targets.get(path)
+            if t is not None and t.rule:
+                break
+            t = self._fixed_aliases.get(path)
+            if t is not None and t.rule:
+                break
+            next_path = self._aliases.get(path)
+            if next_path is None:
+                t = self._targets.get(path) or _Target(path, None)
+                break
+            if path in chain:
+                # circular aliases
+                t = self._fixed_aliases.get(alias)
+                if t is None or t.abs_path != path:
+                    t = _Target(path, None)
+                break
+            chain.append(path)
+            path = next_path
+        
+        for a in chain:
+            old = self._fixed_aliases.get(a)
+            if old is t:
+                continue
+            self._fixed_aliases[a] = t
+            if t.rule:
+                self.log.debug("Fixed alias %s => %s", a, t.abs_path)
+                self._unresolved_aliases.discard(a)
+            else:
+                self.log.debug("could not fix alias %s => %s", a, t.abs_path)
+            if old is not None:
+                self._retire_target(old, t)
+            # an artificial target that was created for the alias path before the alias was defined is replaced by the alias
+            shadowed = self._targets.get(a)
+            if shadowed is not None and not shadowed.rule:
+                del self._targets[a]
+                self._retire_target(shadowed, t)
+        if not t.rule and t.abs_path not in self._aliases and self._targets.get(t.abs_path) is None:
+            self._targets[t.abs_path] = t
 
-        self._fixed_aliases = fixed_aliases
+    def _fix_aliases(self):
+        # only new aliases, and aliases that did not refer to a rule product in the previous phase, need to be resolved
+        for alias in sorted(self._unresolved_aliases):
+            if alias in self._unresolved_aliases:
+                self._resolve_alias(alias)
     
     def _fix_depends(self):
         leftovers = {}
         for path, depends in self._secondary_dependencies.items():
             target = self._get_target(path)
-            if target:
+            if target and target.rule:
                 if target._built:
                     raise _BuildError("Cannot add secondary dependencies to '%s' since it has already been built" % (target.abs_path))
                 
                 new_deps = set(self._resolve_build_dirs(depends))
                 
-                target.rule.secondary_deps |= new_deps
+                target.rule._secondary_deps = target.rule._secondary_deps | new_deps
+                self._dirty_rules.add(target.rule)
             else:
                 self.log.debug("Target %s had secondary dependencies, but there is no rule for it yet", path)
                 leftovers[path] = depends
@@ -911,14 +2086,15 @@ class EMK_Base(object):
         leftovers = {}
         for path, depends in self._weak_dependencies.items():
             target = self._get_target(path)
-            if target:
+            if target and target.rule:
                 if target._built:
                     self.log.info("Cannot add weak dependencies to '%s' since it has already been built" % (target.abs_path))
                     continue
                 
                 new_deps = set(self._resolve_build_dirs(depends))
                 
-                target.rule.weak_deps |= new_deps
+                target.rule._weak_deps = target.rule._weak_deps | new_deps
+                self._dirty_rules.add(target.rule)
             else:
                 self.log.debug("Target %s had weak dependencies, but there is no rule for it yet", path)
                 leftovers[path] = depends
@@ -930,7 +2106,7 @@ class EMK_Base(object):
             target = self._get_target(path)
             if target:
                 new_deps = set(self._resolve_build_dirs(attached))
-                target.attached = target.attached.union(new_deps)
+                target._attached = target._attached | new_deps
                 if target._built: # need to build now, since it was attached to something that was already built
                     l = [self._get_target(a) for a in new_deps]
                     dep_targets = [t for t in l if t]
@@ -946,27 +2122,50 @@ class EMK_Base(object):
 
         rule.requires = self._resolve_build_dirs(rule.requires)
         
-        secondaries = set(self._resolve_build_dirs(rule.secondary_deps))
+        secondaries = set(self._resolve_build_dirs(rule._secondary_deps))
         updated_paths = secondaries.union(set(rule.requires))
         
-        weak_secondaries = set(self._resolve_build_dirs(rule.weak_deps)) - updated_paths
+        weak_secondaries = set(self._resolve_build_dirs(rule._weak_deps)) - updated_paths
 
         # convert paths to actual targets
         required_targets = []   
         for path in updated_paths:
             target = self._get_target(path, create_new=True)
 
-            target._required_by.add(rule) # when the target is built, we need to know which rules to examine for further building
-            required_targets.append((target, False))
+            target._add_required_by(rule) # when the target is built, we need to know which rules to examine for further building
+            required_targets.append(target._edge(False))
             
-        for path in weak_secondaries:
-            target = self._get_target(path, create_new=True)
-            if target.rule:
-                target._required_by.add(rule)
-            required_targets.append((target, True))
-
+        if self.ALWAYS_BUILD in weak_secondaries:
+            weak_secondaries.discard(self.ALWAYS_BUILD)
+            required_targets.append(self._get_target(self.ALWAYS_BUILD, create_new=True)._edge(True))
         rule._required_targets = required_targets
+        
+        rule._weak_set = None
+        if weak_secondaries:
+            key = frozenset(weak_secondaries)
+            node = self._dep_sets.get(key)
+            if node is None:
+                targets = [self._get_target(path, create_new=True) for path in sorted(key)]
+                node = self._dep_sets[key] = _DepSet(key, targets)
+                node._generated = [t for t, weak in node.edges if t.rule] or ()
+            for target in node._generated:
+                target._add_required_by(rule)
+            if rule._weak_deps == key:
+                rule._weak_deps = key # share the set with the other rules
+            rule._weak_set = node
 
+    def _fix_new_requires(self):
+        # fix up the requirements of the rules that were added since the last phase, and of the rules that have changed
+        rules = self._rules
+        dirty = self._dirty_rules
+        self._dirty_rules = set()
+        for rule in rules[self._fixed_rule_count:]:
+            self._fix_requires(rule)
+            dirty.discard(rule)
+        self._fixed_rule_count = len(rules)
+        for rule in dirty:
+            self._fix_requires(rule)
+    
     def _fix_auto_targets(self):
         self._fixed_auto_targets = []
         for path in self._auto_targets:
@@ -983,11 +2182,16 @@ class EMK_Base(object):
                 t._rebuild_if_changed = True
         
     def _setup_rule_cache(self, rule):
-        paths = [t.abs_path for t in rule.produces]
+        db = self._get_db(rule.scope)
+        paths = [db.db_path(t.abs_path) for t in rule.produces]
         paths.sort()
         rule._key = key = hashlib.md5('\0'.join(paths)).hexdigest()
-        cache = rule.scope._cache.setdefault("rules", {}).setdefault(key, {})
-        rule._cache = cache
+        rule._file_table = self._get_file_table(rule.scope)
+        entry = self._get_rule_cache(rule.scope, key)
+        rule._cache_entry = entry
+        rule._cache = entry["cache"]
+        rule._file_versions = entry["files"]
+        rule._digest_versions = entry["digests"]
     
     def _toplevel_examine_target(self, target):
         if not target in self._toplevel_examined_targets:
@@ -998,10 +2202,12 @@ class EMK_Base(object):
         if target._built or target._visited is True or (target._visited == "weak" and weak):
             return
         
+        if target._visited is False:
+            self._visited_targets.append(target)
         target._visited = "weak" if weak else True
         self.log.debug("Examining target %s", target.abs_path)
 
-        for path in target.attached:
+        for path in target._attached:
             t = self._get_target(path)
             if t:
                 self._examine_target(t, False)
@@ -1011,8 +2217,10 @@ class EMK_Base(object):
                 target._built = True
             elif target.abs_path in self._requires_rule:
                 self._need_undefined_rule = True
+            elif weak and self._changed_paths is not None and target.abs_path not in self._changed_paths:
+                target._built = True # weak dependencies may be missing anyway, so there is no need to check an unchanged one
             else:
-                if os.path.exists(target.abs_path):
+                if self._stat_cache.exists(target.abs_path):
                     target._built = True
                 elif weak:
                     self.log.debug("Allowing weak dependency %s to not exist", target.abs_path)
@@ -1024,11 +2232,22 @@ class EMK_Base(object):
                 self._setup_rule_cache(rule)
             if not rule._want_build:
                 rule._want_build = True
+                rule.scope._pending_rules += 1
                 rule._remaining_unbuilt_reqs = 0
                 for req, is_weak in rule._required_targets:
                     self._examine_target(req, is_weak)
                     if (req.rule or not is_weak) and (not req._built): # we can't build this rule immediately
                         rule._remaining_unbuilt_reqs += 1
+                node = rule._weak_set
+                if node is not None:
+                    if not node._examined:
+                        node._examined = True
+                        self._examined_dep_sets.append(node)
+                        for req, is_weak in node.edges:
+                            self._examine_target(req, True)
+                    for req in node._generated:
+                        if not req._built:
+                            rule._remaining_unbuilt_reqs += 1
 
                 if not rule._remaining_unbuilt_reqs:
                     # can build this rule immediately
@@ -1047,13 +2266,14 @@ class EMK_Base(object):
                     if changed:
                         t._virtual_modtime = cache["vmodtime"] = now
                 else:
-                    t._virtual = False
                     try:
-                        cache["modtime"] = os.path.getmtime(abs_path)
+                        fid, version = rule._file_table.modtime_version(abs_path, self._stat_cache.getmtime(abs_path))
+                        rule._file_versions[fid] = version
                     except OSError:
                         rulestack = ["    " + _style_tag('rule_stack') + line + _style_tag('') for line in rule.stack]
-                        with self._lock:
-                            del rule.scope._cache["rules"][rule._key]
+                        with self._cache_lock:
+                            rule.scope._rule_caches.pop(rule._key, None)
+                            rule.scope._dirty_rule_caches.add(rule._key)
                         raise _BuildError("%s should have been produced by the rule" % (abs_path), rulestack)
             else:
                 changed = False
@@ -1063,12 +2283,25 @@ class EMK_Base(object):
                 t._virtual_modtime = modtime
         
             t._built = True
+        
+        with self._cache_lock:
+            if built and rule._weak_set is None:
+                # the rule no longer has weak dependencies, so it does not need the state of its old weak dependency set
+                rule._file_versions.pop("weak_set", None)
+                rule._digest_versions.pop("weak_set", None)
+            if built or not rule._cache_entry.get("ok"):
+                rule._cache_entry["ok"] = True
+                rule.scope._dirty_rule_caches.add(rule._key)
+            rule.scope._pending_rules -= 1
+            scope_done = (rule.scope._pending_rules == 0)
+        if scope_done and not self.cleaning:
+            self._cache_write_queue.put(rule.scope)
 
         for t in rule.produces:
             for r in t._required_by:
                 if not r._want_build:
                     continue
-                with r._lock:
+                with self._ready_lock:
                     r._remaining_unbuilt_reqs -= 1
                     if r._remaining_unbuilt_reqs == 0:
                         self._buildable_rules.put(r)
@@ -1091,6 +2324,7 @@ class EMK_Base(object):
             if cached_modtime != virtual_modtime:
                 self.log.debug("Modtime (virtual) for %s has changed; cached = %s, actual = %s", req.abs_path, cached_modtime, virtual_modtime)
                 cache["vmodtime"] = virtual_modtime
+                self._rule_cache_changed(rule)
                 return True
             return False
     
@@ -1100,39 +2334,280 @@ class EMK_Base(object):
         of the dependency differs from the cached value, or if there is no cached value. Returns None if
         the file does not exist.
         
+        The modtime of each file is stored once in the project's file state table; the rule cache only records
+        the version of the file state that the rule last saw.
+        
         Note that when a has_changed function is executing, the rule that needs the dependency is available
         via emk.current_rule; the rule cache is accessible via emk.rule_cache().
         
+        Files in immutable directories (see emk.immutable_dirs) are not checked; the stamp of the directory is compared instead.
+        
+        Arguments:
+          abs_path -- The absolute path of the dependency to check.
+        """
+        immutable = self._immutable_source(abs_path)
+        if immutable is not None:
+            return self._immutable_has_changed(self.current_rule, immutable, {})
+        
+        st = self._stat_cache.stat(abs_path)
+        if st is None:
+            return None
+        
+        rule = self.current_rule
+        fid, version = rule._file_table.modtime_version(abs_path, st.st_mtime)
+        cached_version = rule._file_versions.get(fid)
+        if cached_version != version:
+            self.log.debug("Modtime for %s has changed; cached version = %s, actual version = %s", abs_path, cached_version, version)
+            rule._file_versions[fid] = version
+            self._rule_cache_changed(rule)
+            return True
+        return False
+
+    def hash_has_changed(self, abs_path):
+        """
+        Content-based function for determining if a rule dependency has changed. Returns True if the content digest
+        of the dependency differs from the cached value, or if there is no cached value. Returns None if the file does not exist.
+
+        The (size, modtime, inode) of the file is cached along with the digest; the file is only rehashed when that
+        stat information differs from the cached value. This means that touching a file (or checking out a different
+        branch and then switching back) will not cause a rebuild if the contents are identical.
+
+        To use content hashing for all rules, set 'emk.default_has_changed = emk.hash_has_changed' (or pass the "has_changed=hash"
+        option to emk); to use it for a single rule, pass 'has_changed=emk.hash_has_changed' when creating the rule.
+
+        Files in immutable directories (see emk.immutable_dirs) are not checked; the stamp of the directory is compared instead.
+
         Arguments:
           abs_path -- The absolute path of the dependency to check.
         """
+        immutable = self._immutable_source(abs_path)
+        if immutable is not None:
+            return self._immutable_has_changed(self.current_rule, immutable, {})
+        
+        st = self._stat_cache.stat(abs_path)
+        if st is None:
+            return None
+        
+        rule = self.current_rule
+        stat_key = (st.st_size, getattr(st, "st_mtime_ns", st.st_mtime), st.st_ino)
         try:
-            cache = self.rule_cache(abs_path)
-            modtime = os.path.getmtime(abs_path)
-            cached_modtime = cache.get("modtime")
-            if cached_modtime != modtime:
-                self.log.debug("Modtime for %s has changed; cached = %s, actual = %s", abs_path, cached_modtime, modtime)
-                cache["modtime"] = modtime
-                return True
-            return False
-        except OSError:
+            fid, version = rule._file_table.digest_version(abs_path, stat_key)
+        except IOError:
             return None
-    
+        cached_version = rule._digest_versions.get(fid)
+        if cached_version != version:
+            self.log.debug("Digest for %s has changed; cached version = %s, actual version = %s", abs_path, cached_version, version)
+            rule._digest_versions[fid] = version
+            self._rule_cache_changed(rule)
+            return True
+        return False
+
+    def _resolve_immutable_dirs(self):
+        roots = {}
+        for d, stamp in self._immutable_dirs.items():
+            d = os.path.realpath(os.path.abspath(os.path.expanduser(d)))
+            roots[d] = str(stamp)
+        if roots != self._immutable_roots:
+            self._immutable_roots = roots
+            self._immutable_lookup = {}
+
+    def _immutable_root(self, abs_path):
+        # Returns (immutable directory, stamp) for the given path if it is in an immutable directory, or None.
+        if not self._immutable_roots:
+            return None
+        d = os.path.dirname(abs_path)
+        try:
+            return self._immutable_lookup[d]
+        except KeyError:
+            pass
+        result = None
+        candidate = d
+        while True:
+            stamp = self._immutable_roots.get(candidate)
+            if stamp is not None:
+                result = (candidate, stamp)
+                break
+            parent = os.path.dirname(candidate)
+            if parent == candidate:
+                break
+            candidate = parent
+        self._immutable_lookup[d] = result
+        return result
+
+    def _immutable_source(self, abs_path):
+        # Returns (immutable directory, stamp) if the given path is in an immutable directory and is not produced by a rule, or None.
+        immutable = self._immutable_root(abs_path)
+        if immutable is not None:
+            target = self._targets.get(abs_path)
+            if target is not None and target.rule is not None:
+                return None
+        return immutable
+
+    def _immutable_has_changed(self, rule, immutable, seen):
+        # Dependencies in an immutable directory are checked as a whole: they have changed if the stamp of the directory
+        # differs from the stamp that the rule last saw. The result for each directory is remembered in seen.
+        d, stamp = immutable
+        c = seen.get(d)
+        if c is None:
+            key = ("immutable", d)
+            cached_stamp = rule._file_versions.get(key)
+            c = seen[d] = (cached_stamp != stamp)
+            if c:
+                self.log.debug("Stamp for immutable directory %s has changed; cached = %s, actual = %s", d, cached_stamp, stamp)
+                rule._file_versions[key] = stamp
+                self._rule_cache_changed(rule)
+        return c
+
+    def _weak_set_signature(self, rule, node):
+        # Returns (combined state of the dependencies in the shared weak dependency set, rule versions dict to record it in).
+        # The signature is None if the dependencies must be checked individually (custom has_changed functions and virtual dependencies).
+        func = getattr(rule.has_changed, "__func__", None)
+        if func is getattr(EMK_Base.default_has_changed, "__func__", EMK_Base.default_has_changed):
+            use_digests = False
+            rule_versions = rule._file_versions
+        elif func is getattr(EMK_Base.hash_has_changed, "__func__", EMK_Base.hash_has_changed):
+            use_digests = True
+            rule_versions = rule._digest_versions
+        else:
+            return None, None
+        
+        table = rule._file_table
+        if node._signatures is None:
+            node._signatures = {}
+        elif (table, use_digests) in node._signatures:
+            return node._signatures[(table, use_digests)], rule_versions
+        
+        versions = []
+        for t, weak in node.edges:
+            if t._virtual_modtime is not None:
+                versions = None
+                break
+            immutable = None if t.rule else self._immutable_root(t.abs_path)
+            if immutable is not None:
+                versions.append(immutable)
+                continue
+            st = self._stat_cache.stat(t.abs_path)
+            if st is None:
+                versions.append(-1)
+            elif use_digests:
+                try:
+                    versions.append(table.digest_version(t.abs_path, (st.st_size, getattr(st, "st_mtime_ns", st.st_mtime), st.st_ino))[1])
+                except IOError:
+                    versions.append(-1)
+            else:
+                versions.append(table.modtime_version(t.abs_path, st.st_mtime)[1])
+        signature = None
+        if versions is not None:
+            # the signature also identifies the set itself, by the database paths of the dependencies (so that it is still
+            # valid if the project is moved)
+            db = self._get_db(rule.scope)
+            signature = hashlib.md5(repr(([db.db_path(t.abs_path) for t, weak in node.edges], versions))).hexdigest()
+        node._signatures[(table, use_digests)] = signature
+        return signature, rule_versions
+
+    def _load_changed_paths(self, path):
+        # Returns the set of canonical paths that have changed since the last build, according to the changed_from option:
+        # "git:<rev>" (files that differ from the given git revision, and untracked files), "stdin" (one path per line),
+        # or a comma-separated list of paths. Relative paths are relative to the given directory.
+        source = self._changed_from
+        if source.startswith("git:"):
+            def git(*args):
+                try:
+                    proc = subprocess.Popen(["git"] + list(args), cwd=path, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                    out, err = proc.communicate()
+                except OSError as e:
+                    raise _BuildError("Failed to run git for changed_from=%s: %s" % (source, e))
+                if proc.returncode != 0:
+                    raise _BuildError("Failed to get the changed files for changed_from=%s: %s" % (source, err.strip()))
+                return out
+            base_dir = git("rev-parse", "--show-toplevel").strip()
+            names = git("diff", "--name-only", "-z", source[4:], "--").split('\0')
+            names.extend(git("ls-files", "--others", "--exclude-standard", "--full-name", "-z").split('\0'))
+        elif source == "stdin":
+            base_dir = path
+            names = [line.strip() for line in sys.stdin.read().splitlines()]
+        else:
+            base_dir = path
+            names = source.split(',')
+        
+        changed = set()
+        for name in names:
+            if name:
+                changed.add(self._realpath(os.path.join(base_dir, os.path.expanduser(name))))
+        self.log.info("%d %s changed (from %s)", len(changed), ("path has" if len(changed) == 1 else "paths have"), source)
+        return changed
+
+    def _find_affected_rules(self):
+        # Walk up the graph (via _required_by) from the changed paths to find the rules that may need to be rebuilt.
+        # Rules that always build, and rules that share a weak dependency set that contains a changed path, are affected as well.
+        to_visit = []
+        for path in self._changed_paths:
+            target = self._targets.get(path)
+            if target is not None:
+                if target.rule:
+                    to_visit.append(target.rule)
+                to_visit.extend(target._required_by)
+        always = self._targets.get(self.ALWAYS_BUILD)
+        if always is not None:
+            to_visit.extend(always._required_by)
+        
+        changed = self._changed_paths
+        changed_sets = set([node for key, node in self._dep_sets.items() if not key.isdisjoint(changed)])
+        for rule in self._rules:
+            if rule._weak_set in changed_sets or self.ALWAYS_BUILD in rule._weak_deps:
+                to_visit.append(rule)
+        
+        affected = set()
+        while to_visit:
+            rule = to_visit.pop()
+            if rule in affected:
+                continue
+            affected.add(rule)
+            for t in rule.produces:
+                to_visit.extend(t._required_by)
+        self.log.debug("%d of %d rules may be affected by the changed paths", len(affected), len(self._rules))
+        return affected
+
     def _get_changed_reqs(self, rule):
         changed_reqs = []
-        for req, weak in rule._required_targets:
+        trace = None
+        if self.traces:
+            trace = rule._req_trace = {}
+        
+        required = rule._required_targets
+        node = rule._weak_set
+        if node is not None:
+            # if no dependency in the shared weak dependency set has changed since the rule last saw it, skip the individual checks
+            # (a rule only records the signature of its current set, so entries for sets that it used in earlier builds
+            # do not accumulate in its cache)
+            signature, rule_versions = self._weak_set_signature(rule, node)
+            if signature is None or rule_versions.get("weak_set") != signature or trace is not None:
+                required = required + node.edges
+                if signature is not None:
+                    rule_versions["weak_set"] = signature
+                    self._rule_cache_changed(rule)
+        
+        immutable_changed = {} # map immutable directory -> whether its stamp has changed since the rule last saw it
+        for req, weak in required:
             if req.abs_path is self.ALWAYS_BUILD:
                 c = True
                 changed_reqs.append(req.abs_path)
             else:
-                c = self._req_has_changed(rule, req)
+                immutable = None
+                if req._virtual_modtime is None and req.rule is None:
+                    immutable = self._immutable_root(req.abs_path)
+                if immutable is not None:
+                    c = self._immutable_has_changed(rule, immutable, immutable_changed)
+                else:
+                    c = self._req_has_changed(rule, req)
                 if c is None:
                     # it is OK for weak dependencies to not exist
                     if not weak:
                         raise _BuildError("Failed to determine if %s has changed", req.abs_path)
                 elif c:
                     changed_reqs.append(req.abs_path)
-            rule._req_trace[req] = c
+            if trace is not None:
+                trace[req] = c
         return changed_reqs
     
     def _build_thread_func(self, special):
@@ -1147,7 +2622,14 @@ class EMK_Base(object):
                 self._local.current_rule = rule
 
                 need_build = False
-                changed_reqs = self._get_changed_reqs(rule)
+                # when the changed paths are known (the changed_from option), rules that they do not affect keep their state
+                # from the last build without checking their dependencies; rules that did not complete successfully in the
+                # last build are always checked
+                trusted = (self._affected_rules is not None and rule not in self._affected_rules and rule._cache_entry.get("ok") and not self.traces and
+                    (self._trusted_rules is None or rule.produces[0].abs_path in self._trusted_rules))
+                # when called back from an exported build.ninja, the rules that ninja runs itself are already up to date
+                trusted = trusted or (self._ninja_mode == "run" and bool((self._describe_rule(rule) or {}).get("commands")))
+                changed_reqs = [] if trusted else self._get_changed_reqs(rule)
                 rule._built = True
                 
                 if changed_reqs:
@@ -1157,19 +2639,27 @@ class EMK_Base(object):
                     for t in rule.produces:
                         tcache = rule._cache.setdefault(t.abs_path, {})
                         if not tcache.get("virtual", False): # virtual products of this rule cannot be modified externally
-                            if not os.path.exists(t.abs_path):
+                            if not self._stat_cache.exists(t.abs_path):
                                 self.log.debug("Need to build %s because it does not exist", t.abs_path)
                                 need_build = True
-                            elif t._rebuild_if_changed and rule.has_changed(t.abs_path):
+                            elif t._rebuild_if_changed and not trusted and rule.has_changed(t.abs_path):
                                 self.log.debug("Need to build %s because it has changed", t.abs_path)
                                 need_build = True
 
                 if need_build:
                     produces = [p.abs_path for p in rule.produces]
+                    if rule._cache_entry.get("ok"):
+                        # if the rule fails, it must not be trusted in the next build
+                        with self._cache_lock:
+                            rule._cache_entry["ok"] = False
+                            rule.scope._dirty_rule_caches.add(rule._key)
                     
                     if not rule.cwd_safe:
                         os.chdir(rule.scope.dir)
-                    rule.func(produces, rule.requires, *rule.args)
+                    try:
+                        rule.func(produces, rule.requires, *rule.args)
+                    finally:
+                        self._stat_cache.invalidate(produces)
                     rule._ran_func = True
 
                 self._local.current_rule = None
@@ -1198,17 +2688,35 @@ class EMK_Base(object):
 
         self._building = True
 
-        self._buildable_rules = _RuleQueue(self._build_threads)
+        with self._lock:
+            self._buildable_rules = _RuleQueue(self._build_threads)
+            if self._cancelled:
+                raise _BuildError("Build cancelled")
         
-        # mark unbuilt targets as unvisited
-        for path, target in self._targets.items():
+        for scope in self._visited_dirs.values():
+            scope._pending_rules = 0
+        
+        # mark the unbuilt targets that were examined in the previous phase as unvisited
+        for target in self._visited_targets:
             if not target._built:
                 target._visited = False
                 if target.rule:
                     target.rule._want_build = False
+        self._visited_targets = []
+        for node in self._examined_dep_sets:
+            node._examined = False
+            node._signatures = None
+        self._examined_dep_sets = []
+        
+        self._resolve_immutable_dirs()
+        if self._changed_paths is not None:
+            self._affected_rules = self._find_affected_rules()
         
         self._need_undefined_rule = False
         
+        # prebuild/postbuild functions may have created files that were previously missing
+        self._stat_cache.forget_missing()
+        
         # revisit all targets that we want to build that were not built previously
         for target in self._toplevel_examined_targets:
             if not target._built:
@@ -1243,6 +2751,7 @@ class EMK_Base(object):
             threads_left -= 1
             threads.append(threading.Thread(target=self._build_thread_func, kwargs={"special":False}))
         
+        self._start_cache_writer()
         for thread in threads:
             thread.start()
         
@@ -1255,6 +2764,7 @@ class EMK_Base(object):
             self._buildable_rules.stop()
             for thread in threads:
                 thread.join()
+            self._stop_cache_writer()
         
         if self._buildable_rules.errors:
             # For now, we just raise the first error
@@ -1285,24 +2795,90 @@ class EMK_Base(object):
         while self._prebuild_funcs:
             funcs = self._prebuild_funcs
             self._prebuild_funcs = []
-            try:
-                for scope, f in funcs:
-                    self._local.current_scope = scope
-                    os.chdir(scope.dir)
-                
-                    self.scope.prepare_do_later()
-                    f()
-                    self._run_do_later_funcs()
-                
-                    recurse_dirs = self.scope.recurse_dirs
-                    self.scope.recurse_dirs = set()
-
-                    for d in recurse_dirs:
-                        self._handle_dir(d)
-            except _BuildError:
-                raise
-            except Exception as e:
-                raise _BuildError("Error running prebuild function (in %s)" % (self.scope.dir), _get_exception_info())
+            i = 0
+            while i < len(funcs):
+                scope, f, cwd_safe = funcs[i]
+                if cwd_safe and self._build_threads > 1:
+                    # run consecutive cwd-safe prebuild functions in parallel
+                    j = i + 1
+                    while j < len(funcs) and funcs[j][2]:
+                        j += 1
+                    self._run_parallel_prebuild_funcs(funcs[i:j])
+                    i = j
+                else:
+                    self._run_prebuild_func(scope, f)
+                    i += 1
+    
+    def _run_prebuild_func(self, scope, f):
+        try:
+            self._local.current_scope = scope
+            os.chdir(scope.dir)
+            
+            self.scope.prepare_do_later()
+            f()
+            self._run_do_later_funcs()
+            
+            recurse_dirs = self.scope.recurse_dirs
+            self.scope.recurse_dirs = set()
+            
+            self._recurse_dirs(recurse_dirs)
+        except _BuildError:
+            raise
+        except Exception as e:
+            raise _BuildError("Error running prebuild function (in %s)" % (self.scope.dir), _get_exception_info())
+    
+    def _run_parallel_prebuild_funcs(self, funcs):
+        # The functions of each scope are run in order by a single thread; different scopes are independent at this stage,
+        # so they are spread over the build threads. The working directory is not changed (the functions are cwd-safe).
+        tasks = []
+        scope_tasks = collections.OrderedDict()
+        for scope, f, cwd_safe in funcs:
+            task = _PrebuildTask(scope, f)
+            tasks.append(task)
+            scope_tasks.setdefault(scope, []).append(task)
+        
+        pending = collections.deque(scope_tasks.values())
+        def thread_func():
+            self._local.current_rule = None
+            while True:
+                try:
+                    chain = pending.popleft()
+                except IndexError:
+                    return
+                for task in chain:
+                    self._local.current_scope = task.scope
+                    self._local.prebuild_task = task
+                    try:
+                        task.scope.prepare_do_later()
+                        task.func()
+                        self._run_do_later_funcs()
+                        task.recurse_dirs = task.scope.recurse_dirs
+                        task.scope.recurse_dirs = set()
+                    except _BuildError as e:
+                        task.error = e
+                    except Exception as e:
+                        task.error = _BuildError("Error running prebuild function (in %s)" % (task.scope.dir), _get_exception_info())
+                    finally:
+                        self._local.prebuild_task = None
+                    if task.error is not None:
+                        break
+        
+        threads = [threading.Thread(target=thread_func) for i in range(min(self._build_threads, len(scope_tasks)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        # Merge the results in the original order, and recurse into the directories of each function before merging the
+        # results of the next one (as a sequential run would), so that the build does not depend on thread timing.
+        for task in tasks:
+            if task.error is not None:
+                raise task.error
+            self._rules.extend(task.rules)
+            self._prebuild_funcs.extend(task.prebuild_funcs)
+            self._postbuild_funcs.extend(task.postbuild_funcs)
+            self._local.current_scope = task.scope
+            self._recurse_dirs(task.recurse_dirs)
     
     def _run_postbuild_funcs(self):
         funcs = self._postbuild_funcs
@@ -1346,6 +2922,8 @@ class EMK_Base(object):
                 # found a directory with a cached parent scope
                 parent_scope = self._stored_subproj_scopes[d]
                 break
+            self._note_graph_input(os.path.join(d, "emk_subproj.py"))
+            self._note_graph_input(os.path.join(d, "emk_project.py"))
             if os.path.isfile(os.path.join(d, "emk_subproj.py")):
                 # we will need to load this subproj file later
                 new_subproj_dirs.append((d, True))
@@ -1359,77 +2937,1141 @@ class EMK_Base(object):
             prev = d
             d, tail = os.path.split(d)
         
-        if proj_dir:
-            # load emk_project.py if necessary.
-            self._local.current_scope = _ScopeData(self._root_scope, "project", proj_dir, proj_dir)
-            
-            self._local.current_scope.prepare_do_later()
-            self.import_from([proj_dir], "emk_project")
-            self._run_module_post_functions()
-            self._run_do_later_funcs()
-            
-            parent_scope = self._local.current_scope
-        elif parent_scope is self._root_scope:
-            # no project dir; use root directory
-            proj_dir = d
-        else:
-            # use cached project dir
-            proj_dir = parent_scope.proj_dir
+        if proj_dir:
+            # load emk_project.py if necessary.
+            self._local.current_scope = _ScopeData(self._root_scope, "project", proj_dir, proj_dir)
+            
+            self._local.current_scope.prepare_do_later()
+            self.import_from([proj_dir], "emk_project")
+            self._run_module_post_functions()
+            self._run_do_later_funcs()
+            
+            parent_scope = self._local.current_scope
+        elif parent_scope is self._root_scope:
+            # no project dir; use root directory
+            proj_dir = d
+        else:
+            # use cached project dir
+            proj_dir = parent_scope.proj_dir
+        
+        # Now cache the parent scope for each directory we visited.
+        new_subproj_dirs.reverse()
+        for d, have_subproj in new_subproj_dirs:
+            if have_subproj:
+                # load emk_subproj.py if necessary.
+                self._local.current_scope = parent_scope = _ScopeData(parent_scope, "subproj", d, proj_dir)
+            
+                self.scope.prepare_do_later()
+                self.import_from([d], "emk_subproj")
+                self._run_module_post_functions()
+                self._run_do_later_funcs()
+            
+                self._stored_subproj_scopes[d] = self.scope
+            else:
+                self._stored_subproj_scopes[d] = parent_scope
+        
+        self._local.current_scope = parent_scope
+        self._current_proj_dir = proj_dir
+    
+    def _load_scope_cache(self, scope):
+        # must be called with the cache lock held
+        if scope._cache_loaded:
+            return
+        scope._cache_loaded = True
+        scope._cache = {}
+        if self.cleaning:
+            return
+        
+        db = self._get_db(scope)
+        data = db.load_scope(scope.dir)
+        if data is not None:
+            try:
+                scope._cache = db.unpack(data)
+                scope._cache_data = data
+            except Exception:
+                pass
+        else:
+            # make sure the scope is written to the database, even if its cache is empty
+            scope._cache_touched = True
+            self._load_legacy_cache(scope, db)
+
+    def _get_rule_cache(self, scope, key):
+        with self._cache_lock:
+            self._load_scope_cache(scope)
+            entry = scope._rule_caches.get(key)
+            if entry is not None:
+                return entry
+            
+            data = None
+            if not self.cleaning:
+                data = scope._db.load_rule(scope.dir, key)
+            if data is not None:
+                try:
+                    entry = scope._db.unpack(data)
+                except Exception:
+                    pass
+            if entry is None:
+                entry = {"cache": {}, "files": {}, "digests": {}}
+            scope._rule_caches[key] = entry
+            return entry
+
+    def _rule_cache_changed(self, rule):
+        with self._cache_lock:
+            rule.scope._dirty_rule_caches.add(rule._key)
+
+    def _load_legacy_cache(self, scope, db):
+        # migrate a per-directory cache file from an older version of emk
+        hash = hashlib.md5(scope.dir).hexdigest()
+        cache_path = os.path.join(scope.dir, scope.build_dir, "__emk_cache__" + hash)
+        try:
+            with open(cache_path, "rb") as f:
+                cache = pickle.load(f)
+        except Exception:
+            return
+        db.add_legacy_path(cache_path)
+        self.log.debug("Migrating cache file %s", cache_path)
+        
+        scope._cache = cache.get("other", {})
+        table = db.file_table()
+        if cache.get("format") is None:
+            # the rule caches store the modtime of each file directly; move them into the file state table
+            for key, old_entry in cache.get("rules", {}).items():
+                entry = scope._rule_caches[key] = {"cache": {}, "files": {}, "digests": {}}
+                scope._dirty_rule_caches.add(key)
+                for k, v in old_entry.items():
+                    if isinstance(v, dict) and "modtime" in v:
+                        fid, version = table.modtime_version(k, v["modtime"])
+                        entry["files"][fid] = version
+                        v = dict(v)
+                        del v["modtime"]
+                    entry["cache"][k] = v
+        elif cache.get("format") == _cache_format and cache.get("file_table") == table.token:
+            scope._rule_caches.update(cache.get("rules", {}))
+            scope._dirty_rule_caches.update(cache.get("rules", {}).keys())
+
+    def _db_location(self, scope):
+        # the project database is stored in the project build dir; if there is no project file,
+        # each rules scope has its own database. Returns (database dir, root dir).
+        cur = scope
+        while cur.parent and cur.scope_type != "project":
+            cur = cur.parent
+        if cur.scope_type != "project":
+            cur = scope
+        return os.path.join(cur.dir, cur.build_dir), cur.dir
+
+    def _get_db(self, scope):
+        db = scope._db
+        if db is None:
+            db_dir, root = self._db_location(scope)
+            with self._lock:
+                db = self._dbs.get(db_dir)
+                if db is None:
+                    db = self._dbs[db_dir] = _ProjectDB(db_dir, root)
+            scope._db = db
+        return db
+
+    def _get_file_table(self, scope):
+        table = scope._file_table
+        if table is None:
+            table = scope._file_table = self._get_db(scope).file_table()
+        return table
+
+    def _remove_scope_cache(self, scope):
+        with self._lock:
+            self._removed_caches.append(scope)
+
+    def _get_cache_changes(self, scope):
+        # Returns the scope cache rows and rule cache rows that need to be written for the given scope.
+        # None of the rules in the scope may be executing.
+        with self._cache_lock:
+            if not scope._cache_loaded:
+                return [], []
+            cache = None
+            if scope._cache_touched:
+                cache = scope._cache
+                scope._cache_touched = False
+            rule_caches = [(key, scope._rule_caches.get(key)) for key in scope._dirty_rule_caches]
+            scope._dirty_rule_caches = set()
+        
+        db = self._get_db(scope)
+        scope_rows = []
+        if cache is not None:
+            data = db.pack(cache)
+            if data != scope._cache_data:
+                scope_rows.append((scope.dir, scope.build_dir, data))
+                if self._config_records is not None and (scope._cache_data is None or db.unpack(scope._cache_data) != cache):
+                    # the rules of a resident graph may depend on the scope cache (eg the c module), so they must be loaded again
+                    self._written_scopes.add(scope.dir)
+                scope._cache_data = data
+        rule_rows = []
+        for key, entry in rule_caches:
+            if entry is None:
+                rule_rows.append((scope.dir, key, None))
+            else:
+                rule_rows.append((scope.dir, key, db.pack(entry)))
+        return scope_rows, rule_rows
+
+    def _write_caches(self, scopes, dbs=[]):
+        changes = {} # map db -> (scope cache rows, rule cache rows)
+        for db in dbs:
+            changes[db] = ([], [])
+        for scope in scopes:
+            scope_rows, rule_rows = self._get_cache_changes(scope)
+            if scope_rows or rule_rows:
+                db_scope_rows, db_rule_rows = changes.setdefault(self._get_db(scope), ([], []))
+                db_scope_rows.extend(scope_rows)
+                db_rule_rows.extend(rule_rows)
+        
+        for db, (scope_rows, rule_rows) in changes.items():
+            if scope_rows or rule_rows:
+                self.log.debug("Writing %d scope caches and %d rule caches to %s", len(scope_rows), len(rule_rows), db.path)
+            try:
+                db.write(scope_rows, rule_rows)
+            except sqlite3.Error as e:
+                raise _BuildError("Failed to write build database %s: %s" % (db.path, e))
+
+    def _start_cache_writer(self):
+        # Scope caches are written in the background as soon as all the rules in the scope have been built.
+        self._cache_write_queue = queue.Queue()
+        self._cache_write_error = None
+        self._cache_writer = threading.Thread(target=self._cache_writer_func)
+        self._cache_writer.daemon = True
+        self._cache_writer.start()
+
+    def _cache_writer_func(self):
+        done = False
+        while not done:
+            scopes = [self._cache_write_queue.get()]
+            while True:
+                try:
+                    scopes.append(self._cache_write_queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in scopes:
+                done = True
+                scopes = [scope for scope in scopes if scope is not None]
+            if scopes and self._cache_write_error is None:
+                try:
+                    self._write_caches(scopes)
+                except _BuildError as e:
+                    self._cache_write_error = e
+
+    def _stop_cache_writer(self):
+        self._cache_write_queue.put(None)
+        self._cache_writer.join()
+        if self._cache_write_error:
+            raise self._cache_write_error
+
+    def _setup_root_scope(self, path):
+        root_scope = _ScopeData(None, "global", path, _find_project_dir(path))
+        root_scope.module_paths.append(os.path.join(self._emk_dir, "modules"))
+        self._root_scope = root_scope
+        self._local.current_scope = root_scope
+        
+        # insert "clean" module
+        self.insert_module("clean", _Clean_Module(self.scope_name))
+        self.pre_modules.append("clean")
+
+    def _load_db_location(self, path):
+        # load the config for the given directory (without loading its rules), and return the location of its database.
+        path = os.path.realpath(path)
+        self._setup_root_scope(path)
+        self._load_config()
+        self._load_parent_scope(path)
+        return self._db_location(_ScopeData(self.scope, "rules", path, self._current_proj_dir))
+
+    def _cache_archive_path(self):
+        if len(self._explicit_targets) > 1:
+            raise _BuildError("Only one archive path may be specified", sorted(self._explicit_targets))
+        for archive in self._explicit_targets:
+            return os.path.abspath(archive)
+        return os.path.abspath("emk_cache.tar.gz")
+
+    def _cache_export(self, path):
+        archive = self._cache_archive_path()
+        db_dir, root = self._load_db_location(path)
+        db = _ProjectDB(db_dir, root)
+        if not os.path.isfile(db.path):
+            raise _BuildError("No build database found at %s" % (db.path))
+        build_dirs = db.build_dirs()
+        db.close()
+        
+        def _filter(info):
+            if os.path.join(root, info.name) == archive:
+                return None
+            # the build database records sub-second modification times, so store the exact mtime in a pax header
+            # (the ustar field only has whole seconds, and tarfile would otherwise round it to 12 digits)
+            info.pax_headers["mtime"] = repr(info.mtime)
+            return info
+        
+        added = []
+        with tarfile.open(archive, "w:gz", format=tarfile.PAX_FORMAT) as tar:
+            for d in [db_dir] + build_dirs:
+                rel = os.path.relpath(d, root)
+                if rel == os.pardir or rel.startswith(os.pardir + os.sep):
+                    self.log.warning("Not exporting build dir %s since it is not in %s", d, root)
+                    continue
+                if [a for a in added if d == a or d.startswith(a + os.sep)] or not os.path.isdir(d):
+                    continue
+                self.log.debug("Exporting %s", d)
+                tar.add(d, arcname=rel, filter=_filter)
+                added.append(d)
+        self.log.info("Exported %d build %s from %s to %s", len(added), "dir" if len(added) == 1 else "dirs", root, archive)
+
+    def _cache_import(self, path):
+        archive = self._cache_archive_path()
+        db_dir, root = self._load_db_location(path)
+        if not os.path.isfile(archive):
+            raise _BuildError("Cache archive %s does not exist" % (archive))
+        
+        with tarfile.open(archive, "r:*") as tar:
+            members = tar.getmembers()
+            for member in members:
+                for name in [member.name] + ([member.linkname] if member.issym() or member.islnk() else []):
+                    if os.path.isabs(name) or os.pardir in name.split('/'):
+                        raise _BuildError("Cache archive %s contains an unsafe path: %s" % (archive, name))
+            tar.extractall(root, members)
+        
+        # the file system may not be able to set the exact modtimes that were recorded when the archive was created
+        # (eg Python 2 can only set whole microseconds), so record the modtimes that the extracted files actually have
+        db = _ProjectDB(db_dir, root)
+        table = db.file_table()
+        for member in members:
+            if member.isfile():
+                path = os.path.join(root, member.name.replace("/", os.sep))
+                table.restamp(path, member.mtime, self._stat_cache.getmtime(path))
+        db.write([], [])
+        db.close()
+        self.log.info("Imported %s into %s", archive, root)
+
+    def _cache_server(self):
+        if len(self._explicit_targets) > 1:
+            raise _BuildError("Only one cache directory may be specified", sorted(self._explicit_targets))
+        root = os.path.expanduser("~/.emk/remote-artifacts")
+        for d in self._explicit_targets:
+            root = os.path.abspath(d)
+        host = self._options.get("cache_host", "127.0.0.1")
+        try:
+            port = int(self._options.get("cache_port", "8765"))
+            server = _ArtifactServer((host, port), _ArtifactRequestHandler)
+        except ValueError:
+            raise _BuildError("Invalid cache_port option '%s'" % (self._options.get("cache_port")))
+        except socket.error as e:
+            raise _BuildError("Failed to start artifact cache server on %s:%s: %s" % (host, self._options.get("cache_port", "8765"), e))
+        server.root = root
+        server.log = self.log
+        self.log.info("Serving artifact cache %s at http://%s:%d/", root, host, server.server_address[1])
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+    def _serve(self, path):
+        """
+        Run a resident build server for the project that contains the given directory (until interrupted or stopped).
+        
+        The server accepts builds from the emk script (see emk_client) on a Unix socket in a directory that is private to the
+        current user, and runs them one at a time in the client's directory and environment (see emk_client.build_env()),
+        streaming the log back to the client. The scopes, modules and build graph of the last build are kept in memory (see
+        _ResidentGraph), so only the directories whose rules may have changed are loaded again; the file metadata cache is
+        kept between builds as well, and updated from change notifications. If a build did not need to execute any rules,
+        the same build is answered immediately until a file that it depends on changes.
+        """
+        if not hasattr(socket, "AF_UNIX"):
+            raise _BuildError("The build server requires Unix domain sockets")
+        
+        proj_dir = emk_client.find_project_dir(os.path.realpath(path))
+        try:
+            sock_path = emk_client.socket_path(path)
+        except OSError as e:
+            raise _BuildError("Cannot create the build server socket: %s" % (e))
+        if os.path.exists(sock_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(sock_path)
+                raise _BuildError("A build server is already running for %s" % (proj_dir))
+            except socket.error:
+                os.remove(sock_path)
+            finally:
+                probe.close()
+        
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            listener.bind(sock_path)
+            listener.listen(5)
+        except socket.error as e:
+            listener.close()
+            raise _BuildError("Failed to start the build server on %s: %s" % (sock_path, e))
+        
+        watcher = _make_watcher()
+        stat_cache = _StatCache()
+        graphs = {} # map build key -> _ResidentGraph; only one graph is kept, since the modules are shared by all emk instances
+        state = None # union of the watch states of all builds
+        watched = set()
+        noop_keys = set() # the builds that did not execute any rules, and whose dependencies have not changed since
+        
+        self.log.info("Build server for %s listening on %s", proj_dir, sock_path)
+        try:
+            while True:
+                conn, addr = listener.accept()
+                try:
+                    kind, data = emk_client.read_frame(conn)
+                    if kind != b"r":
+                        continue
+                    req = _native_strings(json.loads(data.decode("utf-8")))
+                    if req.get("command") == "stop":
+                        self.log.info("Stopping the build server")
+                        emk_client.write_frame(conn, b"x", b"0")
+                        return
+                    
+                    # apply the changes since the last build
+                    events = []
+                    while True:
+                        new_events = watcher.read(0)
+                        if not new_events:
+                            break
+                        events.extend(new_events)
+                    if [e for e in events if e[0] is None]:
+                        stat_cache.clear()
+                        noop_keys.clear()
+                    else:
+                        stat_cache.invalidate([e[0] for e in events])
+                        if state and [e for e in events if _watch_relevant(state, e[0], e[1])]:
+                            noop_keys.clear()
+                    for graph in graphs.values():
+                        graph.note_changes(events)
+                    
+                    self.log.info("Building in %s", req["cwd"])
+                    code, report, key = self._serve_request(conn, req, graphs, stat_cache, watched, noop_keys)
+                    if report:
+                        if report["cancelled"]:
+                            self.log.info("Cancelled the build since the client disconnected")
+                        new_state = report["state"]
+                        state = tuple([old | new for old, new in zip(state, new_state)]) if state else new_state
+                        # only trust that nothing has changed if all of the dependencies were watched during the whole build
+                        if code == 0 and not report["cleaning"] and not report["executed"] and new_state[0] <= watched:
+                            noop_keys.add(key)
+                        else:
+                            noop_keys.discard(key)
+                        stat_cache.keep_dirs(watched)
+                        watched = state[0] | set([proj_dir])
+                        watcher.set_dirs(watched)
+                    try:
+                        emk_client.write_frame(conn, b"x", str(code).encode("utf-8"))
+                    except socket.error:
+                        pass
+                except (ValueError, KeyError, socket.error) as e:
+                    self.log.warning("Invalid build request: %s", e)
+                finally:
+                    try:
+                        conn.shutdown(socket.SHUT_RDWR)
+                    except socket.error:
+                        pass
+                    conn.close()
+                    os.chdir(path)
+        finally:
+            listener.close()
+            try:
+                os.remove(sock_path)
+            except OSError:
+                pass
+            watcher.close()
+
+    def _serve_request(self, conn, req, graphs, stat_cache, watched, noop_keys):
+        # Handle a build request from a build server client. Returns (exit code, build report or None if there was no build, key).
+        out = _ServerOutput(conn)
+        saved_env = dict(os.environ)
+        saved_stdout, saved_stderr = sys.stdout, sys.stderr
+        saved_level = self.log.level
+        self.log.removeHandler(self._log_handler)
+        graph = None
+        try:
+            os.environ.clear()
+            os.environ.update(req["env"])
+            os.chdir(req["cwd"])
+            sys.stdout = sys.stderr = out
+            
+            key = repr((os.path.realpath(req["cwd"]), req["args"], self._graph_env()))
+            graph = graphs.get(key)
+            if graph is None:
+                for old in graphs.values():
+                    old.detach()
+                graphs.clear()
+                graph = graphs[key] = _ResidentGraph(req["args"], req["cwd"], stat_cache)
+            
+            if key in noop_keys and graph.loaded and not graph.emk.traces:
+                graph.attach(out)
+                graph.emk.log.info("Nothing to build (nothing has changed since the last build)")
+                return 0, None, key
+            if not graph.load(out):
+                return 1, graph.emk._build_report(1), key
+            report = graph.build(watched, out=out)
+            return report["code"], report, key
+        finally:
+            if graph:
+                graph.detach()
+            sys.stdout, sys.stderr = saved_stdout, saved_stderr
+            os.environ.clear()
+            os.environ.update(saved_env)
+            self.log.addHandler(self._log_handler)
+            self.log.setLevel(saved_level)
+            builtins.emk = self
+
+    def _graph_records(self, local=True):
+        # The records that graph changes are added to when the graph is resident (see _GraphRecords), or None. Local changes
+        # are recorded in the current rules scope; everything else (eg changes made by the config files) in the config records.
+        if self._config_records is None:
+            return None
+        scope = getattr(self._local, "current_scope", None)
+        if local and scope is not None and scope._records is not None:
+            return scope._records
+        return self._config_records
+
+    def _note_graph_input(self, path, local=False):
+        # Local inputs (directory listings, and files imported by a rules file) only affect the current rules scope, so when
+        # the graph is resident only that scope has to be loaded again when they change.
+        records = self._graph_records(local)
+        if records is not None:
+            if path not in records.inputs:
+                records.inputs[path] = self._graph_inputs[path] = _graph_sig(path)
+        elif (self._persist_graph or self._watching or self._ninja_mode == "export") and path not in self._graph_inputs:
+            self._graph_inputs[path] = _graph_sig(path)
+
+    def _note_import(self, paths, name, found_path, local=False):
+        # the result of an import depends on the module file that was found, and on the absence of the module from the earlier paths
+        if not (self._persist_graph or self._watching or self._ninja_mode == "export"):
+            return
+        for d in paths:
+            candidate = os.path.join(d, name + ".py")
+            self._note_graph_input(candidate, local)
+            if found_path and os.path.dirname(found_path) == os.path.realpath(d):
+                break
+        if found_path:
+            self._note_graph_input(_source_path(found_path), local)
+
+    def _build_args(self):
+        # the options and explicit targets that affect the build graph
+        options = sorted([(k, v) for k, v in self._options.items() if k not in _graph_ignored_options])
+        return (options, sorted(self._explicit_targets))
+
+    def _graph_key(self, db, path):
+        return hashlib.md5(repr((db.db_path(path), self._graph_args))).hexdigest()
+
+    def _graph_env(self):
+        return hashlib.md5(repr(sorted([(k, v) for k, v in os.environ.items() if k not in _graph_ignored_env]))).hexdigest()
+
+    def _graph_db(self, path):
+        # load the parent scopes of the given directory, and get the database that its graph is stored in
+        self._load_parent_scope(path)
+        db_dir, root = self._db_location(_ScopeData(self.scope, "rules", path, self._current_proj_dir))
+        db = self._dbs.get(db_dir)
+        if db is None:
+            db = self._dbs[db_dir] = _ProjectDB(db_dir, root)
+        return db
+
+    def _reuse_graph(self, path):
+        # Returns True if the persisted build graph for the given directory shows that there is nothing to build.
+        db = self._graph_db(path)
+        data = db.load_graph(self._graph_key(db, path))
+        if data is None:
+            self.log.debug("No persisted build graph for %s", path)
+            return False
+        try:
+            graph = db.unpack(data)
+        except Exception:
+            return False
+        
+        if graph.get("format") != _graph_format:
+            return False
+        if not graph["noop"]:
+            self.log.debug("The persisted build graph for %s was recorded by a build that executed rules", path)
+            return False
+        if graph["env"] != self._graph_env():
+            self.log.debug("The environment has changed since the build graph for %s was persisted", path)
+            return False
+        for p, sig in graph["inputs"]:
+            if _graph_sig(p) != sig:
+                self.log.debug("%s has changed since the build graph for %s was persisted", p, path)
+                return False
+        for p, sig in graph["files"]:
+            if _graph_sig(p) != sig:
+                self.log.debug("%s has changed since the build graph for %s was persisted", p, path)
+                return False
+        return True
+
+    def _executed_rules(self):
+        # Returns True if the build executed any rule that may have changed what the next build depends on (ie, a rule function
+        # that is not idempotent, or a rule with a custom has_changed function).
+        has_changed_funcs = [getattr(f, "__func__", f) for f in (EMK_Base.default_has_changed, EMK_Base.hash_has_changed)]
+        for rule in self._rules:
+            if not rule._built:
+                continue
+            if (rule._ran_func and not rule.idempotent) or getattr(rule.has_changed, "__func__", None) not in has_changed_funcs:
+                return True
+        return False
+
+    def _save_graph(self, path):
+        # Persist the resolved build graph, along with the signatures of everything that it was created from.
+        # The graph can only be reused if no rules were executed (except idempotent rules), since executed rules may have
+        # discovered new dependencies (eg header files) that are not in the graph yet.
+        noop = not self._executed_rules()
+        files = {}
+        rules = []
+        for rule in self._rules:
+            required = rule._all_required()
+            requires = [(t.abs_path, weak) for t, weak in required if t.abs_path is not self.ALWAYS_BUILD]
+            always = len(requires) != len(required)
+            rules.append((rule.scope.dir, [t.abs_path for t in rule.produces], requires, always))
+            if not rule._built:
+                continue
+            for t in rule.produces:
+                if not rule._cache.get(t.abs_path, {}).get("virtual", False):
+                    files[t.abs_path] = self._stat_cache.stat(t.abs_path)
+            for p, weak in requires:
+                if p not in files and self._immutable_root(p) is None:
+                    files[p] = self._stat_cache.stat(p)
+        
+        graph = {"format": _graph_format, "env": self._graph_env(), "noop": noop, "rules": rules, "dir": path, "time": time.time()}
+        graph["aliases"] = sorted([(a, t.abs_path) for a, t in self._fixed_aliases.items() if t.rule])
+        graph["inputs"] = sorted(self._graph_inputs.items())
+        graph["files"] = [(p, (st.st_mtime, st.st_size, st.st_ino) if st else None) for p, st in sorted(files.items())]
+        
+        db = self._get_db(self._visited_dirs[path])
+        try:
+            db.write_graph(self._graph_key(db, path), db.pack(graph))
+        except sqlite3.Error as e:
+            self.log.warning("Failed to persist the build graph: %s", e)
+        db.close()
+
+    def _query(self, path, args):
+        # Answer a query about the persisted build graph of the given directory, without building (see 'emk :query').
+        words = [a for a in args if '=' not in a]
+        kinds = ("deps", "rdeps", "path", "producers")
+        if not words or words[0] not in kinds:
+            raise _BuildError("The query must be one of %s" % (", ".join(kinds)))
+        kind, names = words[0], words[1:]
+        if kind == "path" and len(names) != 2:
+            raise _BuildError("A path query needs exactly two targets (from and to)")
+        elif not names:
+            raise _BuildError("No targets given for the %s query" % (kind))
+        
+        fmt = self._options.get("format", "lines")
+        if fmt not in ("lines", "json", "tree"):
+            raise _BuildError("Unknown query format '%s'" % (fmt))
+        depth = self._options.get("depth")
+        if depth is not None:
+            try:
+                depth = int(depth)
+            except ValueError:
+                raise _BuildError("Query depth '%s' cannot be converted to an integer" % (depth))
+        weak = (self._options.get("weak", "yes") != "no")
+        if not [a for a in args if a.startswith("log=")]:
+            self.log.setLevel(logging.WARNING)
         
-        # Now cache the parent scope for each directory we visited.
-        new_subproj_dirs.reverse()
-        for d, have_subproj in new_subproj_dirs:
-            if have_subproj:
-                # load emk_subproj.py if necessary.
-                self._local.current_scope = parent_scope = _ScopeData(parent_scope, "subproj", d, proj_dir)
+        path = os.path.realpath(path)
+        db_dir, root = self._load_db_location(path)
+        scope = _ScopeData(self.scope, "rules", path, self._current_proj_dir)
+        db = _ProjectDB(db_dir, root)
+        # the graph that a build in this directory with the same options (and no explicit targets) has persisted
+        options = sorted([(k, v) for k, v in self._options.items() if k not in _graph_ignored_options and k not in _query_options])
+        graph = None
+        if os.path.isfile(db.path):
+            data = db.load_graph(hashlib.md5(repr((db.db_path(path), (options, [])))).hexdigest())
+            if data is not None:
+                graph = db.unpack(data)
+            if graph is None or graph.get("format") != _graph_format:
+                # otherwise, use the most recent graph of a build in this directory or one of its parents (with any options)
+                graph = None
+                for key, data in db.load_graphs():
+                    try:
+                        candidate = db.unpack(data)
+                    except Exception:
+                        continue
+                    if not isinstance(candidate, dict) or candidate.get("format") != _graph_format or "dir" not in candidate:
+                        continue
+                    d = candidate["dir"]
+                    if (path == d or path.startswith(d.rstrip(os.sep) + os.sep)) and (graph is None or candidate["time"] > graph["time"]):
+                        graph = candidate
+                if graph is not None:
+                    self.log.info("Using the build graph persisted for %s", graph["dir"])
+        db.close()
+        if graph is None or graph.get("format") != _graph_format:
+            raise _BuildError("No persisted build graph for %s; build it with the persist_graph=yes option first" % (path))
+        graph_dir = graph.get("dir", path)
+        graph_scope = _ScopeData(self.scope, "rules", graph_dir, self._current_proj_dir) if graph_dir != path else scope
+        
+        rules = graph["rules"]
+        aliases = dict(graph.get("aliases", []))
+        producers = {}
+        users = collections.defaultdict(list)
+        for i, (d, produces, requires, always) in enumerate(rules):
+            for p in produces:
+                producers[p] = i
+            for p, is_weak in requires:
+                if weak or not is_weak:
+                    users[p].append(i)
+        
+        targets = []
+        for name in names:
+            # relative names are resolved against the current directory, or else against the directory of the graph
+            candidates = [_make_target_abspath(name, s) for s in (scope, graph_scope)]
+            candidates = [aliases.get(p, p) for p in candidates]
+            found = [p for p in candidates if p in producers or p in users]
+            if not found:
+                raise _BuildError("%s is not in the build graph of %s" % (candidates[0], graph_dir))
+            targets.append(found[0])
+        
+        def deps(p):
+            i = producers.get(p)
+            if i is None:
+                return []
+            return sorted(set([r for r, is_weak in rules[i][2] if weak or not is_weak]))
+        
+        def rdeps(p):
+            return sorted(set([q for i in users.get(p, []) for q in rules[i][1]]))
+        
+        out = []
+        if kind == "producers":
+            result = {}
+            for p in targets:
+                i = producers.get(p)
+                if i is None:
+                    result[p] = None
+                    out.append("%s	-" % (p))
+                else:
+                    d, produces, requires, always = rules[i]
+                    result[p] = {"dir": d, "produces": produces, "requires": [r for r, is_weak in requires if not is_weak],
+                        "weak": [r for r, is_weak in requires if is_weak], "always": always}
+                    out.append("%s	%s	%s" % (p, d, ' '.join(produces)))
+        elif kind == "path":
+            # breadth-first search through the requirements, so the path is as short as possible
+            start, end = targets
+            parents = {start: None}
+            level = [start]
+            d = 0
+            while level and end not in parents and (depth is None or d < depth):
+                d += 1
+                next_level = []
+                for p in level:
+                    for q in deps(p):
+                        if q not in parents:
+                            parents[q] = p
+                            next_level.append(q)
+                level = next_level
+            if end not in parents:
+                raise _BuildError("%s does not depend on %s" % (start, end))
+            result = []
+            p = end
+            while p is not None:
+                result.append(p)
+                p = parents[p]
+            result.reverse()
+            out = ["  " * i + p for i, p in enumerate(result)] if fmt == "tree" else result
+        else:
+            edges = deps if kind == "deps" else rdeps
+            if fmt == "tree":
+                expanded = set()
+                def walk(p, level):
+                    children = edges(p) if (depth is None or level < depth) else []
+                    if p in expanded and children:
+                        out.append("  " * level + p + " ...")
+                        return
+                    out.append("  " * level + p)
+                    expanded.add(p)
+                    for q in children:
+                        walk(q, level + 1)
+                for p in targets:
+                    walk(p, 0)
+            else:
+                depths = dict([(p, 0) for p in targets])
+                result = []
+                level = targets
+                d = 0
+                while level and (depth is None or d < depth):
+                    d += 1
+                    next_level = []
+                    for p in level:
+                        for q in edges(p):
+                            if q not in depths:
+                                depths[q] = d
+                                next_level.append(q)
+                                result.append({"path": q, "depth": d, "generated": q in producers})
+                    level = next_level
+                out = [r["path"] for r in result]
+        
+        if fmt == "json":
+            sys.stdout.write(json.dumps(result, indent=1, separators=(",", ": "), sort_keys=True) + '\n')
+        else:
+            for line in out:
+                sys.stdout.write(line + '\n')
+
+    def _describe_rule(self, rule):
+        # Returns the command description of the rule (from its command function), or None if the rule can only be run by emk itself.
+        if not rule.command:
+            return None
+        saved_scope = getattr(self._local, "current_scope", None)
+        self._local.current_scope = rule.scope
+        try:
+            return rule.command([t.abs_path for t in rule.produces], rule.requires, *rule.args)
+        finally:
+            self._local.current_scope = saved_scope
+
+    def _write_ninja(self, path, args):
+        # Write the build graph of the completed build into build.ninja in the given directory. Rules that describe their command
+        # lines are run by ninja directly (with header dependencies from their depfiles); rules that only mark their products
+        # virtual become phony edges, and all other rules call back into emk ('emk :ninja-run') to run just that rule.
+        # Paths are written as absolute paths, so ninja's working directory does not matter to the commands.
+        def esc(p):
+            return p.replace('$', '$$').replace(' ', '$ ').replace(':', '$:')
+        
+        def command_line(commands):
+            if os.name == "nt":
+                line = " && ".join([subprocess.list2cmdline(c) for c in commands])
+                if len(commands) > 1:
+                    line = "cmd /c " + line
+            else:
+                line = " && ".join([' '.join([_shell_quote(a) for a in c]) for c in commands])
+            return line.replace('$', '$$')
+        
+        emk_cmd = [sys.executable, os.path.join(self._emk_dir, "emk")]
+        options = [a for a in args if '=' in a and a.partition('=')[0] not in _graph_ignored_options and \
+            a.partition('=')[0] not in ("explicit_target", "lazy_dirs")]
+        stamp_dir = os.path.join(path, ".emk_ninja")
+        
+        lines = ["# Generated by 'emk :ninja'; changes will be overwritten.", "ninja_required_version = 1.3",
+            "builddir = " + esc(stamp_dir), "",
+            "rule emk_command", "  command = $cmd", "  description = $desc", "",
+            "rule emk_command_depfile", "  command = $cmd", "  description = $desc", "  depfile = $depfile", "  deps = gcc", "",
+            "pool emk_callback_pool", "  depth = 1", "",
+            "rule emk_callback", "  command = $cmd", "  description = $desc", "  pool = emk_callback_pool", "  restat = 1", "",
+            "rule emk_regenerate", "  command = $cmd", "  description = Regenerating build.ninja", "  generator = 1", "",
+            "rule emk_listings", "  command = $cmd", "  description = Checking directory listings", "  generator = 1", "  restat = 1", "",
+            "build emk_always_build: phony", ""]
+        
+        def node(t):
+            return "emk_always_build" if t.abs_path is self.ALWAYS_BUILD else esc(t.abs_path)
+        
+        num_commands = num_callbacks = 0
+        for rule in self._rules:
+            if not rule._built or not rule.produces:
+                continue
+            desc = self._describe_rule(rule)
+            products = [t.abs_path for t in rule.produces]
+            virtual = [p for p in products if rule._cache.get(p, {}).get("virtual", False)]
+            depfile = desc and desc.get("depfile")
             
-                self.scope.prepare_do_later()
-                self.import_from([d], "emk_subproj")
-                self._run_module_post_functions()
-                self._run_do_later_funcs()
+            inputs = []
+            implicit = []
+            order_only = []
+            for t, weak in rule._all_required():
+                if not weak:
+                    inputs.append(node(t))
+                elif t.rule:
+                    (order_only if depfile else implicit).append(node(t))
+                elif not depfile and self._stat_cache.exists(t.abs_path):
+                    implicit.append(node(t))
+            deps = ' '.join(inputs)
+            if implicit:
+                deps += " | " + ' '.join(implicit)
+            if order_only:
+                deps += " || " + ' '.join(order_only)
             
-                self._stored_subproj_scopes[d] = self.scope
+            description = (desc and desc.get("description")) or os.path.relpath(products[0], path)
+            if desc is not None and not desc.get("commands"):
+                lines.append("build %s: phony %s" % (' '.join([esc(p) for p in products]), ' '.join(inputs + implicit + order_only)))
+            elif desc is not None:
+                num_commands += 1
+                lines.append("build %s: %s %s" % (' '.join([esc(p) for p in products]),
+                    "emk_command_depfile" if depfile else "emk_command", deps))
+                lines.append("  cmd = " + command_line(desc["commands"]))
+                lines.append("  desc = " + description.replace('$', '$$'))
+                if depfile:
+                    lines.append("  depfile = " + esc(depfile))
             else:
-                self._stored_subproj_scopes[d] = parent_scope
-        
-        self._local.current_scope = parent_scope
-        self._current_proj_dir = proj_dir
-    
-    def _load_scope_cache(self, scope):
-        if not self.cleaning:
-            hash = hashlib.md5(scope.dir).hexdigest()
-            cache_path = os.path.join(scope.dir, scope.build_dir, "__emk_cache__" + hash)
-            try:
-                with open(cache_path, "rb") as f:
-                    scope._cache = pickle.load(f)
-            except IOError:
+                num_callbacks += 1
+                outputs = [p for p in products if p not in virtual]
+                callback = emk_cmd + [":ninja-run"] + options + _ninja_run_options
+                if virtual:
+                    stamp = os.path.join(stamp_dir, hashlib.md5(products[0]).hexdigest())
+                    outputs.append(stamp)
+                    callback.append("ninja_stamp=" + stamp)
+                callback.append("explicit_target=" + products[0])
+                lines.append("build %s: emk_callback %s" % (' '.join([esc(p) for p in outputs]), deps))
+                lines.append("  cmd = " + command_line([callback]))
+                lines.append("  desc = emk " + description.replace('$', '$$'))
+                for p in virtual:
+                    lines.append("build %s: phony %s" % (esc(p), esc(stamp)))
+        
+        for alias, t in sorted(self._fixed_aliases.items()):
+            if t.rule and t.rule._built and alias != t.abs_path:
+                lines.append("build %s: phony %s" % (esc(alias), esc(t.abs_path)))
+        
+        # Directories are not inputs of build.ninja, since their modification times also change when files are created in them
+        # (eg by rules, or by ninja itself). Instead, the listings stamp (which is only rewritten when a listing has changed) is
+        # checked whenever a directory changes. The directory that holds build.ninja is not an input of the stamp at all; if its
+        # listing is used, the stamp is checked on every run.
+        inputs = set([p for p, sig in self._graph_inputs.items() if sig is not None])
+        listing_dirs = set([p for p in inputs if os.path.isdir(p)])
+        inputs -= listing_dirs
+        listings_stamp = os.path.join(stamp_dir, "listings")
+        _update_ninja_listings(listings_stamp, listing_dirs)
+        lines.append("")
+        watched = [esc(d) for d in sorted(listing_dirs) if d != path]
+        if path in listing_dirs:
+            watched.append("emk_always_build")
+        lines.append("build %s: emk_listings | %s" % (esc(listings_stamp), ' '.join(watched)))
+        lines.append("  cmd = " + command_line([emk_cmd + [":ninja-listings", "log=warning", "ninja_stamp=" + listings_stamp]]))
+        lines.append("build build.ninja: emk_regenerate %s | %s" % (esc(listings_stamp), ' '.join([esc(p) for p in sorted(inputs)])))
+        lines.append("  cmd = " + command_line([emk_cmd + [":ninja"] + args]))
+        
+        defaults = sorted([t.abs_path for t in self._toplevel_examined_targets if t.rule and t.rule._built])
+        if defaults:
+            lines.append("")
+            lines.append("default %s" % (' '.join([esc(p) for p in defaults])))
+        
+        ninja_path = os.path.join(path, "build.ninja")
+        with open(ninja_path, "w") as f:
+            f.write('\n'.join(lines) + '\n')
+        self.log.info("Wrote %s (%d commands, %d emk callbacks)", ninja_path, num_commands, num_callbacks)
+
+    def _touch_ninja_stamp(self):
+        # mark a rule with virtual products as built for ninja (see _write_ninja())
+        stamp = self._options.get("ninja_stamp")
+        if stamp:
+            d = os.path.dirname(stamp)
+            if not os.path.isdir(d):
+                os.makedirs(d)
+            with open(stamp, "w"):
                 pass
-        if scope._cache is None:
-            scope._cache = {}
 
-    def _remove_cache(self, cache_path):
-        try:
-            os.remove(cache_path)
-        except OSError:
-            pass
+    def _cancel_build(self):
+        # called from another thread (in watch mode) to stop the current build; rules that are executing will finish.
+        with self._lock:
+            self._cancelled = True
+            if self._buildable_rules:
+                self._buildable_rules.error(_BuildError("Build cancelled"))
+
+    def _watch_state(self):
+        # Returns the state needed to decide whether a changed path affects the build (in watch mode), as a tuple
+        # (directories to watch, relevant files, directories whose listings are relevant, build dirs).
+        products = set([p for p, t in self._targets.items() if t.rule])
+        build_dirs = set([os.path.realpath(os.path.join(scope.dir, scope.build_dir)) for scope in self._visited_dirs.values()])
+        listing_dirs = set(self._visited_dirs.keys())
+        
+        files = set()
+        for rule in self._rules:
+            for t, weak in rule._required_targets:
+                files.add(t.abs_path)
+            files.update([r for r in rule.requires if r is not self.ALWAYS_BUILD and self.build_dir_placeholder not in r])
+        for node in self._dep_sets.values():
+            files.update(node.paths)
+        for p, sig in self._graph_inputs.items():
+            if p in listing_dirs:
+                continue
+            files.add(p)
+        files.discard(self.ALWAYS_BUILD)
+        files -= products
+        if self._immutable_roots:
+            files = set([f for f in files if self._immutable_root(f) is None])
+        
+        dirs = set(listing_dirs)
+        dirs.update([os.path.dirname(f) for f in files])
+        dirs = set([d for d in dirs if not [b for b in build_dirs if d == b or d.startswith(b + os.sep)]])
+        return dirs, files, listing_dirs, build_dirs
+
+    def _build_report(self, code):
+        # The result of a build, for watch mode and the build server (eg when the build ran in a forked process; see _ResidentGraph).
+        state = self._watch_state()
+        checked = set() # the rules that were up to date at the end of the build
+        for rule in self._rules:
+            if rule._built and rule.produces and rule._cache_entry is not None and rule._cache_entry.get("ok"):
+                checked.add(rule.produces[0].abs_path)
+        return {"code": code, "cleaning": self.cleaning, "cancelled": self._cancelled,
+            "failed": self._buildable_rules is None or bool(self._buildable_rules.errors), "executed": self._executed_rules(),
+            "state": state, "checked": checked, "written": self._written_scopes, "stats": self._stat_cache.entries(state[0])}
+
+    def _load_resident(self, path):
+        # Load the config and rules files for a build in the given directory, and prepare the first build phase, so that the
+        # graph can be kept in memory between builds (see _ResidentGraph). Each build then calls run() in a forked process.
+        self._config_records = _GraphRecords()
+        self._watching = True
+        self._start_run(os.path.realpath(path))
+        self._lazy_dirs = False
+        self._load_config()
+        self._handle_dir(self._run_path, first_dir=True)
+        if self._want_phase():
+            self._prepare_phase()
+            self._prepared = True
+
+    def _root_dirs(self):
+        # the directories of a resident graph that are not loaded because another directory recursed into them
+        return [self._run_path] + sorted(self._config_records.recursed - set([self._run_path]))
+
+    def _dirs_to_reload(self, changes):
+        # Returns the directories of a resident graph that must be loaded again because of the given changes (a list of
+        # (path, listing) tuples, as returned by the watchers), or None if the whole graph must be loaded again.
+        config_inputs = self._config_records.inputs
+        local_inputs = {} # map input path -> directories that were loaded from it
+        for d, scope in self._visited_dirs.items():
+            for p in scope._records.inputs:
+                local_inputs.setdefault(p, []).append(d)
+        
+        dirs = set()
+        for path, listing in changes:
+            if path is None or path in config_inputs:
+                return None
+            dirs.update(local_inputs.get(path, ()))
+            parent = os.path.dirname(path)
+            if listing:
+                dirs.update(local_inputs.get(parent, ()))
+            if parent in self._visited_dirs:
+                # rules files and prebuild functions may read any file in their directory (eg to find the main() functions)
+                target = self._targets.get(path)
+                if target is None or not target.rule:
+                    dirs.add(parent)
+        return dirs
+
+    def _reload_dirs(self, dirs):
+        # Load the given directories of a resident graph again, along with the directories that recursed into them (their
+        # prebuild functions may depend on the reloaded directories, eg through the link module), and resolve the graph again.
+        # Returns the products of the rules that are new or have different requirements, which must not be trusted.
+        recursed_by = {}
+        for d, scope in self._visited_dirs.items():
+            for sub in scope._records.recursed:
+                recursed_by.setdefault(sub, set()).add(d)
+        reload_dirs = set()
+        to_visit = [d for d in dirs if d in self._visited_dirs]
+        while to_visit:
+            d = to_visit.pop()
+            if d not in reload_dirs:
+                reload_dirs.add(d)
+                to_visit.extend(recursed_by.get(d, ()))
+        if not reload_dirs:
+            return set()
+        
+        old_reqs = {}
+        for rule in self._rules:
+            old_reqs[rule] = set([t.abs_path for t, weak in rule._all_required()])
+        
+        # every reloaded directory is either a root directory, or is recursed into by another reloaded directory
+        self._unload_dirs(reload_dirs)
+        for d in self._root_dirs():
+            if d in reload_dirs:
+                self._handle_dir(d)
+        self._run_prebuild_funcs()
+        
+        # directories that are no longer recursed into are dropped
+        reachable = set()
+        to_visit = self._root_dirs()
+        while to_visit:
+            d = to_visit.pop()
+            scope = self._visited_dirs.get(d)
+            if scope is not None and d not in reachable:
+                reachable.add(d)
+                to_visit.extend(scope._records.recursed)
+        unreachable = set(self._visited_dirs.keys()) - reachable
+        if unreachable:
+            self._unload_dirs(unreachable)
+        
+        self._relink_graph()
+        
+        untrusted = set()
+        for rule in self._rules:
+            reqs = old_reqs.get(rule)
+            if reqs is None or reqs != set([t.abs_path for t, weak in rule._all_required()]):
+                untrusted.update([t.abs_path for t in rule.produces])
+        return untrusted
+
+    def _unload_dirs(self, dirs):
+        # Remove the given directories from a resident graph. The unload_rules() method of each module in their scopes is
+        # called, so that modules can forget any state that they share with other scopes.
+        scopes = set()
+        for d in sorted(dirs):
+            scope = self._visited_dirs.pop(d)
+            scopes.add(scope)
+            self._local.current_scope = scope
+            for mod in scope.modules.values():
+                _try_call_method(mod, "unload_rules")
+            for alias, target in scope._records.aliases:
+                self._aliases.pop(alias, None)
+            for path in scope._records.inputs:
+                self._dir_snapshots.pop(path, None)
+        
+        rules = []
+        for rule in self._rules:
+            if rule.scope in scopes:
+                for t in rule.produces:
+                    if self._targets.get(t.abs_path) is t:
+                        del self._targets[t.abs_path]
+            else:
+                rules.append(rule)
+        self._rules = rules
+        self._postbuild_funcs = [(scope, f) for scope, f in self._postbuild_funcs if scope not in scopes]
+
+    def _relink_graph(self):
+        # Rebuild a resident graph from its rules and the records of all scopes (see _GraphRecords), after some directories
+        # have been loaded again, and prepare the first build phase again.
+        targets = {}
+        for rule in self._rules:
+            rule._secondary_deps = _empty_set
+            rule._weak_deps = _empty_set
+            rule._required_targets = []
+            rule._weak_set = None
+            for t in rule.produces:
+                t._attached = _empty_set
+                t._rebuild_if_changed = False
+                t._required_by = _empty_set
+                targets[t.abs_path] = t
+        self._targets = targets
+        
+        self._aliases = {}
+        self._secondary_dependencies = {}
+        self._weak_dependencies = {}
+        self._attached_dependencies = {}
+        self._auto_targets = set()
+        self._requires_rule = set()
+        self._rebuild_if_changed = set()
+        self._graph_inputs = {}
+        for records in [self._config_records] + [scope._records for scope in self._visited_dirs.values()]:
+            self._aliases.update(records.aliases)
+            for path, deps in records.depends:
+                self._secondary_dependencies.setdefault(path, []).extend(deps)
+            for path, deps in records.weak_depends:
+                self._weak_dependencies.setdefault(path, []).extend(deps)
+            for path, deps in records.attached:
+                self._attached_dependencies.setdefault(path, []).extend(deps)
+            self._auto_targets.update(records.auto_targets)
+            self._requires_rule.update(records.requires_rule)
+            self._rebuild_if_changed.update(records.rebuild_if_changed)
+            self._graph_inputs.update(records.inputs)
+        
+        self._fixed_aliases = {}
+        self._unresolved_aliases = set(self._aliases.keys())
+        self._fixed_auto_targets = []
+        self._fixed_rule_count = 0
+        self._dirty_rules = set()
+        self._replaced_targets = []
+        self._dep_sets = {}
+        self._added_rule = bool(self._rules or self._aliases)
+        self._prepared = False
+        if self._want_phase():
+            self._prepare_phase()
+            self._prepared = True
 
     def _write_scope_caches(self):
         if self.cleaning:
-            return
-        for path, scope in self._visited_dirs.items():
-            hash = hashlib.md5(path).hexdigest()
-            cache_path = os.path.join(path, scope.build_dir, "__emk_cache__" + hash)
-            if scope._cache:
+            for scope in self._removed_caches:
+                self._get_db(scope).remove_scopes([scope.dir])
+        else:
+            self._write_caches(self._visited_dirs.values(), self._dbs.values())
+            for db in self._dbs.values():
                 try:
-                    with open(cache_path, "wb") as f:
-                        pickle.dump(scope._cache, f, -1)
-                except IOError:
-                    self.log.error("Failed to write cache file %s", cache_path)
-                    self._remove_cache(cache_path)
-                    raise
-                except:
-                    self._remove_cache(cache_path)
-                    raise
+                    db.finish()
+                except sqlite3.Error as e:
+                    raise _BuildError("Failed to compact build database %s: %s" % (db.path, e))
+        
+        for db in self._dbs.values():
+            db.close()
     
     def _handle_dir(self, d, first_dir=False):
         path = os.path.realpath(d)
@@ -1446,8 +4088,9 @@ class EMK_Base(object):
         # First, load the parent scope, and create a rules scope for this directory.
         self._load_parent_scope(path)
         self._local.current_scope = _ScopeData(self._local.current_scope, "rules", path, self._current_proj_dir)
-        
-        self._load_scope_cache(self._local.current_scope)
+        if self._config_records is not None:
+            self.scope._records = _GraphRecords()
+        self._note_graph_input(path, local=True) # the directory listing (eg for autodetection of source files)
         
         # Load any preload modules that have been inherited from the parent scope(s).
         self.scope.prepare_do_later()
@@ -1485,9 +4128,146 @@ class EMK_Base(object):
         
         self._visited_dirs[path] = self.scope
         
-        for d in recurse_dirs:
+        self._recurse_dirs(recurse_dirs)
+    
+    def _recurse_dirs(self, dirs):
+        # In lazy mode, directories are only handled once the build needs one of their targets (see _load_needed_dirs()).
+        for d in dirs:
+            if self._lazy_dirs:
+                path = os.path.realpath(d)
+                if path not in self._visited_dirs and path not in self._deferred_dirs:
+                    self.log.debug("Deferring directory %s", path)
+                    self._deferred_dirs[path] = self._local.current_scope
+            else:
+                self._handle_dir(d)
+    
+    def _load_needed_dirs(self):
+        # In lazy mode, handle the deferred directories that produce targets which the build needs (according to the persisted
+        # target index). If a needed target is not in the index and does not exist, any deferred directory might produce it,
+        # so all of them are handled. Returns True if any directories were handled.
+        if not self._deferred_dirs:
+            return False
+        index = self._get_target_index()
+        
+        needed = set()
+        seen = set()
+        to_visit = [(path, False) for path in self._explicit_targets]
+        to_visit.extend([(t.abs_path, False) for t in self._must_build])
+        to_visit.extend([(t.abs_path, False) for t in self._toplevel_examined_targets if not t._built])
+        while to_visit:
+            path, weak = to_visit.pop()
+            if path in seen or path is self.ALWAYS_BUILD:
+                continue
+            seen.add(path)
+            t = self._get_target(path)
+            if t is not None:
+                to_visit.extend([(p, False) for p in t._attached])
+                if t.rule is not None:
+                    to_visit.extend([(req.abs_path, w) for req, w in t.rule._all_required()])
+                    continue
+            d = index.get(path)
+            if d in self._deferred_dirs:
+                needed.add(d)
+            elif d is None and not weak and not (t is not None and t._attached) and not self._stat_cache.exists(path):
+                self.log.debug("%s is not in the target index; loading all deferred directories", path)
+                needed = set(self._deferred_dirs.keys())
+                break
+        
+        self._handle_deferred_dirs(needed)
+        return bool(needed)
+    
+    def _handle_deferred_dirs(self, dirs):
+        for d in sorted(dirs):
+            self._local.current_scope = self._deferred_dirs.pop(d)
             self._handle_dir(d)
     
+    def _get_target_index(self):
+        if self._target_index is None:
+            self._target_index = {}
+            for d, paths in self._load_target_index().items():
+                for path in paths:
+                    self._target_index[path] = d
+        return self._target_index
+    
+    def _target_index_db(self):
+        return self._get_db(self._visited_dirs[self._run_path])
+    
+    def _load_target_index(self):
+        # The target index maps each directory to the targets (rule products and aliases) that are defined when it is loaded.
+        # It is stored in the build database of the directory that emk was run in.
+        if self._stored_target_index is None:
+            self._stored_target_index = {}
+            db = self._target_index_db()
+            data = db.load_graph("target_index")
+            if data is not None:
+                try:
+                    self._stored_target_index = db.unpack(data)
+                except Exception:
+                    pass
+        return self._stored_target_index
+    
+    def _save_target_index(self):
+        # Update the target index with the targets of the directories that were loaded in this build.
+        entries = {}
+        for path in self._visited_dirs:
+            entries[path] = set()
+        for rule in self._rules:
+            entries[rule.scope.dir].update([t.abs_path for t in rule.produces])
+        for alias in self._aliases:
+            d = os.path.dirname(alias)
+            if d in entries:
+                entries[d].add(alias)
+        
+        index = self._load_target_index()
+        changed = False
+        for d, paths in entries.items():
+            paths = sorted(paths)
+            if index.get(d) != paths:
+                index[d] = paths
+                changed = True
+        if changed:
+            db = self._target_index_db()
+            try:
+                db.write_graph("target_index", db.pack(index))
+            except sqlite3.Error as e:
+                self.log.warning("Failed to store the target index: %s", e)
+    
+    def _take_dir_snapshot(self, path):
+        # The listing is reused from the previous build if the directory has the same signature as when the listing was stored.
+        sig = _graph_sig(path)
+        db = self._get_db(self.scope)
+        with self._lock:
+            stored = self._stored_snapshots.get(db)
+            if stored is None:
+                stored = self._stored_snapshots[db] = self._load_dir_snapshots(db)
+        entry = stored.get(path)
+        if sig is not None and entry is not None and entry[0] == sig:
+            return _DirSnapshot(path, entry[1])
+        
+        files = _list_files(path)
+        if sig is not None and time.time() - sig[0] > _snapshot_racy_interval:
+            with self._lock:
+                self._new_snapshots.setdefault(db, {})[path] = (sig, files)
+        return _DirSnapshot(path, files)
+    
+    def _load_dir_snapshots(self, db):
+        data = db.load_graph("dir_snapshots")
+        if data is not None:
+            try:
+                return db.unpack(data)
+            except Exception:
+                pass
+        return {}
+    
+    def _save_dir_snapshots(self):
+        for db, snapshots in self._new_snapshots.items():
+            stored = self._stored_snapshots[db]
+            stored.update(snapshots)
+            try:
+                db.write_graph("dir_snapshots", db.pack(stored))
+            except sqlite3.Error as e:
+                self.log.warning("Failed to store the directory listings: %s", e)
+    
     def _module(self, name, weak):
         # if the module has already been loaded in the current scope, return the existing instance
         if name in self.scope.modules:
@@ -1535,8 +4315,13 @@ class EMK_Base(object):
         try:
             fixed_module_paths = [_make_target_abspath(path, self.scope) for path in self.scope.module_paths]
             self.log.debug("Trying to load module %s from %s", name, fixed_module_paths)
-            fp, pathname, description = imp.find_module(name, fixed_module_paths)
+            try:
+                fp, pathname, description = imp.find_module(name, fixed_module_paths)
+            except ImportError:
+                self._note_import(fixed_module_paths, name, None)
+                raise
             mpath = os.path.realpath(pathname)
+            self._note_import(fixed_module_paths, name, mpath)
             if not mpath in self._all_loaded_modules:
                 d, tail = os.path.split(mpath)
                 os.chdir(d)
@@ -1564,7 +4349,7 @@ class EMK_Base(object):
         self.log.info("Module %s not found", name)
         return None
     
-    def _rule(self, func, produces, requires, args, cwd_safe, ex_safe, has_changed, stack):
+    def _rule(self, func, produces, requires, args, cwd_safe, ex_safe, has_changed, stack, idempotent=False, command=None):
         if self.scope_name != "rules":
             raise _BuildError("Cannot create rules when not in 'rules' scope (current scope = '%s')" % (self.scope_name), stack)
         
@@ -1583,8 +4368,11 @@ class EMK_Base(object):
 
         new_rule = _Rule(fixed_requires, args, func, cwd_safe, ex_safe, has_changed, self.scope)
         new_rule.stack = stack
+        new_rule.idempotent = idempotent
+        new_rule.command = command
+        task = getattr(self._local, "prebuild_task", None)
         with self._lock:
-            self._rules.append(new_rule)
+            (self._rules if task is None else task.rules).append(new_rule)
             for product in fixed_produces:
                 new_target = _Target(product, new_rule)
                 if new_target.abs_path in self._targets and self._targets[new_target.abs_path].rule:
@@ -1596,6 +4384,9 @@ class EMK_Base(object):
                         raise _BuildError("New rule produces %s, which is already an alias for %s" % (new_target.abs_path, self._aliases[new_target.abs_path]))
 
                     self.log.debug("Adding target %s <= %s", new_target.abs_path, fixed_requires)
+                    old_target = self._targets.get(new_target.abs_path)
+                    if old_target is not None:
+                        self._replaced_targets.append(old_target)
                     self._targets[new_target.abs_path] = new_target
                     self.scope.targets[new_target.orig_path] = new_target
                     new_rule.produces.append(new_target)
@@ -1629,7 +4420,7 @@ class EMK_Base(object):
         
         strings = []
         if rule._built:
-            for target, changed in rule._req_trace.items():
+            for target, changed in (rule._req_trace or {}).items():
                 path = target.abs_path
                 if changed:
                     strings.append(self._trace_changed_str(path))
@@ -1640,7 +4431,7 @@ class EMK_Base(object):
                     if self._trace_unchanged and target.rule not in visited:
                         to_visit.append(target)
         else:
-            for req, weak in rule._required_targets:
+            for req, weak in rule._all_required():
                 path = req.abs_path
                 if path is self.ALWAYS_BUILD:
                     strings.append(self._trace_changed_str(path))
@@ -1666,7 +4457,7 @@ class EMK_Base(object):
         if target._required_by:
             self.log.info("Rules that require %s:" % (target.abs_path))
             for r in target._required_by:
-                strings = [t.abs_path for t, weak in r._required_targets]
+                strings = [t.abs_path for t, weak in r._all_required()]
                 s = ", ".join([p.abs_path for p in r.produces])
                 if strings:
                     s = s + " <= " + ", ".join(strings)
@@ -1736,8 +4527,17 @@ class EMK(EMK_Base):
       default_has_changed   -- The default function to determine if a rule requirement or product has changed. If replaced, the replacement
                                function should take a single argument which is the absolute path of the thing to check to see if it has changed.
                                When this function is executing, emk.current_rule and emk.rule_cache() are available.
+                               emk.hash_has_changed may be used to detect changes based on file contents instead of modtimes.
       build_dir_placeholder -- The placeholder to use for emk.build_dir in paths passed to emk functions. The default value is "$:build:$".
       proj_dir_placeholder  -- The placeholder to use for emk.proj_dir in paths passed to emk functions. The default value is "$:proj:$".
+      file_symlinks         -- Whether or not files (as opposed to directories) may be symlinks. Paths are canonicalized by resolving the
+                               symlinks of each directory once and joining the file name; if this is True (the default), each file is
+                               also checked for being a symlink. Set it to False (or pass the "file_symlinks=no" option) if the source
+                               tree contains no file-level symlinks, to save a filesystem call for each new path.
+      immutable_dirs        -- A dict mapping directories (eg toolchain or SDK trees) to version stamps. Files in these directories (that are
+                               not produced by rules) are assumed not to change; instead of checking each file, emk records the stamp of the
+                               directory once per rule, and changing the stamp (eg when the toolchain is upgraded) invalidates all of the files
+                               in the directory at once. The directory paths should be absolute. The default value is an empty dict.
     
     Scoped read-only properties (apply only to the current scope):
       scope_name    -- The name of the current scope. May be one of ['global', 'project', 'subproj', 'rules].
@@ -1762,6 +4562,7 @@ class EMK(EMK_Base):
         self.Target = _Target
         self.Rule = _Rule
         self.Container = _Container
+        self.DirSnapshot = _DirSnapshot
 
     def _set_build_dir(self, dir):
         if self.scope.scope_type == "rules":
@@ -1778,12 +4579,20 @@ class EMK(EMK_Base):
     def _set_pre_modules(self, names):
         self.scope.pre_modules = names
 
+    def _set_file_symlinks(self, value):
+        self._realpath_cache.file_symlinks = bool(value)
+
+    def _set_immutable_dirs(self, dirs):
+        self._immutable_dirs = dirs
+
     cleaning = property(lambda self: self._cleaning)
     building = property(lambda self: self._building)
     
     emk_dir = property(lambda self: self._emk_dir)
     options = property(lambda self: self._options)
     explicit_targets = property(lambda self: self._explicit_targets)
+    file_symlinks = property(lambda self: self._realpath_cache.file_symlinks, _set_file_symlinks)
+    immutable_dirs = property(lambda self: self._immutable_dirs, _set_immutable_dirs)
     
     scope_name = property(lambda self: self.scope.scope_type)
     proj_dir = property(lambda self: self.scope.proj_dir)
@@ -1849,41 +4658,37 @@ class EMK(EMK_Base):
         self.log.info("Using %d %s", self._build_threads, ("thread" if self._build_threads == 1 else "threads"))
         
         path = os.path.realpath(path)
-        root_scope = _ScopeData(None, "global", path, _find_project_dir(path))
-        root_scope.module_paths.append(os.path.join(self._emk_dir, "modules"))
-        self._root_scope = root_scope
-        self._local.current_scope = root_scope
-        
-        # insert "clean" module
-        self.insert_module("clean", _Clean_Module(self.scope_name))
-        self.pre_modules.append("clean")
+        resident = self._config_records is not None # the graph has already been loaded by _load_resident()
+        if not resident:
+            self._start_run(path)
         
         self._time_lines = []
         self._build_phase = 1
         
         try:
-            self._load_config()
+            if not resident:
+                self._load_config()
+            
+            if self._changed_from is not None and not self.cleaning:
+                self._changed_paths = self._load_changed_paths(path)
             
             start_time = time.time()
             phase_start_time = start_time
-            self._handle_dir(path, first_dir=True)
+            if self._persist_graph and not resident and not self.cleaning and not self.traces and not self._ninja_mode and self._reuse_graph(path):
+                self._reused_graph = True
+                self.log.info("Nothing to build (the build graph for %s has not changed)", path)
+                self.log.info("Finished in %0.3f seconds" % (time.time() - start_time))
+                return
+            
+            if not resident:
+                self._handle_dir(path, first_dir=True)
 
             self._done_build = False
-            while ((self._have_unbuilt() or self._explicit_targets) and (self._added_rule or self._prebuild_funcs or self._postbuild_funcs)) or \
-              self._must_build or \
-              ((not self._done_build) and (self._auto_targets or self._prebuild_funcs or self._postbuild_funcs)):
-                self._run_prebuild_funcs()
-            
-                self._remove_artificial_targets()
-                self._fix_aliases()
-                self._fix_depends()
-                self._fix_weak_depends()
-                for rule in self._rules:
-                    self._fix_requires(rule)
-                self._fix_attached()
-                self._fix_auto_targets()
-                self._fix_requires_rule()
-                self._fix_rebuild_if_changed()
+            while self._prepared or self._want_phase():
+                if self._prepared:
+                    self._prepared = False # the first phase of a resident graph was prepared when it was loaded
+                elif not self._prepare_phase():
+                    continue
 
                 self._added_rule = False
             
@@ -1906,14 +4711,19 @@ class EMK(EMK_Base):
                         scope.recurse_dirs = set()
                     
                         self._local.current_scope = scope.parent
-                        for d in recurse_dirs:
-                            self._handle_dir(d)
+                        self._recurse_dirs(recurse_dirs)
+                
+                if self._deferred_dirs and not (self._added_rule or self._prebuild_funcs or self._postbuild_funcs) and \
+                  (self._have_unbuilt() or self._explicit_targets):
+                    # the target index did not lead to everything that is needed (eg it is out of date), so load the remaining directories
+                    self.log.debug("Loading all deferred directories")
+                    self._handle_deferred_dirs(list(self._deferred_dirs.keys()))
                     
         finally:
             self._write_scope_caches()
         
         unbuilt = set()
-        for path, target in self._targets.items():
+        for target in self._targets.values():
             if target._visited is True and not target._built:
                 unbuilt.add(target)
         
@@ -1921,7 +4731,7 @@ class EMK(EMK_Base):
         for target in unbuilt:
             if target.rule:
                 unbuilt_deps = []
-                for dep, weak in target.rule._required_targets:
+                for dep, weak in target.rule._all_required():
                     if (dep.rule or not weak) and (dep in unbuilt):
                         unbuilt_deps.append(dep.abs_path)
                 unbuilt_lines.append("%s depends on unbuilt %s" % (target.abs_path, unbuilt_deps))
@@ -1933,11 +4743,57 @@ class EMK(EMK_Base):
         if self._explicit_targets:
             raise _BuildError("No rule creates these explicitly specified targets:", self._explicit_targets)
         
+        if self._persist_graph and not self.cleaning:
+            self._save_graph(path)
+        if not self.cleaning:
+            if self._keep_target_index:
+                self._save_target_index()
+            self._save_dir_snapshots()
+        
         for line in self._time_lines:
             self.log.debug(line)
         diff = time.time() - start_time
         self.log.info("Finished in %0.3f seconds" % (diff))
     
+    def _start_run(self, path):
+        self._run_path = path
+        self._setup_root_scope(path)
+        
+        self._graph_args = self._build_args()
+        if self._persist_graph or self._ninja_mode == "export":
+            # the graph also depends on the emk code itself (modules are recorded when they are imported)
+            for p in (_module_path, _source_path(os.path.realpath(emk_client.__file__))):
+                self._note_graph_input(p)
+        self._lazy_dirs = self._lazy_dirs and bool(self._explicit_targets) and not self.cleaning
+    
+    def _want_phase(self):
+        # Returns True if there is work left for another build phase.
+        return ((self._have_unbuilt() or self._explicit_targets) and (self._added_rule or self._prebuild_funcs or self._postbuild_funcs)) or \
+          self._must_build or \
+          ((not self._done_build) and (self._auto_targets or self._prebuild_funcs or self._postbuild_funcs))
+    
+    def _prepare_phase(self):
+        # Run the prebuild functions, and fix up the graph for the next build phase. Returns False if directories were loaded
+        # lazily, so that the graph must be prepared again.
+        self._run_prebuild_funcs()
+    
+        self._fix_replaced_targets()
+        self._fix_aliases()
+        self._fix_depends()
+        self._fix_weak_depends()
+        self._fix_new_requires()
+        self._fix_attached()
+        self._fix_auto_targets()
+        self._fix_requires_rule()
+        self._fix_rebuild_if_changed()
+        
+        if self._lazy_dirs and self._load_needed_dirs():
+            # the new directories may have added rules and prebuild functions, so fix up the graph again before building
+            self._auto_targets.update([t.abs_path for t in self._fixed_auto_targets])
+            self._added_rule = True
+            return False
+        return True
+    
     def import_from(self, paths, name):
         """
         Import a Python module from a set of search directories.
@@ -2097,12 +4953,24 @@ class EMK(EMK_Base):
                          the build should be cleaned. The default value is False.
           has_changed -- The function to execute for this rule to determine if the dependencies (or "rebuild if changed" products)
                          have changed. The default value is emk.default_has_changed.
+          idempotent  -- If True, executing the rule again has no effect if its requirements and products have not changed (eg the
+                         rule only defines other rules, or only copies a file if the destination differs). Rules that are executed
+                         prevent the build graph from being reused (see the persist_graph option) unless they are idempotent.
+                         The default value is False.
+          command     -- A function that describes what the rule function does as command lines, so that the rule can be run
+                         by ninja when the build graph is exported (see 'emk :ninja'). It is called with the same arguments as the
+                         rule function, and must return None (the rule is run by calling back into emk), or a dict with the keys
+                         "commands" (a list of commands to run in order, each a list of arguments; an empty list means that the
+                         rule does nothing except mark its products virtual) and optionally "depfile" (the path of a make-style
+                         dependency file written by the commands) and "description". The default value is None.
         """
         stack = _format_stack(_filter_stack(traceback.extract_stack()[:-1]))
         cwd_safe = kwargs.get("cwd_safe", False)
         ex_safe = kwargs.get("ex_safe", False)
         has_changed = kwargs.get("has_changed", None)
-        self._rule(func, produces, requires, args, cwd_safe, ex_safe, has_changed, stack)
+        idempotent = kwargs.get("idempotent", False)
+        command = kwargs.get("command", None)
+        self._rule(func, produces, requires, args, cwd_safe, ex_safe, has_changed, stack, idempotent, command)
     
     def make_rule(self, produces, requires, *args, **kwargs):
         """
@@ -2133,13 +5001,25 @@ class EMK(EMK_Base):
                          the build should be cleaned. The default value is False.
           has_changed -- The function to execute for this rule to determine if the dependencies (or "rebuild if changed" products)
                          have changed. The default value is emk.default_has_changed.
+          idempotent  -- If True, executing the rule again has no effect if its requirements and products have not changed (eg the
+                         rule only defines other rules, or only copies a file if the destination differs). Rules that are executed
+                         prevent the build graph from being reused (see the persist_graph option) unless they are idempotent.
+                         The default value is False.
+          command     -- A function that describes what the rule function does as command lines, so that the rule can be run
+                         by ninja when the build graph is exported (see 'emk :ninja'). It is called with the same arguments as the
+                         rule function, and must return None (the rule is run by calling back into emk), or a dict with the keys
+                         "commands" (a list of commands to run in order, each a list of arguments; an empty list means that the
+                         rule does nothing except mark its products virtual) and optionally "depfile" (the path of a make-style
+                         dependency file written by the commands) and "description". The default value is None.
         """
         def decorate(func):
             stack = _format_decorator_stack(_filter_stack(traceback.extract_stack()[:-1]))
             cwd_safe = kwargs.get("cwd_safe", False)
             ex_safe = kwargs.get("ex_safe", False)
             has_changed = kwargs.get("has_changed", None)
-            self._rule(func, produces, requires, args, cwd_safe, ex_safe, has_changed, stack)
+            idempotent = kwargs.get("idempotent", False)
+            command = kwargs.get("command", None)
+            self._rule(func, produces, requires, args, cwd_safe, ex_safe, has_changed, stack, idempotent, command)
             return func
         return decorate
     
@@ -2165,6 +5045,9 @@ class EMK(EMK_Base):
         abspath = _make_target_abspath(target, self.scope)
         self.log.debug("Adding %s as dependencies of target %s", fixed_depends, abspath)
         with self._lock:
+            records = self._graph_records()
+            if records is not None:
+                records.depends.append((abspath, fixed_depends))
             if abspath in self._secondary_dependencies:
                 self._secondary_dependencies[abspath].extend(fixed_depends)
             else:
@@ -2194,6 +5077,9 @@ class EMK(EMK_Base):
         abspath = _make_target_abspath(target, self.scope)
         self.log.debug("Adding %s as weak dependencies of target %s", fixed_depends, abspath)
         with self._lock:
+            records = self._graph_records()
+            if records is not None:
+                records.weak_depends.append((abspath, fixed_depends))
             if abspath in self._weak_dependencies:
                 self._weak_dependencies[abspath].extend(fixed_depends)
             else:
@@ -2218,6 +5104,9 @@ class EMK(EMK_Base):
         abspath = _make_target_abspath(target, self.scope)
         self.log.debug("Attaching %s to target %s", fixed_depends, abspath)
         with self._lock:
+            records = self._graph_records()
+            if records is not None:
+                records.attached.append((abspath, fixed_depends))
             if abspath in self._attached_dependencies:
                 self._attached_dependencies[abspath].extend(fixed_depends)
             else:
@@ -2236,9 +5125,13 @@ class EMK(EMK_Base):
                      Project and build dir placeholders will be resolved according to the current scope.
         """
         with self._lock:
+            records = self._graph_records()
             for target in _flatten_gen(targets):
                 self.log.debug("Marking %s for automatic build", target)
-                self._auto_targets.add(_make_target_abspath(target, self.scope))
+                abspath = _make_target_abspath(target, self.scope)
+                self._auto_targets.add(abspath)
+                if records is not None:
+                    records.auto_targets.append(abspath)
     
     def alias(self, target, alias):
         """
@@ -2266,7 +5159,11 @@ class EMK(EMK_Base):
                 raise _BuildError("Duplicate alias %s" % (abs_alias), stack)
             
             self.log.debug("Adding alias %s for %s", abs_alias, abs_target)
+            records = self._graph_records()
+            if records is not None:
+                records.aliases.append((abs_alias, abs_target))
             self._aliases[abs_alias] = abs_target
+            self._unresolved_aliases.add(abs_alias)
             self._added_rule = True
     
     def require_rule(self, *paths):
@@ -2287,10 +5184,13 @@ class EMK(EMK_Base):
                    the scope dir. Project and build dir placeholders will be resolved based on each path.
         """
         with self._lock:
+            records = self._graph_records()
             for path in _flatten_gen(paths):
                 abs_path = _make_require_abspath(path, self.scope)
                 self.log.debug("Requiring %s to be built by an explicit rule", abs_path)
                 self._requires_rule.add(abs_path)
+                if records is not None:
+                    records.requires_rule.append(abs_path)
     
     def rebuild_if_changed(self, *paths):
         """
@@ -2305,10 +5205,13 @@ class EMK(EMK_Base):
                    relative to the scope dir. Project and build dir placeholders will be resolved based on each path.
         """
         with self._lock:
+            records = self._graph_records()
             for path in _flatten_gen(paths):
                 abs_path = _make_require_abspath(path, self.scope)
                 self.log.debug("Requiring %s to be rebuilt if it has changed", abs_path)
                 self._rebuild_if_changed.add(abs_path)
+                if records is not None:
+                    records.rebuild_if_changed.append(abs_path)
     
     def trace(self, *paths):
         """
@@ -2346,10 +5249,13 @@ class EMK(EMK_Base):
           paths -- The list of directories to visit. The paths may be absolute, or relative to the scope dir.
                    Project and build dir placeholders will be resolved according to the current scope.
         """
+        records = self._graph_records()
         for path in _flatten_gen(paths):
             abspath = _make_target_abspath(path, self.scope)
             self.log.debug("Adding recurse directory %s", abspath)
             self.scope.recurse_dirs.add(abspath)
+            if records is not None:
+                records.recursed.add(os.path.realpath(abspath))
     
     def subdir(self, *paths):
         """
@@ -2389,7 +5295,7 @@ class EMK(EMK_Base):
             
         self.scope._do_later_funcs.append(func)
     
-    def do_prebuild(self, func):
+    def do_prebuild(self, func, cwd_safe=False):
         """
         Specify a function to execute during the prebuild stage (see emk.run() for a description of the build stages).
         
@@ -2397,11 +5303,21 @@ class EMK(EMK_Base):
         actual building (rule execution) begins. If you specify a prebuild function during the prebuild stage, it will be
         executed after all of the currently pending prebuild functions have been executed.
         
+        Prebuild functions may be declared as cwd-safe. cwd-unsafe prebuild functions are executed by the main thread, with the
+        current working directory set to the scope directory. When more than one build thread is used, consecutive cwd-safe prebuild
+        functions of different scopes are executed in parallel (the functions of each scope are still executed in order, by a single
+        thread), and the working directory is not changed. A cwd-safe prebuild function must not depend on the current working
+        directory, and must synchronize any state that it shares with other scopes (eg module globals). Rules and prebuild/postbuild
+        functions that are created by cwd-safe prebuild functions are added to the build in the same order as if they had been run
+        one after another.
+        
         Arguments:
-          func -- The function to execute.
+          func     -- The function to execute.
+          cwd_safe -- If True, the function is considered to be cwd-safe (see above). The default value is False.
         """
+        task = getattr(self._local, "prebuild_task", None)
         with self._lock:
-            self._prebuild_funcs.append((self.scope, func))
+            (self._prebuild_funcs if task is None else task.prebuild_funcs).append((self.scope, func, cwd_safe))
     
     def do_postbuild(self, func):
         """
@@ -2414,8 +5330,9 @@ class EMK(EMK_Base):
         Arguments:
           func -- The function to execute.
         """
+        task = getattr(self._local, "prebuild_task", None)
         with self._lock:
-            self._postbuild_funcs.append((self.scope, func))
+            (self._postbuild_funcs if task is None else task.postbuild_funcs).append((self.scope, func))
     
     def mark_virtual(self, *paths):
         """
@@ -2460,7 +5377,10 @@ class EMK(EMK_Base):
             self.log.warning("Cannot mark anything as untouched when not in a rule")
             return
             
-        untouched_set = self.current_rule._untouched
+        rule = self.current_rule
+        if not rule._untouched:
+            rule._untouched = set()
+        untouched_set = rule._untouched
         for path in _flatten_gen(paths):
             abs_path = _make_target_abspath(path, self.scope)
             self.log.debug("Marking %s as untouched", abs_path)
@@ -2479,9 +5399,13 @@ class EMK(EMK_Base):
         Returns the cache dict for the given key (or an empty dict if there was currently no cache for that key).
         Returns None if called while not in rules scope.
         """
-        if self.scope._cache is None:
+        scope = self.scope
+        if scope.scope_type != "rules":
             return None
-        return self.scope._cache.setdefault("other", {}).setdefault(key, {})
+        with self._cache_lock:
+            self._load_scope_cache(scope)
+            scope._cache_touched = True
+            return scope._cache.setdefault(key, {})
     
     def rule_cache(self, key):
         """
@@ -2500,6 +5424,7 @@ class EMK(EMK_Base):
         """
         rule = self.current_rule
         if rule:
+            self._rule_cache_changed(rule)
             return rule._cache.setdefault(key, {})
         return None
     
@@ -2521,7 +5446,57 @@ class EMK(EMK_Base):
         Returns the path in absolute form, relative to the scope dir.
         """
         return _make_target_abspath(path, self.scope)
-    
+
+    def stat(self, path):
+        """
+        Get the file metadata for a path from the build-wide stat cache.
+
+        emk caches the result of os.stat() for each path that is checked during the build (including paths that do not exist),
+        so that files that are checked by many rules (eg header files) are only examined once. The products of a rule are
+        removed from the cache after the rule has been executed.
+
+        Arguments:
+          path -- The path to get the metadata for. The path may be absolute, or relative to the scope dir.
+                  Project and build dir placeholders will be resolved according to the current scope.
+
+        Returns the os.stat() result for the path, or None if the path does not exist.
+        """
+        return self._stat_cache.stat(_make_target_abspath(path, self.scope))
+
+    def invalidate_stat(self, *paths):
+        """
+        Remove the given paths from the build-wide stat cache (see emk.stat()).
+
+        If a rule or prebuild/postbuild function creates or modifies files that are not products of the rule,
+        it should call this method so that later change checks see the new file metadata.
+
+        Arguments:
+          paths -- The list of paths to invalidate. The paths may be absolute, or relative to the scope dir.
+                   Project and build dir placeholders will be resolved according to the current scope.
+        """
+        self._stat_cache.invalidate([_make_target_abspath(path, self.scope) for path in _flatten_gen(paths)])
+
+    def dir_snapshot(self, path=None):
+        """
+        Get a snapshot of the regular files in a directory (an emk.DirSnapshot instance, with the file names grouped by extension).
+
+        Each directory is listed once per build, and the snapshot is shared by all callers (eg the c, asm and java modules use it
+        to autodetect source files), so files that are created later in the build are not included. The listing is stored in the
+        build database, and is reused by the next build if the directory has not been modified since then.
+
+        Arguments:
+          path -- The directory to get the snapshot of; may be absolute, or relative to the scope dir. The default is the scope dir.
+        """
+        if path is None:
+            path = self.scope_dir
+        else:
+            path = _make_target_abspath(path, self.scope)
+        self._note_graph_input(path, local=True)
+        snapshot = self._dir_snapshots.get(path)
+        if snapshot is None:
+            snapshot = self._dir_snapshots.setdefault(path, self._take_dir_snapshot(path))
+        return snapshot
+
     def fix_stack(self, stack):
         """
         Filter and format a stack trace to remove emk or threading frames from the start.
@@ -2580,6 +5555,348 @@ def setup(args=[]):
     builtins.emk = emk
     return emk
 
+def _log_build_error(emk, e):
+    lines = ['\n' + _style_tag('important') + "Build error:" + _style_tag('') + " %s" % (e)]
+    if e.extra_info:
+        lines.extend(["    " + line.replace('\n', "\n    ") for line in e.extra_info])
+    emk.log.error('\n'.join(lines), extra={'adorn':False})
+    emk._print_bad_rules()
+
+def _watch_relevant(state, path, listing):
+    # Returns True if the given changed path may affect the build, based on the state from the previous build.
+    if path is None:
+        return True
+    dirs, files, listing_dirs, build_dirs = state
+    for b in build_dirs:
+        if path == b or path.startswith(b + os.sep):
+            return False
+    if path in files:
+        return True
+    return listing and os.path.dirname(path) in listing_dirs
+
+class _ResidentGraph(object):
+    """
+    A build graph that is kept in memory between builds (by the build server, and in watch mode).
+    
+    The config and rules files are loaded, and the first build phase is prepared, once; each build then runs in a forked
+    process, so that it cannot modify the graph (or the state of the modules). When files change, only the directories
+    whose rules may have changed are loaded again (see EMK_Base._reload_dirs()): the directories whose rules files, imported
+    files or listings have changed, the directories that contain a changed file that is not a rule product, and the directories
+    whose scope caches were written by the last build, along with the directories that recursed into any of them. The whole
+    graph is loaded again if any other file that it was loaded from (eg a config file or a module) changes, or if change
+    events were lost.
+    
+    The rules that were up to date at the end of the last build are trusted without checking their dependencies, unless
+    they are affected by the paths that have changed since (as with the changed_from option); this is only done if all of
+    the dependencies of the last build were watched during the whole build.
+    """
+    def __init__(self, args, path, stat_cache):
+        self.args = list(args)
+        self.path = os.path.realpath(path)
+        self.stat_cache = stat_cache
+        self.emk = None # the emk instance of the graph; kept after a failed load for logging
+        self.loaded = False
+        self.level = logging.INFO
+        self.changes = [] # (path, listing) tuples that have not been applied to the graph yet
+        self.changed = set() # paths that have changed since the last build started
+        self.untrusted = set() # products of the rules that are new or have changed since the last build
+        self.trusted = None # products of the rules that were up to date at the end of the last build, or None
+        self.written = set() # directories whose scope caches were written by the last build
+    
+    def note_changes(self, events):
+        for path, listing in events:
+            if path is None:
+                self.trusted = None
+            else:
+                self.changed.add(path)
+        self.changes.extend(events)
+    
+    def attach(self, stream):
+        # make the emk instance of the graph the current one, logging to the given stream
+        builtins.emk = self.emk
+        self.emk._log_handler.stream = stream
+        self.emk.log.addHandler(self.emk._log_handler)
+        self.emk.log.setLevel(self.level)
+    
+    def detach(self):
+        if self.emk is not None:
+            self.emk.log.removeHandler(self.emk._log_handler)
+    
+    def load(self, stream):
+        # Apply the changes to the graph (loading it again if needed), logging to the given stream. Returns False if the rules
+        # could not be loaded (the error has been logged); the graph is then loaded again by the next build.
+        changes, written = self.changes, self.written
+        self.changes = []
+        self.written = set()
+        try:
+            if self.loaded:
+                self.attach(stream)
+                dirs = self.emk._dirs_to_reload(changes)
+                if dirs is not None:
+                    self.untrusted.update(self.emk._reload_dirs(dirs | written))
+                    return True
+                self.emk.log.info("Loading all directories again")
+            
+            self.loaded = False
+            self.detach()
+            os.chdir(self.path)
+            self.emk = setup(self.args)
+            self.level = self.emk.log.level
+            self.attach(stream)
+            self.emk._watching = True
+            self.emk._stat_cache = self.stat_cache
+            self.trusted = None
+            self.untrusted = set()
+            if not self.emk.cleaning:
+                self.emk._load_resident(self.path)
+            self.loaded = True
+            return True
+        except _BuildError as e:
+            self.loaded = False
+            _log_build_error(self.emk, e)
+        except Exception:
+            self.loaded = False
+            if self.emk is None:
+                raise
+            self.emk.log.error("Unhandled exception:\n%s", traceback.format_exc(), extra={'adorn':False})
+        except KeyboardInterrupt:
+            self.loaded = False
+            raise
+        return False
+    
+    def build(self, watched, poll=None, out=None):
+        # Build the loaded graph in a forked process, and return the report of the build (see EMK_Base._build_report()).
+        # The given directories have been watched since the last build. While the build is running, poll() is called repeatedly
+        # (if given; it may block for a short time), and the build is cancelled if it returns True. If out is given (a
+        # _ServerOutput), the build is cancelled when the build server client disconnects.
+        emk = self.emk
+        for db in emk._dbs.values():
+            db.close() # the connections cannot be shared with the forked process
+        trusted = self.trusted
+        changed = self.changed | self.untrusted
+        self.changed = set()
+        self.untrusted = set()
+        
+        report_r, report_w = os.pipe()
+        cancel_r, cancel_w = os.pipe() if poll else (None, None)
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                os.close(report_r)
+                if cancel_w is not None:
+                    os.close(cancel_w)
+                code = self._run_child(report_w, cancel_r, out, trusted, changed)
+            finally:
+                os._exit(code)
+        
+        os.close(report_w)
+        if cancel_r is not None:
+            os.close(cancel_r)
+        chunks = []
+        try:
+            while True:
+                if poll is not None and not select.select([report_r], [], [], 0)[0]:
+                    if poll() and cancel_w is not None:
+                        os.write(cancel_w, b"c")
+                        os.close(cancel_w)
+                        cancel_w = None
+                    continue
+                data = os.read(report_r, 65536)
+                if not data:
+                    break
+                chunks.append(data)
+        finally:
+            os.close(report_r)
+            if cancel_w is not None:
+                os.close(cancel_w)
+            os.waitpid(pid, 0)
+        
+        if chunks:
+            report = pickle.loads(b"".join(chunks))
+        else:
+            emk.log.error("The build process exited unexpectedly")
+            self.loaded = False
+            report = emk._build_report(1)
+        self.stat_cache.update(report["stats"])
+        self.written = report["written"]
+        if emk.cleaning:
+            self.loaded = False
+        self.trusted = report["checked"] if report["state"][0] <= watched and self.loaded else None
+        return report
+    
+    def _run_child(self, report_w, cancel_r, out, trusted, changed):
+        # Runs the build in the forked process, and writes the report to the parent process. Returns the exit code.
+        emk = self.emk
+        def monitor_cancel():
+            if os.read(cancel_r, 1):
+                emk._cancel_build()
+        def monitor_client():
+            # the connection is closed if the client is interrupted
+            try:
+                data = out.conn.recv(1)
+            except socket.error:
+                data = b""
+            if not data:
+                out.disconnected = True
+                emk._cancel_build()
+        for func, enabled in ((monitor_cancel, cancel_r is not None), (monitor_client, out is not None)):
+            if enabled:
+                monitor_thread = threading.Thread(target=func)
+                monitor_thread.daemon = True
+                monitor_thread.start()
+        
+        if trusted is not None and emk._changed_from is None:
+            emk._changed_paths = changed
+            emk._trusted_rules = trusted
+        code = 1
+        try:
+            emk.run(self.path)
+            code = 0
+        except _BuildError as e:
+            if not emk._cancelled:
+                _log_build_error(emk, e)
+        except KeyboardInterrupt:
+            emk.log.error("\nemk: Interrupted", extra={'adorn':False})
+            emk._print_bad_rules()
+        except Exception:
+            emk.log.error("Unhandled exception:\n%s", traceback.format_exc(), extra={'adorn':False})
+        finally:
+            emk._print_traces()
+        
+        data = pickle.dumps(emk._build_report(code), pickle.HIGHEST_PROTOCOL)
+        while data:
+            data = data[os.write(report_w, data):]
+        sys.stdout.flush()
+        sys.stderr.flush()
+        return code
+
+def _watch(args):
+    """
+    Build, then wait for changes to the files that the build depends on and build again (until interrupted).
+    
+    The build graph is kept in memory between builds (see _ResidentGraph): the changed paths only cause the directories whose
+    rules may have changed to be loaded again, and the rules that are not affected by them are not checked again. Each build
+    runs in a forked process; if os.fork() is not available, each build uses a new emk instance instead (so all rules files
+    are reloaded). The file metadata cache is kept between builds; only the paths that have been reported as changed are
+    checked again. Changes are debounced, and a build is cancelled (after the rules that are currently executing have
+    finished) as soon as a file that it depends on changes.
+    """
+    path = os.getcwd()
+    watcher = _make_watcher()
+    stat_cache = _StatCache()
+    graph = _ResidentGraph(args, path, stat_cache) if hasattr(os, "fork") else None
+    state = None
+    watched = set() # the directories that have been watched since the last build
+    emk = None
+    changed = []
+    in_child = False
+    
+    def relevant(events):
+        return [e[0] for e in events if state and _watch_relevant(state, e[0], e[1])]
+    
+    def apply_changes(events):
+        if [e for e in events if e[0] is None]:
+            stat_cache.clear()
+        stat_cache.invalidate([e[0] for e in events if e[0]])
+        if graph is not None:
+            graph.note_changes(events)
+        return relevant(events)
+    
+    try:
+        while True:
+            os.chdir(path)
+            if changed and emk:
+                names = sorted(set([p for p in changed if p]))
+                emk.log.info("Rebuilding since %d %s changed: %s", len(names), "path" if len(names) == 1 else "paths",
+                    ", ".join(names[:5]) + (", ..." if len(names) > 5 else ""))
+            
+            # monitor changes during the build, and cancel it if it becomes obsolete
+            events = []
+            if graph is not None:
+                if graph.load(sys.stdout):
+                    def poll():
+                        new_events = watcher.read(0.1)
+                        events.extend(new_events)
+                        return bool(relevant(new_events))
+                    in_child = True
+                    report = graph.build(watched, poll=poll)
+                    in_child = False
+                else:
+                    report = graph.emk._build_report(1)
+                emk = graph.emk
+            else:
+                if emk:
+                    emk.log.removeHandler(emk._log_handler)
+                emk = setup(args)
+                emk._watching = True
+                emk._stat_cache = stat_cache
+                stop = threading.Event()
+                def monitor():
+                    while not stop.is_set():
+                        new_events = watcher.read(0.1)
+                        events.extend(new_events)
+                        if relevant(new_events):
+                            emk._cancel_build()
+                monitor_thread = threading.Thread(target=monitor)
+                monitor_thread.daemon = True
+                monitor_thread.start()
+                
+                code = 1
+                try:
+                    emk.run(path)
+                    code = 0
+                except _BuildError as e:
+                    if not emk._cancelled:
+                        _log_build_error(emk, e)
+                finally:
+                    stop.set()
+                    monitor_thread.join()
+                report = emk._build_report(code)
+            if report["cancelled"]:
+                emk.log.info("Build cancelled since its dependencies changed")
+            try:
+                delay = float(emk.options.get("watch_delay", "0.2"))
+            except ValueError:
+                emk.log.error("Invalid watch_delay option '%s'", emk.options.get("watch_delay"))
+                delay = 0.2
+            
+            # update the watched directories; if the build failed, the new state may be incomplete so keep the old state as well
+            new_state = report["state"]
+            if state and (report["cancelled"] or report["failed"]):
+                new_state = tuple([old | new for old, new in zip(state, new_state)])
+            state = new_state
+            
+            # metadata for files in directories that were not watched during the whole build may be out of date
+            if [e for e in events if e[0] is None]:
+                stat_cache.clear()
+            else:
+                stat_cache.keep_dirs(watched)
+            watched = state[0] | set([path])
+            watcher.set_dirs(watched)
+            changed = apply_changes(events)
+            
+            if not changed:
+                emk.log.info("Watching %d %s for changes", len(state[0]), "directory" if len(state[0]) == 1 else "directories")
+            while not changed:
+                changed = apply_changes(watcher.read(1.0))
+            
+            # wait until there are no more changes (eg while an editor is saving several files)
+            while True:
+                events = watcher.read(delay)
+                if not events:
+                    break
+                changed.extend(apply_changes(events))
+    except KeyboardInterrupt:
+        # a build that runs in a forked process reports the interruption itself
+        if emk and not in_child:
+            emk.log.error("\nemk: Interrupted", extra={'adorn':False})
+            emk._print_bad_rules()
+        return 1
+    finally:
+        watcher.close()
+
 def main(args):
     """
     Execute the emk build process in the current directory.
@@ -2623,11 +5940,137 @@ def main(args):
                  current directory.
       trace_unchanged -- If set to "yes", the tracer will trace through targets
                          that were not modified as well. The default value is "no".
+      has_changed     -- The default method used to determine if a rule dependency
+                         has changed. May be one of ["modtime", "hash"]. If set to
+                         "hash", emk.default_has_changed is set to
+                         emk.hash_has_changed, so files are only considered changed
+                         if their contents differ. The default value is "modtime".
+      persist_graph   -- If set to "yes", the resolved build graph is stored in the
+                         build database at the end of each successful build, along
+                         with the state of everything it was created from (emk and
+                         module files, config and rules files, directory listings,
+                         options and environment variables). If nothing has changed
+                         since a build that did not need to execute any rules, emk
+                         does not load any rules files and finishes immediately.
+                         The default value is "no".
+      file_symlinks   -- If set to "no", emk trusts that no files in the source tree
+                         are symlinks (directories may still be symlinks), so each path
+                         is canonicalized by joining the file name onto the cached real
+                         path of its directory without checking the file itself. Sets
+                         emk.file_symlinks. The default value is "yes".
+      changed_from    -- The list of paths that have changed since the last build.
+                         May be "git:<rev>" (the files that differ from the given git
+                         revision, plus untracked files), "stdin" (one path per line),
+                         or a comma-separated list of paths. Only the rules that depend
+                         (directly or indirectly) on those paths are checked; all other
+                         rules keep their state from the last build. By default, every
+                         dependency is checked.
+      lazy_dirs       -- If set to "yes" and explicit targets are given, directories that
+                         are recursed into are only loaded once the build needs one of
+                         their targets (according to the target index that emk stores at
+                         the end of each build with this option set; the first such build
+                         loads every directory). The default value is "no".
+
+    Commands (the command must be the first argument that is not an option, prefixed with ':', eg
+    'emk :watch'; all other arguments that are not options are target names):
+     :cache-export [archive] -- Write the build database and the build dirs of the project
+                                that contains the current directory into a gzipped tar archive
+                                (default "emk_cache.tar.gz"). All cached paths are stored relative
+                                to the project dir, so the archive can be imported into a copy of the
+                                project at a different path.
+     :cache-import [archive] -- Extract an archive created by cache-export into the project that
+                                contains the current directory.
+     :cache-server [dir]     -- Run the reference server for utils.RemoteArtifactCache, storing the
+                                artifacts in the given directory (default "~/.emk/remote-artifacts").
+                                The server listens on the address given by the cache_host and
+                                cache_port options (default 127.0.0.1 and 8765). It does not limit
+                                the size of the stored artifacts.
+     :watch [targets...]     -- Build, then watch the directories and files that the build depends on
+                                and build again whenever they change (until interrupted). Changes are
+                                debounced: the build starts once nothing has changed for watch_delay
+                                seconds (default 0.2). A build whose dependencies change while it is
+                                running is cancelled and restarted. The build graph is kept in
+                                memory, so only the rules scopes and rules affected by the changed
+                                files are loaded and checked again. Uses inotify on Linux; other
+                                platforms poll the watched directories.
+     :server [stop]          -- Run a resident build server for the project that contains the current
+                                directory (or stop the running server). While the server is running,
+                                the emk script sends builds in that project to the server, which runs
+                                them in the client's directory and environment and streams the log
+                                back. The server keeps the build graph in memory and reloads only
+                                the rules scopes whose inputs changed; each build runs in a forked
+                                copy of the graph. It watches the files that the builds depend on,
+                                so a build that had nothing to do is answered immediately until one
+                                of those files changes. Pass the server=no option to build without
+                                the server. Requires Unix domain sockets.
+     :ninja [targets...]     -- Build, then write the resolved build graph into build.ninja in the
+                                current directory, so that ninja can run the build. Rules that can
+                                describe their command lines (eg compiling and linking with gcc or
+                                clang) are run by ninja directly; other rules call back into emk
+                                ('emk :ninja-run', one at a time). build.ninja is regenerated by ninja
+                                when the emk files, modules or directory listings that the graph was
+                                created from change.
+     :ninja-run [targets...] -- Used by build.ninja to build targets whose rules are Python functions.
+                                The rules that ninja runs itself are assumed to be up to date.
+     :ninja-listings         -- Used by build.ninja to check whether the listings of the directories
+                                that the graph was created from have changed.
+     :query <kind> <targets> -- Answer a query about the build graph that was persisted (see the
+                                persist_graph option) by a build in the current directory with the
+                                same options (or else by the latest build in the current directory
+                                or one of its parents), without building anything. The kind may be
+                                "deps" (the requirements of the targets, transitively), "rdeps" (the
+                                targets that depend on the given targets, transitively), "path" (a
+                                shortest dependency path from the first target to the second) or
+                                "producers" (the rules that produce the targets). The depth option
+                                limits how many levels are followed; weak=no ignores weak
+                                dependencies (eg header files); format may be "lines" (the default),
+                                "json" or "tree". Header files only appear in the graph once another
+                                build has run after they were found (eg after a clean build).
     """
     emk = None
     try:
+        try:
+            command, args = emk_client.split_command(args)
+        except ValueError as e:
+            print("emk: %s" % (e), file=sys.stderr)
+            return 1
+        
+        if command == "watch":
+            return _watch(args)
+        
         emk = setup(args)
-        emk.run(os.getcwd())
+        if command == "cache-export":
+            emk._cache_export(os.getcwd())
+        elif command == "cache-import":
+            emk._cache_import(os.getcwd())
+        elif command == "cache-server":
+            emk._cache_server()
+        elif command == "server":
+            if "stop" in emk._explicit_targets:
+                if not emk_client.stop(os.getcwd()):
+                    raise _BuildError("No build server is running for %s" % (emk_client.find_project_dir(os.path.realpath(os.getcwd()))))
+            else:
+                emk._serve(os.getcwd())
+        elif command == "query":
+            emk._query(os.getcwd(), args)
+        elif command == "ninja":
+            if emk.cleaning:
+                raise _BuildError("Cannot export the build graph when cleaning")
+            path = os.getcwd()
+            emk._ninja_mode = "export"
+            emk.run(path)
+            emk._write_ninja(os.path.realpath(path), args)
+        elif command == "ninja-listings":
+            stamp = emk._options.get("ninja_stamp")
+            if not stamp:
+                raise _BuildError("No listings stamp given (ninja_stamp option)")
+            _update_ninja_listings(stamp)
+        elif command == "ninja-run":
+            emk._ninja_mode = "run"
+            emk.run(os.getcwd())
+            emk._touch_ninja_stamp()
+        else:
+            emk.run(os.getcwd())
         return 0
     except KeyboardInterrupt:
         if emk:
@@ -2635,11 +6078,7 @@ def main(args):
             emk._print_bad_rules()
         return 1
     except _BuildError as e:
-        lines = ['\n' + _style_tag('important') + "Build error:" + _style_tag('') + " %s" % (e)]
-        if e.extra_info:
-            lines.extend(["    " + line.replace('\n', "\n    ") for line in e.extra_info])
-        emk.log.error('\n'.join(lines), extra={'adorn':False})
-        emk._print_bad_rules()
+        _log_build_error(emk, e)
         return 1
     finally:
         if emk:
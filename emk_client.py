@@ -0,0 +1,193 @@
+"""
+Thin client for the resident emk build server (see 'emk server').
+
+This module is imported by the emk script before emk.py, so it must stay small and fast to import.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import errno
+import stat
+import socket
+import struct
+import tempfile
+import hashlib
+import json
+
+_frame_header = struct.Struct(">cI")
+
+# the commands that may be given as the first argument that is not an option, prefixed with command_prefix (eg ":watch"; see emk.main());
+# they always run in the emk process, and are never sent to the build server. The prefix keeps every other argument a target name.
+command_prefix = ":"
+commands = ("cache-export", "cache-import", "cache-server", "watch", "server", "ninja", "ninja-run", "ninja-listings", "query")
+
+def split_command(args):
+    """
+    Returns (command, args without the command). The command (without the prefix) is None if the first argument that is not an option
+    does not start with the command prefix. Raises ValueError if the argument has the prefix but is not a known command.
+    """
+    for i, arg in enumerate(args):
+        if '=' not in arg:
+            if arg.startswith(command_prefix):
+                command = arg[len(command_prefix):]
+                if command not in commands:
+                    raise ValueError("Unknown command %s" % (arg))
+                return command, args[:i] + args[i+1:]
+            break
+    return None, args
+
+def find_project_dir(path):
+    """
+    Returns the closest ancestor of the given directory that contains an emk_project.py file,
+    or the root directory if there is no project file.
+    """
+    d = path
+    prev = None
+    while d != prev:
+        if os.path.isfile(os.path.join(d, "emk_project.py")):
+            return d
+        prev = d
+        d, tail = os.path.split(d)
+    return d
+
+def socket_dir():
+    """
+    Returns the directory that holds the build server sockets of the current user ($XDG_RUNTIME_DIR/emk, or emk-<uid> in the
+    temp directory), creating it if necessary. Raises OSError if the directory is not owned by the current user, or if
+    other users have access to it.
+    """
+    uid = os.getuid()
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        d = os.path.join(runtime_dir, "emk")
+    else:
+        d = os.path.join(tempfile.gettempdir(), "emk-%d" % (uid))
+    try:
+        os.mkdir(d, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    st = os.lstat(d)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != uid or st.st_mode & 0o077:
+        raise OSError(errno.EACCES, "Build server socket directory is not private to the current user", d)
+    return d
+
+def socket_path(path):
+    """
+    Returns the path of the Unix socket used by the build server for the project that contains the given directory.
+    Raises OSError if the socket directory is not private (see socket_dir()).
+    """
+    proj_dir = find_project_dir(os.path.realpath(path))
+    return os.path.join(socket_dir(), "%s.sock" % (hashlib.md5(proj_dir.encode("utf-8")).hexdigest()[:16]))
+
+def build_env(environ):
+    """
+    Returns the environment that is sent to the build server (all of the given environment, as a dict of name -> value);
+    the server runs the build in exactly that environment.
+    """
+    return dict(environ)
+
+def write_frame(sock, kind, data):
+    """
+    Send a frame (a one-byte kind and the data) over the given socket.
+    """
+    sock.sendall(_frame_header.pack(kind, len(data)) + data)
+
+def _recv_exact(sock, size):
+    chunks = []
+    while size:
+        data = sock.recv(size)
+        if not data:
+            return None
+        chunks.append(data)
+        size -= len(data)
+    return b"".join(chunks)
+
+def read_frame(sock):
+    """
+    Read a frame from the given socket. Returns (kind, data), or (None, None) if the connection was closed.
+    """
+    header = _recv_exact(sock, _frame_header.size)
+    if header is None:
+        return None, None
+    kind, size = _frame_header.unpack(header)
+    data = _recv_exact(sock, size) if size else b""
+    if data is None:
+        return None, None
+    return kind, data
+
+def _connect(path):
+    # only connect to a server that is run by the current user
+    try:
+        sock_path = socket_path(path)
+        st = os.lstat(sock_path)
+    except OSError:
+        return None
+    if not stat.S_ISSOCK(st.st_mode) or st.st_uid != os.getuid():
+        return None
+    
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(sock_path)
+    except socket.error:
+        sock.close()
+        return None
+    return sock
+
+def request(sock, req):
+    """
+    Send a request to the build server, and copy the output to stdout until the server sends the exit code.
+    Returns the exit code.
+    """
+    write_frame(sock, b"r", json.dumps(req).encode("utf-8"))
+    out = getattr(sys.stdout, "buffer", sys.stdout)
+    while True:
+        kind, data = read_frame(sock)
+        if kind is None:
+            print("emk: Lost connection to the build server", file=sys.stderr)
+            return 1
+        if kind == b"o":
+            out.write(data)
+            out.flush()
+        elif kind == b"x":
+            return int(data)
+
+def run(args):
+    """
+    Run the emk build through the build server for the current project, if there is one.
+
+    Returns the exit code, or None if the build could not be sent to a server (ie, emk should build in this process).
+    """
+    if not hasattr(socket, "AF_UNIX") or "server=no" in args or "changed_from=stdin" in args:
+        return None
+    try:
+        if split_command(args)[0] is not None:
+            return None
+    except ValueError:
+        return None
+
+    cwd = os.getcwd()
+    sock = _connect(cwd)
+    if sock is None:
+        return None
+    try:
+        return request(sock, {"cwd": cwd, "args": args, "env": build_env(os.environ)})
+    except KeyboardInterrupt:
+        print("\nemk: Interrupted", file=sys.stderr)
+        return 1
+    finally:
+        sock.close()
+
+def stop(path):
+    """
+    Stop the build server for the project that contains the given directory. Returns True if a server was stopped.
+    """
+    sock = _connect(path)
+    if sock is None:
+        return False
+    try:
+        request(sock, {"command": "stop"})
+    finally:
+        sock.close()
+    return True
@@ -1,6 +1,5 @@
 import os
 import logging
-import shlex
 import re
 import sys
 import traceback
@@ -46,7 +45,7 @@ class _GccAssembler(object):
         Returns a list of paths (strings) of all the extra dependencies.
         """
         cache = emk.scope_cache(path)
-        return cache.get("secondary_deps", [])
+        return utils.intern_paths(cache.get("secondary_deps", []))
     
     def depfile_args(self, dep_file):
         """
@@ -65,18 +64,18 @@ class _GccAssembler(object):
         utils.call(args, print_stderr=False)
         
         try:
-            with open(dep_file, "r") as f:
-                data = f.read()
-                data = data.replace("\\\n", "")
-                items = shlex.split(data)
-                unique_items = [emk.abspath(item) for item in (set(items[2:]) - set([""]))]
-                # call has_changed to set up rule cache for future builds.
-                for item in unique_items:
-                    emk.current_rule.has_changed(item)
-                cache = emk.scope_cache(dest)
-                cache["secondary_deps"] = unique_items
+            # the first prerequisite is the source file
+            deps = utils.read_depfile(dep_file)[1:]
         except IOError:
             log.error("Failed to open depfile %s", dep_file)
+            return
+        
+        # call has_changed to set up rule cache for future builds.
+        has_changed = emk.current_rule.has_changed
+        for item in deps:
+            has_changed(item)
+        cache = emk.scope_cache(dest)
+        cache["secondary_deps"] = deps
 
     def obj_ext(self):
         """
@@ -84,7 +83,7 @@ class _GccAssembler(object):
         """
         return ".o"
 
-class Module(object):
+class Module(emk.Container):
     """
     emk module for assembling code. Depends on the link module (and utils).
     
@@ -137,21 +136,11 @@ class Module(object):
         if parent:
             self.assembler = parent.assembler
             
-            self.include_dirs = list(parent.include_dirs)
-            self.defines = parent.defines.copy()
-            self.flags = list(parent.flags)
-            
-            self.source_files = list(parent.source_files)
-
-            self.exts = list(parent.exts)
+            # the list and dict properties are copied on first access (see emk.Container.inherit())
+            self.inherit(parent, "include_dirs", "defines", "flags", "source_files", "exts", "excludes", "non_lib_src", "non_exe_src", "obj_funcs")
 
             self.autodetect = parent.autodetect
             self.autodetect_from_targets = parent.autodetect_from_targets
-            self.excludes = list(parent.excludes)
-            self.non_lib_src = list(parent.non_lib_src)
-            self.non_exe_src = list(parent.non_exe_src)
-            
-            self.obj_funcs = list(parent.obj_funcs)
 
             self.unique_names = parent.unique_names
         else:
@@ -192,35 +181,37 @@ class Module(object):
         if emk.cleaning:
             return
         
-        emk.do_prebuild(self._prebuild)
+        emk.do_prebuild(self._prebuild, cwd_safe=True)
         if self.unique_names and self.link:
             self.link.unique_names = True
     
     def _prebuild(self):
         sources = set()
         
-        self._non_exe_src = set(self.non_exe_src)
-        self._non_lib_src = set(self.non_lib_src)
+        # read-only accesses use peek() so that properties which are not modified in this scope are not copied
+        self._non_exe_src = set(self.peek("non_exe_src"))
+        self._non_lib_src = set(self.peek("non_lib_src"))
+        exts = self.peek("exts")
         
         if self.autodetect:
             if self.autodetect_from_targets:
-                target_files = [t for t in emk.local_targets.keys() if self._matches_exts(t, self.exts)]
+                target_files = [t for t in emk.local_targets.keys() if self._matches_exts(t, exts)]
                 if target_files:
                     log.debug("Detected generated asm files: %s", target_files)
                     self.source_files.extend(target_files)
                     
-            files = set(self.source_files)
-            files.update([f for f in os.listdir(emk.scope_dir) if os.path.isfile(f)])
-            for file_path in files:
-                if self._matches_exts(file_path, self.exts):
-                    self.source_files.append(file_path)
+            files = set(emk.dir_snapshot().with_exts(exts))
+            files.update([f for f in self.peek("source_files") if self._matches_exts(f, exts)])
+            if files:
+                self.source_files.extend(sorted(files))
         
-        for f in self.source_files:
-            if f in self.excludes:
+        excludes = self.peek("excludes")
+        for f in self.peek("source_files"):
+            if f in excludes:
                 continue
             sources.add(f)
         
-        args = (self.include_dirs, self.defines, self.flags)
+        args = (self.peek("include_dirs"), self.peek("defines"), self.peek("flags"))
         
         objs = {}
         for src in sources:
@@ -1,8 +1,8 @@
 import os
 import logging
-import shlex
 import re
 import sys
+import shutil
 import traceback
 
 log = logging.getLogger("emk.c")
@@ -11,6 +11,44 @@ utils = emk.module("utils")
 
 fix_path_regex = re.compile(r'[\W]+')
 
+def _find_executable(exe):
+    # Returns the path of the given executable (searched for in the PATH), or None if it cannot be found.
+    # Uses shutil.which() where it is available (Python 3.3+); distutils.spawn.find_executable() is deprecated.
+    which = getattr(shutil, "which", None)
+    if which:
+        return which(exe)
+    if os.path.dirname(exe):
+        return exe if os.path.isfile(exe) and os.access(exe, os.X_OK) else None
+    exts = [""]
+    if sys.platform == "win32" and not os.path.splitext(exe)[1]:
+        exts = os.environ.get("PATHEXT", ".EXE").split(os.pathsep)
+    for d in os.environ.get("PATH", os.defpath).split(os.pathsep):
+        for ext in exts:
+            path = os.path.join(d, exe + ext)
+            if os.path.isfile(path) and os.access(path, os.X_OK):
+                return path
+    return None
+
+_prefix_map_options = ("-ffile-prefix-map", "-fdebug-prefix-map", "-fmacro-prefix-map")
+
+def _key_flags(flags):
+    # Returns the compiler flags in the form used in artifact cache keys: prefix map flags are split into
+    # (option, old prefix, new prefix), so that an old prefix in the project dir is made relative like other paths.
+    result = []
+    for f in flags:
+        option, sep, value = f.partition("=")
+        if option in _prefix_map_options and "=" in value:
+            result.append((option,) + tuple(value.split("=", 1)))
+        else:
+            result.append(f)
+    return result
+
+def _remaps_paths(flags):
+    # Returns True if the given compiler flags remap the absolute source paths that would otherwise be embedded
+    # in object files (in the debug info, and in __FILE__).
+    options = set([f.partition("=")[0] for f in flags])
+    return "-ffile-prefix-map" in options or ("-fdebug-prefix-map" in options and "-fmacro-prefix-map" in options)
+
 class _GccCompiler(object):
     """
     Compiler class for using gcc/g++ to compile C/C++ respectively.
@@ -19,7 +57,9 @@ class _GccCompiler(object):
       load_extra_dependencies
       compile_c
       compile_cxx
-    See the documentation for those functions in this class for more details.
+    See the documentation for those functions in this class for more details. The compiler class may also define
+    an identity method to allow the c module to use an artifact cache, and a compile_command method to allow
+    compilation to be run by ninja when the build graph is exported (see 'emk :ninja').
     
     Properties (defaults set based on the path prefix passed to the constructor):
       c_path   -- The path of the C compiler (eg "gcc").
@@ -37,6 +77,31 @@ class _GccCompiler(object):
         self.name = "gcc"
         self.c_path = path_prefix + "gcc"
         self.cxx_path = path_prefix + "g++"
+        self._identities = {}
+    
+    def identity(self, cxx):
+        """
+        Get a string that identifies the compiler that will be used, for use in artifact cache keys. The identity includes
+        the version information printed by the compiler, and the size and modification time of the compiler executable.
+        
+        Arguments:
+          cxx -- If True, get the identity of the C++ compiler; otherwise get the identity of the C compiler.
+        
+        Returns the identity string, or None if the compiler could not be identified (in which case the artifact cache is not used).
+        """
+        exe = self.cxx_path if cxx else self.c_path
+        if exe not in self._identities:
+            identity = None
+            path = _find_executable(exe)
+            if path:
+                try:
+                    stdout, stderr, code = utils.call([path, "-v"], print_call=False, print_stderr=False, noexit=True)
+                    st = os.stat(path)
+                    identity = "%s\n%s\n%s %s" % (os.path.realpath(path), stderr.strip(), st.st_size, st.st_mtime)
+                except (emk.BuildError, OSError):
+                    pass
+            self._identities[exe] = identity
+        return self._identities[exe]
     
     def load_extra_dependencies(self, path):
         """
@@ -49,7 +114,7 @@ class _GccCompiler(object):
         Returns a list of paths (strings) of all the extra dependencies.
         """
         cache = emk.scope_cache(path)
-        return cache.get("secondary_deps", [])
+        return utils.intern_paths(cache.get("secondary_deps", []))
     
     def depfile_args(self, dep_file):
         """
@@ -57,30 +122,49 @@ class _GccCompiler(object):
         """
         return ["-Wp,-MMD,%s" % (dep_file)]
     
-    def compile(self, exe, source, dest, includes, defines, flags):
-        dep_file = dest + ".dep"
+    def compile_args(self, exe, source, dest, includes, defines, flags):
+        """
+        Returns the compiler command line (a list of arguments) to compile the source file into dest, writing
+        the secondary dependencies into dest + ".dep".
+        """
         args = [exe]
-        args.extend(self.depfile_args(dep_file))
+        args.extend(self.depfile_args(dest + ".dep"))
         args.extend(["-I%s" % (emk.abspath(d)) for d in includes])
         args.extend(["-D%s=%s" % (key, value) for key, value in defines.items()])
         args.extend(utils.flatten(flags))
         args.extend(["-o", dest, "-c", source])
-        utils.call(args, print_stderr=False)
+        return args
+    
+    def compile_command(self, cxx, source, dest, includes, defines, flags):
+        """
+        Get the command line that compiles a source file, for running the compilation outside of emk (see 'emk :ninja').
+        
+        Arguments are the same as for compile_c() and compile_cxx(), plus:
+          cxx -- If True, the source file is compiled as C++; otherwise it is compiled as C.
+        
+        Returns a tuple (list of arguments, path of the make-style dependency file that the command writes).
+        """
+        exe = self.cxx_path if cxx else self.c_path
+        return self.compile_args(exe, source, dest, includes, defines, flags), dest + ".dep"
+    
+    def compile(self, exe, source, dest, includes, defines, flags):
+        dep_file = dest + ".dep"
+        utils.call(self.compile_args(exe, source, dest, includes, defines, flags), print_stderr=False)
         
         try:
-            with open(dep_file, "r") as f:
-                data = f.read()
-                data = data.replace("\\\n", "")
-                items = shlex.split(data)
-                unique_items = [emk.abspath(item) for item in (set(items[2:]) - set([""]))]
-                # call has_changed to set up rule cache for future builds.
-                for item in unique_items:
-                    emk.current_rule.has_changed(item)
-                cache = emk.scope_cache(dest)
-                cache["secondary_deps"] = unique_items
+            # the first prerequisite is the source file
+            deps = utils.read_depfile(dep_file)[1:]
         except IOError:
             log.error("Failed to open depfile %s", dep_file)
             utils.rm(dep_file)
+            return
+        
+        # call has_changed to set up rule cache for future builds.
+        has_changed = emk.current_rule.has_changed
+        for item in deps:
+            has_changed(item)
+        cache = emk.scope_cache(dest)
+        cache["secondary_deps"] = deps
         
     def compile_c(self, source, dest, includes, defines, flags):
         """
@@ -169,7 +253,7 @@ class _MsvcCompiler(object):
         Returns a list of paths (strings) of all the extra dependencies.
         """
         cache = emk.scope_cache(path)
-        return cache.get("secondary_deps", [])
+        return utils.intern_paths(cache.get("secondary_deps", []))
     
     def compile(self, source, dest, includes, defines, flags):
         args = [self.cl_exe, "/nologo", "/c", "/showIncludes"]
@@ -231,7 +315,7 @@ class _MsvcCompiler(object):
         """
         return ".obj"
 
-class Module(object):
+class Module(emk.Container):
     """
     emk module for compiling C and C++ code. Depends on the link module (and utils).
     
@@ -287,6 +371,9 @@ class Module(object):
                       naming conflicts when the build directory is not a relative path. The default value is False.
                       If True, the link module's unique_names property will also be set to True.
       obj_funcs    -- A list of functions that are run for each generated object file path.
+      artifact_cache -- A utils.ArtifactCache instance used to store and restore compiled object files, or None to disable
+                        the artifact cache. The cache is only used if the compiler defines an identity method. For example,
+                        'c.artifact_cache = utils.ArtifactCache("~/.emk/artifacts")'. The default value is None.
 
       obj_ext      -- The file extension for object files generated by the compiler (eg ".o" for gcc or ".obj" for MSVC).  This property is
                       read-only as its value is provided by the compiler implementation.
@@ -303,31 +390,14 @@ class Module(object):
         if parent:
             self.compiler = parent.compiler
             
-            self.include_dirs = list(parent.include_dirs)
-            self.defines = parent.defines.copy()
-            self.flags = list(parent.flags)
-            
-            self.source_files = list(parent.source_files)
-
-            self.c.exts = list(parent.c.exts)
-            self.c.include_dirs = list(parent.c.include_dirs)
-            self.c.defines = parent.c.defines.copy()
-            self.c.flags = list(parent.c.flags)
-            self.c.source_files = list(parent.c.source_files)
-            
-            self.cxx.exts = list(parent.cxx.exts)
-            self.cxx.include_dirs = list(parent.cxx.include_dirs)
-            self.cxx.defines = parent.cxx.defines.copy()
-            self.cxx.flags = list(parent.cxx.flags)
-            self.cxx.source_files = list(parent.cxx.source_files)
+            # the list and dict properties are copied on first access (see emk.Container.inherit())
+            self.inherit(parent, "include_dirs", "defines", "flags", "source_files", "excludes", "non_lib_src", "non_exe_src", "obj_funcs")
+            self.c.inherit(parent.c, "exts", "include_dirs", "defines", "flags", "source_files")
+            self.cxx.inherit(parent.cxx, "exts", "include_dirs", "defines", "flags", "source_files")
 
             self.autodetect = parent.autodetect
             self.autodetect_from_targets = parent.autodetect_from_targets
-            self.excludes = list(parent.excludes)
-            self.non_lib_src = list(parent.non_lib_src)
-            self.non_exe_src = list(parent.non_exe_src)
-            
-            self.obj_funcs = list(parent.obj_funcs)
+            self.artifact_cache = parent.artifact_cache
 
             self.unique_names = parent.unique_names
         else:
@@ -361,6 +431,7 @@ class Module(object):
             self.non_exe_src = []
             
             self.obj_funcs = []
+            self.artifact_cache = None
             
             self.unique_names = False
 
@@ -381,7 +452,7 @@ class Module(object):
         if emk.cleaning:
             return
         
-        emk.do_prebuild(self._prebuild)
+        emk.do_prebuild(self._prebuild, cwd_safe=True)
         if self.unique_names and self.link:
             self.link.unique_names = True
     
@@ -389,48 +460,58 @@ class Module(object):
         c_sources = set()
         cxx_sources = set()
         
-        self._non_exe_src = set(self.non_exe_src)
-        self._non_lib_src = set(self.non_lib_src)
+        # read-only accesses use peek() so that properties which are not modified in this scope are not copied
+        self._non_exe_src = set(self.peek("non_exe_src"))
+        self._non_lib_src = set(self.peek("non_lib_src"))
+        c_exts = self.c.peek("exts")
+        cxx_exts = self.cxx.peek("exts")
         
         if self.autodetect:
             if self.autodetect_from_targets:
-                target_c_files = [t for t in emk.local_targets.keys() if self._matches_exts(t, self.c.exts)]
+                target_c_files = [t for t in emk.local_targets.keys() if self._matches_exts(t, c_exts)]
                 if target_c_files:
                     log.debug("Detected generated C files: %s", target_c_files)
                     self.c.source_files.extend(target_c_files)
                     
-                target_cxx_files = [t for t in emk.local_targets.keys() if self._matches_exts(t, self.cxx.exts)]
+                target_cxx_files = [t for t in emk.local_targets.keys() if self._matches_exts(t, cxx_exts)]
                 if target_cxx_files:
                     log.debug("Detected generated C++ files: %s", target_cxx_files)
                     self.cxx.source_files.extend(target_cxx_files)
                     
-            files = set(self.source_files)
-            files.update([f for f in os.listdir(emk.scope_dir) if os.path.isfile(f)])
-            for file_path in files:
-                if self._matches_exts(file_path, self.c.exts):
-                    self.c.source_files.append(file_path)
-                if self._matches_exts(file_path, self.cxx.exts):
-                    self.cxx.source_files.append(file_path)
-        
-        for f in self.c.source_files:
-            if f in self.excludes:
+            snapshot = emk.dir_snapshot()
+            source_files = self.peek("source_files")
+            c_files = set(snapshot.with_exts(c_exts))
+            c_files.update([f for f in source_files if self._matches_exts(f, c_exts)])
+            cxx_files = set(snapshot.with_exts(cxx_exts))
+            cxx_files.update([f for f in source_files if self._matches_exts(f, cxx_exts)])
+            if c_files:
+                self.c.source_files.extend(sorted(c_files))
+            if cxx_files:
+                self.cxx.source_files.extend(sorted(cxx_files))
+        
+        excludes = self.peek("excludes")
+        for f in self.c.peek("source_files"):
+            if f in excludes:
                 continue
             c_sources.add(f)
-        for f in self.cxx.source_files:
-            if f in self.excludes:
+        for f in self.cxx.peek("source_files"):
+            if f in excludes:
                 continue
             cxx_sources.add(f)
         
-        c_includes = utils.unique_list(self.include_dirs + self.c.include_dirs)
-        c_flags = utils.unique_list(self.flags + self.c.flags)
-        c_defines = dict(self.defines)
-        c_defines.update(self.c.defines)
+        include_dirs = self.peek("include_dirs")
+        flags = self.peek("flags")
+        defines = self.peek("defines")
+        c_includes = utils.unique_list(include_dirs + self.c.peek("include_dirs"))
+        c_flags = utils.unique_list(flags + self.c.peek("flags"))
+        c_defines = dict(defines)
+        c_defines.update(self.c.peek("defines"))
         c_args = (False, c_includes, c_defines, c_flags)
         
-        cxx_includes = utils.unique_list(self.include_dirs + self.cxx.include_dirs)
-        cxx_flags = utils.unique_list(self.flags + self.cxx.flags)
-        cxx_defines = dict(self.defines)
-        cxx_defines.update(self.cxx.defines)
+        cxx_includes = utils.unique_list(include_dirs + self.cxx.peek("include_dirs"))
+        cxx_flags = utils.unique_list(flags + self.cxx.peek("flags"))
+        cxx_defines = dict(defines)
+        cxx_defines.update(self.cxx.peek("defines"))
         cxx_args = (True, cxx_includes, cxx_defines, cxx_flags)
         
         objs = {}
@@ -473,10 +554,10 @@ class Module(object):
         if extra_deps is None:
             requires.append(emk.ALWAYS_BUILD)
         
-        emk.rule(self.do_compile, dest, requires, *args, cwd_safe=True, ex_safe=True)
+        emk.rule(self.do_compile, dest, requires, *args, cwd_safe=True, ex_safe=True, command=self.compile_command)
         if extra_deps:
             emk.weak_depend(dest, extra_deps)
-        for f in self.obj_funcs:
+        for f in self.peek("obj_funcs"):
             f(dest)
     
     def do_compile(self, produces, requires, cxx, includes, defines, flags):
@@ -485,6 +566,9 @@ class Module(object):
         
         The compiler instance will also produce an <object file>.dep file that contains additional dependencies (ie, header files).
         
+        If there is an artifact cache, the object file is restored from the cache instead of being compiled if the compiler,
+        arguments, source file and header files are the same as when it was stored.
+        
         Arguments:
           produces -- The path to the object file that will be produced.
           requires -- The list of dependencies; the source file should be first.
@@ -495,12 +579,55 @@ class Module(object):
         """
         if not self.compiler:
             raise emk.BuildError("No compiler defined!")
+        
+        source, dest = requires[0], produces[0]
+        key = None
+        cache = self.artifact_cache
+        if cache and hasattr(self.compiler, "identity"):
+            identity = self.compiler.identity(cxx)
+            if identity:
+                try:
+                    flat_flags = utils.flatten(flags)
+                    key = cache.key(identity, cxx, [emk.abspath(d) for d in includes], defines, _key_flags(flat_flags),
+                        source, cache.file_digest(source))
+                    if not _remaps_paths(flat_flags):
+                        # the object file contains absolute paths (eg the source path in __FILE__ and in the debug info), so it
+                        # may only be restored into a checkout of the project at the same path (the key parts are made relative
+                        # to the project dir, so the absolute path must be added in a form that is not)
+                        key = cache.key(key, "proj_dir:" + emk.proj_dir)
+                except (IOError, OSError):
+                    pass
+        if key:
+            deps = cache.restore(key, [dest], emk.scope_cache(dest).get("secondary_deps"))
+            if deps is not None:
+                log.info("Restored %s from artifact cache", dest)
+                # call has_changed to set up rule cache for future builds.
+                for item in deps:
+                    emk.current_rule.has_changed(item)
+                emk.scope_cache(dest)["secondary_deps"] = deps
+                return
+        
         try:
             if cxx:
-                self.compiler.compile_cxx(requires[0], produces[0], includes, defines, flags)
+                self.compiler.compile_cxx(source, dest, includes, defines, flags)
             else:
-                self.compiler.compile_c(requires[0], produces[0], includes, defines, flags)
+                self.compiler.compile_c(source, dest, includes, defines, flags)
         except:
-            utils.rm(produces[0])
-            utils.rm(produces[0] + ".dep")
+            utils.rm(dest)
+            utils.rm(dest + ".dep")
             raise
+        
+        if key:
+            cache.save(key, [dest], emk.scope_cache(dest).get("secondary_deps", []))
+    
+    def compile_command(self, produces, requires, cxx, includes, defines, flags):
+        """
+        Rule command function (see emk.rule()) that describes the compiler command line run by do_compile(), if the
+        compiler defines a compile_command method. The artifact cache is not used when the command is run outside of emk.
+        """
+        if not self.compiler or not hasattr(self.compiler, "compile_command"):
+            return None
+        
+        source, dest = requires[0], produces[0]
+        args, dep_file = self.compiler.compile_command(cxx, source, dest, includes, defines, flags)
+        return {"commands": [args], "depfile": dep_file, "description": "Compiling %s" % (os.path.relpath(source, emk.proj_dir))}
@@ -3,12 +3,14 @@ import logging
 import re
 import shutil
 import hashlib
+import threading
 
 log = logging.getLogger("emk.java")
 utils = emk.module("utils")
 
 need_depdirs = {}
 dir_cache = {}
+cache_lock = threading.Lock() # protects need_depdirs and dir_cache, since prebuild functions of different scopes may run in parallel
 
 comments_regex = re.compile(r'(/\*.*?\*/)|(//.*?$)', re.MULTILINE | re.DOTALL)
 package_regex = re.compile(r'package\s+(\S+)\s*;')
@@ -16,7 +18,7 @@ main_function_regex = re.compile(r'((public\s+static)|(static\s+public))\s+void\
 
 fix_path_regex = re.compile(r'[\W]+')
 
-class Module(object):
+class Module(emk.Container):
     """
     emk module for compiling Java code and creating jar files. Depends on the utils module.
     
@@ -91,29 +93,19 @@ class Module(object):
             self.javac_cmd = parent.javac_cmd
             self.jar_cmd = parent.jar_cmd
             
-            self.compile_flags = list(parent.compile_flags)
-            self.exts = list(parent.exts)
-            self.source_files = list(parent.source_files)
+            # the list properties are copied on first access (see emk.Container.inherit())
+            self.inherit(parent, "compile_flags", "exts", "source_files", "excludes", "exe_classes", "exclude_exe_classes", "resources",
+                "depdirs", "projdirs", "sysjars")
         
             self.autodetect = parent.autodetect
             self.autodetect_from_targets = parent.autodetect_from_targets
-            self.excludes = list(parent.excludes)
-            
-            self.exe_classes = list(parent.exe_classes)
-            self.exclude_exe_classes = list(parent.exclude_exe_classes)
             self.autodetect_exe = parent.autodetect_exe
             
-            self.resources = list(parent.resources)
-            
             self.make_jar = parent.make_jar
             self.jarname = parent.jarname
             self.jar_in_jar = parent.jar_in_jar
             self.exe_jar_in_jar = parent.exe_jar_in_jar
             self.unique_names = parent.unique_names
-            
-            self.depdirs = list(parent.depdirs)
-            self.projdirs = list(parent.projdirs)
-            self.sysjars = list(parent.sysjars)
         else:
             self.javac_cmd = "javac"
             self.jar_cmd = "jar"
@@ -151,17 +143,29 @@ class Module(object):
                 return True
         return False
     
+    def unload_rules(self):
+        # The rules of this directory are being loaded again (by the build server or in watch mode), along with the directories
+        # that depend on it; forget what the other directories know about it.
+        with cache_lock:
+            if dir_cache.get(emk.scope_dir) is self:
+                del dir_cache[emk.scope_dir]
+            need_depdirs.pop(emk.scope_dir, None)
+            for dirs in need_depdirs.values():
+                dirs.discard(emk.scope_dir)
+            for cached in dir_cache.values():
+                cached._depended_by.discard(emk.scope_dir)
+    
     def post_rules(self):
         if emk.cleaning:
             return
         
-        emk.do_prebuild(self._prebuild)
+        emk.do_prebuild(self._prebuild, cwd_safe=True)
     
     def _examine_source(self, sourcefile):
         global comments_regex
         package = None
         main = False
-        with open(sourcefile) as f:
+        with open(os.path.join(emk.scope_dir, sourcefile)) as f:
             data = f.read()
             text = comments_regex.sub('', data)
             if main_function_regex.search(text):
@@ -182,31 +186,34 @@ class Module(object):
         global need_depdirs
         global dir_cache
         
-        for d in self.projdirs:
-            self.depdirs.append(os.path.join(emk.proj_dir, d))
-        self.projdirs = []
+        # read-only accesses use peek() so that properties which are not modified in this scope are not copied
+        projdirs = self.peek("projdirs")
+        if projdirs:
+            self.depdirs.extend([os.path.join(emk.proj_dir, d) for d in projdirs])
+            self.projdirs = []
         
-        self._abs_depdirs = set([emk.abspath(d) for d in self.depdirs])
+        self._abs_depdirs = set([emk.abspath(d) for d in self.peek("depdirs")])
         
         for d in self._abs_depdirs:
             emk.recurse(d)
             
         sources = set()
         
+        exts = self.peek("exts")
         if self.autodetect:
             if self.autodetect_from_targets:
-                target_files = [t for t in emk.local_targets.keys() if self._matches_exts(t, self.exts)]
+                target_files = [t for t in emk.local_targets.keys() if self._matches_exts(t, exts)]
                 if target_files:
                     log.debug("Detected generated Java files: %s", target_files)
                     self.source_files.extend(target_files)
                     
-            files = [f for f in os.listdir(emk.scope_dir) if os.path.isfile(f)]
-            for file_path in files:
-                if self._matches_exts(file_path, self.exts):
-                    self.source_files.append(file_path)
+            files = emk.dir_snapshot().with_exts(exts)
+            if files:
+                self.source_files.extend(files)
         
-        for f in self.source_files:
-            if not f in self.excludes:
+        excludes = self.peek("excludes")
+        for f in self.peek("source_files"):
+            if not f in excludes:
                 sources.add(f)
                 
         if self.autodetect_exe:
@@ -221,11 +228,12 @@ class Module(object):
                     else:
                         fqn = name
                     self.exe_classes.append(fqn)
-        exe_class_set = set(self.exe_classes)
-        exe_class_set -= set(self.exclude_exe_classes)
+        exe_class_set = set(self.peek("exe_classes"))
+        exe_class_set -= set(self.peek("exclude_exe_classes"))
         
-        if self.resources:
-            resource_set = set(self.resources)
+        resources = self.peek("resources")
+        if resources:
+            resource_set = set(resources)
             resource_sources, resource_dests = zip(*resource_set)
             emk.rule(self._copy_resources, "java.__jar_resources__", resource_sources, resource_dests, cwd_safe=True, ex_safe=True)
         else:
@@ -270,34 +278,35 @@ class Module(object):
                 emk.alias(specific_jarpath, specific_jarname)
                 emk.autobuild(specific_jarpath)
         
-        self._classpaths = set([self._class_dir])
-        self._jar_contents = set([self._class_dir, self._resource_dir])
-        self._sysjars = set([emk.abspath(j) for j in self.sysjars])
-        for d in self._abs_depdirs:
-            if d in dir_cache:
-                cache = dir_cache[d]
-                self._classpaths |= cache._classpaths
-                self._jar_contents |= cache._jar_contents
-                self._sysjars |= cache._sysjars
-                cache._depended_by.add(emk.scope_dir)
-            elif d in need_depdirs:
-                need_depdirs[d].add(emk.scope_dir)
-            else:
-                need_depdirs[d] = set([emk.scope_dir])
+        with cache_lock:
+            self._classpaths = set([self._class_dir])
+            self._jar_contents = set([self._class_dir, self._resource_dir])
+            self._sysjars = set([emk.abspath(j) for j in self.peek("sysjars")])
+            for d in self._abs_depdirs:
+                if d in dir_cache:
+                    cache = dir_cache[d]
+                    self._classpaths |= cache._classpaths
+                    self._jar_contents |= cache._jar_contents
+                    self._sysjars |= cache._sysjars
+                    cache._depended_by.add(emk.scope_dir)
+                elif d in need_depdirs:
+                    need_depdirs[d].add(emk.scope_dir)
+                else:
+                    need_depdirs[d] = set([emk.scope_dir])
         
-        needed_by = set()
-        if emk.scope_dir in need_depdirs:
-            for d in need_depdirs[emk.scope_dir]:
-                self._depended_by.add(d)
-                self._get_needed_by(d, needed_by)
+            needed_by = set()
+            if emk.scope_dir in need_depdirs:
+                for d in need_depdirs[emk.scope_dir]:
+                    self._depended_by.add(d)
+                    self._get_needed_by(d, needed_by)
         
-        for d in needed_by:
-            cache = dir_cache[d]
-            cache._classpaths |= self._classpaths
-            cache._jar_contents |= self._jar_contents
-            cache._sysjars |= self._sysjars
+            for d in needed_by:
+                cache = dir_cache[d]
+                cache._classpaths |= self._classpaths
+                cache._jar_contents |= self._jar_contents
+                cache._sysjars |= self._sysjars
         
-        dir_cache[emk.scope_dir] = self
+            dir_cache[emk.scope_dir] = self
     
     def _copy_resources(self, produces, requires, dests):
         for dest, src in zip(dests, requires):
@@ -321,7 +330,7 @@ class Module(object):
             classpath = ':'.join(self._classpaths | self._sysjars)
     
             cmd = [self.javac_cmd, "-d", self._class_dir, "-sourcepath", emk.scope_dir, "-classpath", classpath]
-            cmd.extend(utils.flatten(self.compile_flags))
+            cmd.extend(utils.flatten(self.peek("compile_flags")))
             cmd.extend(requires)
             utils.call(cmd)
         emk.mark_virtual("java.__jar_contents__")
@@ -5,6 +5,7 @@ import re
 import shutil
 import hashlib
 import struct
+import threading
 
 log = logging.getLogger("emk.link")
 
@@ -25,7 +26,9 @@ class _GccLinker(object):
       do_link
       link_cwd_safe
       strip
-    See the documentation for those functions in this class for more details.
+    See the documentation for those functions in this class for more details. The linker class may also define
+    link_command, static_lib_command and strip_command methods to allow linking to be run by ninja when the build
+    graph is exported (see 'emk :ninja').
     
     Properties (defaults set based on the path prefix passed to the constructor):
       c_path     -- The path of the C linker (eg "gcc").
@@ -97,6 +100,20 @@ class _GccLinker(object):
         """
         utils.call(self.ar_path, "r", dest, objs)
     
+    def static_lib_command(self, dest, source_objs):
+        """
+        Get the commands that create a static library from the given object files, for running outside of emk (see 'emk :ninja').
+        
+        Arguments:
+          dest        -- The path of the static library to generate.
+          source_objs -- A list of paths to object files to include in the generated static library.
+        
+        Returns a list of commands (each a list of arguments) to run in order, or None if the library can only be created by emk.
+        """
+        if os.name == "nt":
+            return None
+        return [["rm", "-f", dest], [self.ar_path, "r", dest] + list(source_objs)]
+    
     def create_static_lib(self, dest, source_objs, other_libs):
         """
         Create a static library (archive) containing the given object files and all object files contained in
@@ -164,14 +181,30 @@ class _GccLinker(object):
         """
         return []
     
-    def link_cmd(self, cmd, flags, dest, objs, abs_libs, lib_dirs, libs):
+    def link_args(self, cmd, flags, dest, objs, abs_libs, lib_dirs, libs):
         """
-        Set up and call the linker.
+        Returns the linker command line (a list of arguments).
         """
         sg = "-Wl,--start-group"
         eg = "-Wl,--end-group"
-        call = [cmd] + flags + ["-o", dest] + objs + lib_dirs + [sg] + abs_libs + libs + [eg]
-        utils.call(call, print_stderr=False)
+        return [cmd] + flags + ["-o", dest] + objs + lib_dirs + [sg] + abs_libs + libs + [eg]
+    
+    def link_cmd(self, cmd, flags, dest, objs, abs_libs, lib_dirs, libs):
+        """
+        Set up and call the linker.
+        """
+        utils.call(self.link_args(cmd, flags, dest, objs, abs_libs, lib_dirs, libs), print_stderr=False)
+    
+    def _link_parts(self, source_objs, abs_libs, lib_dirs, rel_libs, flags, cxx_mode):
+        linker = self.c_path
+        if cxx_mode:
+            linker = self.cxx_path
+        
+        flat_flags = utils.flatten(flags)
+        
+        lib_dir_flags = ["-L" + d for d in lib_dirs]
+        rel_lib_flags = ["-l" + lib for lib in rel_libs]
+        return linker, flat_flags, source_objs, abs_libs, lib_dir_flags, rel_lib_flags
 
     def do_link(self, dest, source_objs, abs_libs, lib_dirs, rel_libs, flags, cxx_mode):
         """
@@ -191,16 +224,16 @@ class _GccLinker(object):
           flags       -- Additional flags to be passed to the linker.
           cxx_mode    -- If True, then the object files or libraries contain C++ code (so use g++ to link, for example).
         """
-        linker = self.c_path
-        if cxx_mode:
-            linker = self.cxx_path
-        
-        flat_flags = utils.flatten(flags)
-        
-        lib_dir_flags = ["-L" + d for d in lib_dirs]
-        rel_lib_flags = ["-l" + lib for lib in rel_libs]
-        
-        self.link_cmd(linker, flat_flags, dest, source_objs, abs_libs, lib_dir_flags, rel_lib_flags)
+        linker, flat_flags, objs, abs_libs, lib_dir_flags, rel_lib_flags = self._link_parts(source_objs, abs_libs, lib_dirs, rel_libs, flags, cxx_mode)
+        self.link_cmd(linker, flat_flags, dest, objs, abs_libs, lib_dir_flags, rel_lib_flags)
+    
+    def link_command(self, dest, source_objs, abs_libs, lib_dirs, rel_libs, flags, cxx_mode):
+        """
+        Get the command line (a list of arguments) that do_link() runs, for running outside of emk (see 'emk :ninja').
+        The arguments are the same as for do_link().
+        """
+        linker, flat_flags, objs, abs_libs, lib_dir_flags, rel_lib_flags = self._link_parts(source_objs, abs_libs, lib_dirs, rel_libs, flags, cxx_mode)
+        return self.link_args(linker, flat_flags, dest, objs, abs_libs, lib_dir_flags, rel_lib_flags)
     
     def link_cwd_safe(self):
         """
@@ -217,7 +250,13 @@ class _GccLinker(object):
         Arguments:
           path -- The path of the file to strip.
         """
-        utils.call(self.strip_path, "-S", "-x", path)
+        utils.call(self.strip_command(path))
+    
+    def strip_command(self, path):
+        """
+        Get the command line (a list of arguments) that strip() runs, for running outside of emk (see 'emk :ninja').
+        """
+        return [self.strip_path, "-S", "-x", path]
 
     def obj_ext(self):
         """
@@ -277,6 +316,12 @@ class _OsxLinker(_GccLinker):
             cmd.append(dest)
         cmd.extend(objs)
         utils.call(cmd)
+    
+    def static_lib_command(self, dest, source_objs):
+        """
+        Create a static library with libtool, which replaces an existing library.
+        """
+        return [[self.libtool_path, "-static", "-s", "-o", dest, "-"] + list(source_objs)]
 
     def shlib_opts(self):
         """
@@ -284,13 +329,12 @@ class _OsxLinker(_GccLinker):
         """
         return ["-dynamiclib"]
     
-    def link_cmd(self, cmd, flags, dest, objs, abs_libs, lib_dirs, libs):
+    def link_args(self, cmd, flags, dest, objs, abs_libs, lib_dirs, libs):
         """
         The actual linker call to use on OS X. Note that we don't need '--start-group'/'--end-group' on OS X
         because the OS X linker will search all libraries to resolve symbols, regardless of order.
         """
-        call = [cmd] + flags + ["-o", dest] + objs + abs_libs + lib_dirs + libs
-        utils.call(call, print_stderr=False)
+        return [cmd] + flags + ["-o", dest] + objs + abs_libs + lib_dirs + libs
         
 class _MingwGccLinker(_GccLinker):
     """
@@ -488,8 +532,10 @@ class _MsvcLinker(object):
 
 link_cache = {}
 need_depdirs = {}
+# protects link_cache, need_depdirs and the dependency sets of the cached modules, since prebuild functions of different scopes may run in parallel
+cache_lock = threading.Lock()
 
-class Module(object):
+class Module(emk.Container):
     """
     emk module for linking compiled code (ie, .o files) into libraries/executables. Depends on the utils module.
     
@@ -656,46 +702,13 @@ class Module(object):
             self.lib_in_lib = parent.lib_in_lib
             self.unique_names = parent.unique_names
             
-            self.exe_objs = list(parent.exe_objs)
-            self.non_exe_objs = list(parent.non_exe_objs)
-            self.objects = parent.objects.copy()
-            self.obj_nosrc = list(parent.obj_nosrc)
-            self.non_lib_objs = list(parent.non_lib_objs)
-            
-            self.depdirs = list(parent.depdirs)
-            self.projdirs = list(parent.projdirs)
-            
-            self.static_libs = list(parent.static_libs)
-            self.local_static_libs = list(parent.local_static_libs)
-            self.syslibs = list(parent.syslibs)
-            self.local_syslibs = list(parent.local_syslibs)
-            self.syslib_paths = list(parent.syslib_paths)
-            self.local_syslib_paths = list(parent.local_syslib_paths)
-            
-            self.flags = list(parent.flags)
-            self.local_flags = list(parent.local_flags)
-            self.libflags = list(parent.libflags)
-            self.local_libflags = list(parent.local_libflags)
-            self.exeflags = list(parent.exeflags)
-            self.local_exeflags = list(parent.local_exeflags)
-            
-            self.c.flags = list(parent.c.flags)
-            self.c.local_flags = list(parent.c.local_flags)
-            self.c.libflags = list(parent.c.libflags)
-            self.c.local_libflags = list(parent.c.local_libflags)
-            self.c.exeflags = list(parent.c.exeflags)
-            self.c.local_exeflags = list(parent.c.local_exeflags)
-            
-            self.cxx.flags = list(parent.cxx.flags)
-            self.cxx.local_flags = list(parent.cxx.local_flags)
-            self.cxx.libflags = list(parent.cxx.libflags)
-            self.cxx.local_libflags = list(parent.cxx.local_libflags)
-            self.cxx.exeflags = list(parent.cxx.exeflags)
-            self.cxx.local_exeflags = list(parent.cxx.local_exeflags)
-            
-            self.exe_funcs = list(parent.exe_funcs)
-            self.static_lib_funcs = list(parent.static_lib_funcs)
-            self.shared_lib_funcs = list(parent.shared_lib_funcs)
+            # the list and dict properties are copied on first access (see emk.Container.inherit())
+            self.inherit(parent, "exe_objs", "non_exe_objs", "objects", "obj_nosrc", "non_lib_objs", "depdirs", "projdirs",
+                "static_libs", "local_static_libs", "syslibs", "local_syslibs", "syslib_paths", "local_syslib_paths",
+                "flags", "local_flags", "libflags", "local_libflags", "exeflags", "local_exeflags",
+                "exe_funcs", "static_lib_funcs", "shared_lib_funcs")
+            self.c.inherit(parent.c, "flags", "local_flags", "libflags", "local_libflags", "exeflags", "local_exeflags")
+            self.cxx.inherit(parent.cxx, "flags", "local_flags", "libflags", "local_libflags", "exeflags", "local_exeflags")
         else:
             self.comments_regex = re.compile(r'(/\*.*?\*/)|(//.*?$)', re.MULTILINE | re.DOTALL)
             self.main_function_regex = re.compile(r'int\s+main\s*\(')
@@ -776,9 +789,21 @@ class Module(object):
     def new_scope(self, scope):
         return Module(scope, parent=self)
     
+    def unload_rules(self):
+        # The rules of this directory are being loaded again (by the build server or in watch mode), along with the directories
+        # that depend on it; forget what the other directories know about it.
+        with cache_lock:
+            if link_cache.get(emk.scope_dir) is self:
+                del link_cache[emk.scope_dir]
+            need_depdirs.pop(emk.scope_dir, None)
+            for dirs in need_depdirs.values():
+                dirs.discard(emk.scope_dir)
+            for cached in link_cache.values():
+                cached._depended_by.discard(emk.scope_dir)
+    
     def post_rules(self):
         if not emk.cleaning:
-            emk.do_prebuild(self._prebuild)
+            emk.do_prebuild(self._prebuild, cwd_safe=True)
     
     def _get_needed_by(self, d, result):
         global link_cache
@@ -793,44 +818,55 @@ class Module(object):
         global link_cache
         global need_depdirs
         
-        self._syslib_paths = set([emk.abspath(d) for d in self.syslib_paths])
-        self._local_syslib_paths = set([emk.abspath(d) for d in self.local_syslib_paths])
-        self._static_libs = set([emk.abspath(lib) for lib in self.static_libs])
-        self._local_static_libs = set([emk.abspath(lib) for lib in self.local_static_libs])
+        self._syslib_paths = set([emk.abspath(d) for d in self.peek("syslib_paths")])
+        self._local_syslib_paths = set([emk.abspath(d) for d in self.peek("local_syslib_paths")])
+        self._static_libs = set([emk.abspath(lib) for lib in self.peek("static_libs")])
+        self._local_static_libs = set([emk.abspath(lib) for lib in self.peek("local_static_libs")])
         
-        for d in self.projdirs:
+        for d in self.peek("projdirs"):
             self.depdirs.append(os.path.join(emk.proj_dir, d))
         self.projdirs = []
 
         self._all_static_libs.update(self._static_libs)
         
-        for d in set(self.depdirs):
-            abspath = emk.abspath(d)
-            self._all_depdirs.add(abspath)
-            if abspath in link_cache:
-                dep_link = link_cache[abspath]
-                self._all_depdirs.update(dep_link._all_depdirs)
-                self._all_static_libs.update(dep_link._all_static_libs)
-                dep_link._depended_by.add(emk.scope_dir)
-            elif abspath in need_depdirs:
-                need_depdirs[abspath].add(emk.scope_dir)
-            else:
-                need_depdirs[abspath] = set([emk.scope_dir])
-            emk.recurse(d)
+        depdirs = set(self.peek("depdirs"))
+        # This scope is added to link_cache in the same locked section that reads link_cache and need_depdirs, so that
+        # the prebuild function of a scope that depends on this one (which may be running in parallel) finds this scope
+        # either in need_depdirs or in link_cache.
+        with cache_lock:
+            for d in depdirs:
+                abspath = emk.abspath(d)
+                self._all_depdirs.add(abspath)
+                if abspath in link_cache:
+                    dep_link = link_cache[abspath]
+                    self._all_depdirs.update(dep_link._all_depdirs)
+                    self._all_static_libs.update(dep_link._all_static_libs)
+                    dep_link._depended_by.add(emk.scope_dir)
+                elif abspath in need_depdirs:
+                    need_depdirs[abspath].add(emk.scope_dir)
+                else:
+                    need_depdirs[abspath] = set([emk.scope_dir])
+            
+            needed_by = set()
+            if emk.scope_dir in need_depdirs:
+                for d in need_depdirs[emk.scope_dir]:
+                    self._depended_by.add(d)
+                    self._get_needed_by(d, needed_by)
+            
+            for d in needed_by:
+                cached = link_cache[d]
+                cached._all_depdirs.update(self._all_depdirs)
+                cached._all_static_libs.update(self._all_static_libs)
+            lib_deps = [os.path.join(d, "link.__static_lib__") for d in self._all_depdirs]
+            all_static_libs = list(self._all_static_libs)
+            
+            link_cache[emk.scope_dir] = self
         
-        needed_by = set()
-        if emk.scope_dir in need_depdirs:
-            for d in need_depdirs[emk.scope_dir]:
-                self._depended_by.add(d)
-                self._get_needed_by(d, needed_by)
-
-        lib_deps = [os.path.join(d, "link.__static_lib__") for d in self._all_depdirs]
+        for d in depdirs:
+            emk.recurse(d)
         for d in needed_by:
-            cached = link_cache[d]
-            cached._all_depdirs.update(self._all_depdirs)
-            cached._all_static_libs.update(self._all_static_libs)
             emk.depend(os.path.join(d, "link.__exe_deps__"), lib_deps)
-            emk.depend(os.path.join(d, "link.__exe_deps__"), self._all_static_libs)
+            emk.depend(os.path.join(d, "link.__exe_deps__"), all_static_libs)
         
         if self.detect_exe == "exact":
             emk.require_rule("link.__static_lib__", "link.__lib_in_lib__", "link.__shared_lib__", "link.__exe_deps__", "link.__exes__")
@@ -861,13 +897,11 @@ class Module(object):
             emk.do_prebuild(self._create_interim_rule)
         else:
             emk.do_prebuild(self._create_rules)
-        
-        link_cache[emk.scope_dir] = self
     
     def _create_interim_rule(self):
-        all_objs = set(self.obj_nosrc) | set([obj for obj, src in self.objects.items()]) | set(self.exe_objs)
+        all_objs = set(self.peek("obj_nosrc")) | set([obj for obj, src in self.peek("objects").items()]) | set(self.peek("exe_objs"))
         all_objs.add(emk.ALWAYS_BUILD)
-        emk.rule(self._interim_rule, "link.__interim__", all_objs)
+        emk.rule(self._interim_rule, "link.__interim__", all_objs, idempotent=True, command=utils.virtual_command)
         emk.autobuild("link.__interim__")
         
     def _interim_rule(self, produces, requires):
@@ -885,19 +919,19 @@ class Module(object):
     def _create_rules(self):
         global link_cache
         
-        exe_objs = set(self.exe_objs)
-        non_exe_objs = set(self.non_exe_objs)
-        obj_nosrc = set(self.obj_nosrc)
-        all_objs = obj_nosrc | set([obj for obj, src in self.objects.items()])
+        exe_objs = set(self.peek("exe_objs"))
+        non_exe_objs = set(self.peek("non_exe_objs"))
+        obj_nosrc = set(self.peek("obj_nosrc"))
+        all_objs = obj_nosrc | set([obj for obj, src in self.peek("objects").items()])
         
         if not self.detect_exe:
             pass
         elif self.detect_exe is True or self.detect_exe.lower() == "simple":
-            for obj, src in self.objects.items():
+            for obj, src in self.peek("objects").items():
                 if (not obj in exe_objs) and (not obj in non_exe_objs) and self._simple_detect_exe(src):
                     exe_objs.add(obj)
         elif self.detect_exe.lower() == "exact":
-            for obj, src in self.objects.items():
+            for obj, src in self.peek("objects").items():
                 if (not obj in exe_objs) and (not obj in non_exe_objs) and self.linker.contains_main_function(obj):
                     exe_objs.add(obj)
             for obj in obj_nosrc:
@@ -905,7 +939,7 @@ class Module(object):
                     exe_objs.add(obj)
         
         lib_objs = all_objs - exe_objs
-        lib_objs -= set(self.non_lib_objs)
+        lib_objs -= set(self.peek("non_lib_objs"))
         
         utils.mark_virtual_rule(["link.__exe_deps__"], ["link.__static_lib__"])
         
@@ -929,20 +963,22 @@ class Module(object):
                         libname = self.static_libname
                 libpath = os.path.join(emk.build_dir, libname)
                 self._static_libpath = libpath
-                emk.rule(self._create_static_lib, libpath, lib_objs, False, cwd_safe=self.linker.static_lib_cwd_safe(), ex_safe=True)
+                emk.rule(self._create_static_lib, libpath, lib_objs, False, cwd_safe=self.linker.static_lib_cwd_safe(), ex_safe=True, \
+                    command=self._static_lib_command)
                 emk.alias(libpath, "link.__static_lib__")
                 emk.autobuild(libpath)
-                for f in self.static_lib_funcs:
+                for f in self.peek("static_lib_funcs"):
                     f(libpath)
             if self.make_shared_lib:
                 libname = self.lib_prefix + dirname + self.shared_lib_ext
                 if self.shared_libname:
                     libname = self.shared_libname
                 libpath = os.path.join(emk.build_dir, libname)
-                emk.rule(self._create_shared_lib, libpath, ["link.__exe_deps__"] + list(lib_objs), cwd_safe=self.linker.link_cwd_safe(), ex_safe=True)
+                emk.rule(self._create_shared_lib, libpath, ["link.__exe_deps__"] + list(lib_objs), cwd_safe=self.linker.link_cwd_safe(), ex_safe=True, \
+                    command=self._shared_lib_command)
                 emk.autobuild(libpath)
                 emk.alias(libpath, "link.__shared_lib__")
-                for f in self.shared_lib_funcs:
+                for f in self.peek("shared_lib_funcs"):
                     f(libpath)
         if not making_static_lib:
             utils.mark_virtual_rule(["link.__static_lib__"], [])
@@ -957,10 +993,10 @@ class Module(object):
                 libname = self.static_libname
             libpath = os.path.join(emk.build_dir, libname)
             emk.rule(self._create_static_lib, libpath, ["link.__static_lib__", "link.__exe_deps__"], True, \
-                cwd_safe=self.linker.static_lib_cwd_safe(), ex_safe=True)
+                cwd_safe=self.linker.static_lib_cwd_safe(), ex_safe=True, command=self._static_lib_command)
             emk.alias(libpath, "link.__lib_in_lib__")
             emk.autobuild(libpath)
-            for f in self.static_lib_funcs:
+            for f in self.peek("static_lib_funcs"):
                 f(libpath)
         
         exe_targets = []
@@ -981,10 +1017,10 @@ class Module(object):
             name = name + self.exe_ext
             
             path = os.path.join(emk.build_dir, name)
-            emk.rule(self._create_exe, path, [obj, "link.__exe_deps__"], cwd_safe=self.linker.link_cwd_safe(), ex_safe=True)
+            emk.rule(self._create_exe, path, [obj, "link.__exe_deps__"], cwd_safe=self.linker.link_cwd_safe(), ex_safe=True, command=self._exe_command)
             emk.alias(path, name)
             exe_targets.append(path)
-            for f in self.exe_funcs:
+            for f in self.peek("exe_funcs"):
                 f(path)
             
         utils.mark_virtual_rule(["link.__exes__"], exe_targets)
@@ -1014,75 +1050,47 @@ class Module(object):
             utils.rm(produces[0])
             raise
     
-    def _create_shared_lib(self, produces, requires):
-        global link_cache
-        
-        flags = self.linker.shlib_opts() + self.local_flags + self.flags + self.local_libflags + self.libflags
-        c_flags = self.c.local_flags + self.c.flags + self.c.local_libflags + self.c.libflags
-        cxx_flags = self.cxx.local_flags + self.cxx.flags + self.cxx.local_libflags + self.cxx.libflags
-
-        abs_libs = self._local_static_libs | self._static_libs
-        syslibs = set(self.local_syslibs) | set(self.syslibs)
-        lib_paths = self._syslib_paths | self._local_syslib_paths
-        link_cxx = self.link_cxx
-        
-        for d in self._all_depdirs:
-            cache = link_cache[d]
-            flags += cache.flags
-            flags += cache.libflags
-            c_flags += cache.c.flags
-            c_flags += cache.c.libflags
-            cxx_flags += cache.cxx.flags
-            cxx_flags += cache.cxx.libflags
-            
-            if cache._static_libpath:
-                abs_libs.add(os.path.join(d, cache._static_libpath))
-            abs_libs |= cache._static_libs
-            syslibs |= set(cache.syslibs)
-            lib_paths |= cache._syslib_paths
-            link_cxx = link_cxx or cache.link_cxx
-        
-        if link_cxx:
-            flags += cxx_flags
-        else:
-            flags += c_flags
-        
-        try:
-            self.linker.do_link(produces[0], [o for o in requires if o.endswith(self.obj_ext)], list(abs_libs), \
-                lib_paths, syslibs, utils.unique_list(flags), cxx_mode=link_cxx)
-            if self.strip:
-                self.linker.strip(produces[0])
-        except:
-            utils.rm(produces[0])
-            raise
+    def _static_lib_command(self, produces, requires, lib_in_lib):
+        # describes the commands run by _create_static_lib() (see emk.rule()); libraries that contain other libraries are
+        # created by emk, since the other libraries must be extracted first
+        if lib_in_lib or not hasattr(self.linker, "static_lib_command"):
+            return None
+        commands = self.linker.static_lib_command(produces[0], requires)
+        if commands is None:
+            return None
+        return {"commands": commands, "description": "Archiving %s" % (os.path.relpath(produces[0], emk.proj_dir))}
     
-    def _create_exe(self, produces, requires):
+    def _link_inputs(self, exe):
+        # Returns (flags, abs_libs, lib_paths, syslibs, link_cxx) for linking an executable (if exe is True) or a shared library.
         global link_cache
         
-        flags = self.linker.exe_opts() + self.local_flags + self.flags + self.local_exeflags + self.exeflags
-        c_flags = self.c.local_flags + self.c.flags + self.c.local_exeflags + self.c.exeflags
-        cxx_flags = self.cxx.local_flags + self.cxx.flags + self.cxx.local_exeflags + self.cxx.exeflags
+        kind = "exeflags" if exe else "libflags"
+        local_kind = "local_" + kind
+        opts = self.linker.exe_opts() if exe else self.linker.shlib_opts()
+        flags = opts + self.peek("local_flags") + self.peek("flags") + self.peek(local_kind) + self.peek(kind)
+        c_flags = self.c.peek("local_flags") + self.c.peek("flags") + self.c.peek(local_kind) + self.c.peek(kind)
+        cxx_flags = self.cxx.peek("local_flags") + self.cxx.peek("flags") + self.cxx.peek(local_kind) + self.cxx.peek(kind)
 
         abs_libs = self._local_static_libs | self._static_libs
-        if self._static_libpath:
+        if exe and self._static_libpath:
             abs_libs.add(emk.abspath(self._static_libpath))
-        syslibs = set(self.local_syslibs) | set(self.syslibs)
+        syslibs = set(self.peek("local_syslibs")) | set(self.peek("syslibs"))
         lib_paths = self._syslib_paths | self._local_syslib_paths
         link_cxx = self.link_cxx
         
         for d in self._all_depdirs:
             cache = link_cache[d]
-            flags += cache.flags
-            flags += cache.exeflags
-            c_flags += cache.c.flags
-            c_flags += cache.c.exeflags
-            cxx_flags += cache.cxx.flags
-            cxx_flags += cache.cxx.exeflags
+            flags += cache.peek("flags")
+            flags += cache.peek(kind)
+            c_flags += cache.c.peek("flags")
+            c_flags += cache.c.peek(kind)
+            cxx_flags += cache.cxx.peek("flags")
+            cxx_flags += cache.cxx.peek(kind)
             
             if cache._static_libpath:
                 abs_libs.add(os.path.join(d, cache._static_libpath))
             abs_libs |= cache._static_libs
-            syslibs |= set(cache.syslibs)
+            syslibs |= set(cache.peek("syslibs"))
             lib_paths |= cache._syslib_paths
             link_cxx = link_cxx or cache.link_cxx
         
@@ -1090,12 +1098,38 @@ class Module(object):
             flags += cxx_flags
         else:
             flags += c_flags
-        
+        return utils.unique_list(flags), list(abs_libs), lib_paths, syslibs, link_cxx
+    
+    def _link(self, produces, requires, exe):
+        flags, abs_libs, lib_paths, syslibs, link_cxx = self._link_inputs(exe)
         try:
-            self.linker.do_link(produces[0], [o for o in requires if o.endswith(self.obj_ext)], list(abs_libs), \
-                lib_paths, syslibs, utils.unique_list(flags), cxx_mode=link_cxx)
+            self.linker.do_link(produces[0], [o for o in requires if o.endswith(self.obj_ext)], abs_libs, \
+                lib_paths, syslibs, flags, cxx_mode=link_cxx)
             if self.strip:
                 self.linker.strip(produces[0])
         except:
             utils.rm(produces[0])
             raise
+    
+    def _link_command(self, produces, requires, exe):
+        # describes the commands run by _link() (see emk.rule())
+        if not hasattr(self.linker, "link_command") or (self.strip and not hasattr(self.linker, "strip_command")):
+            return None
+        flags, abs_libs, lib_paths, syslibs, link_cxx = self._link_inputs(exe)
+        commands = [self.linker.link_command(produces[0], [o for o in requires if o.endswith(self.obj_ext)], abs_libs, \
+            lib_paths, syslibs, flags, link_cxx)]
+        if self.strip:
+            commands.append(self.linker.strip_command(produces[0]))
+        return {"commands": commands, "description": "Linking %s" % (os.path.relpath(produces[0], emk.proj_dir))}
+    
+    def _create_shared_lib(self, produces, requires):
+        self._link(produces, requires, False)
+    
+    def _shared_lib_command(self, produces, requires):
+        return self._link_command(produces, requires, False)
+    
+    def _create_exe(self, produces, requires):
+        self._link(produces, requires, True)
+    
+    def _exe_command(self, produces, requires):
+        return self._link_command(produces, requires, True)
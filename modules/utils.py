@@ -8,16 +8,568 @@ import glob
 import filecmp
 import sys
 import itertools
+import collections
 import platform
+import hashlib
+import threading
+import tempfile
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+if sys.version_info[0] < 3:
+    import httplib
+    import urlparse
+    import Queue as queue
+else:
+    import http.client as httplib
+    import urllib.parse as urlparse
+    import queue
+import json
+import socket
+import time
+import atexit
+import re
 
 log = logging.getLogger("emk.utils")
 
+class _ArtifactCacheBase(object):
+    """
+    Base class for artifact caches; computes keys and file digests.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._digests = {} # map path -> ((size, mtime, inode), digest)
+    
+    def _relocate(self, obj):
+        # Returns a canonical form of the given object for use in keys: lists and tuples (including namedtuples) become
+        # lists, sets become sorted lists, and dicts become lists of (key, value) pairs (sorted, unless the dict is ordered).
+        proj_dir = emk.proj_dir
+        if isinstance(obj, str):
+            if obj.startswith(proj_dir) and (len(obj) == len(proj_dir) or obj[len(proj_dir)] == os.sep):
+                return emk.proj_dir_placeholder + obj[len(proj_dir):]
+            return obj
+        elif isinstance(obj, (list, tuple)):
+            return [self._relocate(item) for item in obj]
+        elif isinstance(obj, (set, frozenset)):
+            return sorted([self._relocate(item) for item in obj])
+        elif isinstance(obj, collections.OrderedDict):
+            return [(self._relocate(k), self._relocate(v)) for k, v in obj.items()]
+        elif isinstance(obj, dict):
+            return sorted([(self._relocate(k), self._relocate(v)) for k, v in obj.items()])
+        return obj
+    
+    def _absolute(self, deps):
+        return [dep.replace(emk.proj_dir_placeholder, emk.proj_dir, 1) for dep in deps]
+    
+    def key(self, *parts):
+        """
+        Compute a cache key from the given parts (strings, or lists/tuples/dicts of strings).
+        Paths in the current project directory are made relative, so that the key is the same in any checkout of the project.
+        """
+        return hashlib.sha1(pickle.dumps(self._relocate(parts), 2)).hexdigest()
+    
+    def file_digest(self, path):
+        """
+        Get the digest of the contents of a file. Digests are remembered for the rest of the build as long as the
+        size, modification time and inode of the file do not change. Raises an IOError or OSError if the file cannot be read.
+        """
+        st = os.stat(path)
+        stat_key = (st.st_size, st.st_mtime, st.st_ino)
+        with self._lock:
+            cached = self._digests.get(path)
+        if cached and cached[0] == stat_key:
+            return cached[1]
+        
+        h = hashlib.sha1()
+        with open(path, "rb") as f:
+            while True:
+                data = f.read(1 << 20)
+                if not data:
+                    break
+                h.update(data)
+        digest = h.hexdigest()
+        with self._lock:
+            self._digests[path] = (stat_key, digest)
+        return digest
+    
+    def _outputs_key(self, key, deps):
+        return self.key(key, [(dep, self.file_digest(dep)) for dep in deps])
+    
+    def _candidates(self, dep_lists, deps_hint):
+        # Returns the (relocated) dependency lists to try for a restore, most likely first.
+        candidates = []
+        if deps_hint:
+            candidates.append(self._relocate(list(deps_hint)))
+        for deps in dep_lists:
+            if deps not in candidates:
+                candidates.append(deps)
+        return candidates
+
+class _ArtifactCache(_ArtifactCacheBase):
+    """
+    A local content-addressed cache for build artifacts (eg object files), shared between builds and project checkouts.
+    
+    Artifacts are looked up in two steps. The base key identifies everything about the build step except the contents of its
+    secondary dependencies (eg the compiler identity, flags, and source file contents). For each base key, the cache stores
+    the dependency lists that have been seen for that key; each dependency list is combined with the current contents of those
+    dependencies to get the key of the stored outputs. Paths in the project directory are stored relative to the project directory,
+    so the cache can be shared by checkouts of a project at different paths.
+    
+    The cache is limited (approximately) to max_size bytes; when it becomes too large, the least recently used entries are removed.
+    
+    Usage (in a rule function):
+      key = cache.key(<compiler identity>, <flags>, cache.file_digest(source))
+      deps = cache.restore(key, produces, <previous dependency list>)
+      if deps is None:
+          # build the outputs and get the list of dependencies, then
+          cache.save(key, produces, deps)
+    
+    Properties:
+      path     -- The directory containing the cache.
+      max_size -- The approximate maximum size of the cache in bytes.
+    """
+    max_dep_lists = 16 # maximum number of dependency lists stored for each base key
+    
+    def __init__(self, path, max_size=5*1024*1024*1024):
+        """
+        Create a new ArtifactCache instance.
+        
+        Arguments:
+          path     -- The directory to store the cache in (eg "~/.emk/artifacts"). Multiple emk processes can use the same directory.
+          max_size -- The approximate maximum size of the cache in bytes. The default value is 5 GiB.
+        """
+        super(_ArtifactCache, self).__init__()
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.max_size = max_size
+        
+        self._size = None
+    
+    def _entry_path(self, key, suffix=""):
+        return os.path.join(self.path, key[:2], key + suffix)
+    
+    def _load_dep_lists(self, key):
+        try:
+            with open(self._entry_path(key, ".deps"), "rb") as f:
+                return pickle.load(f)
+        except Exception:
+            return []
+    
+    def _make_parent_dir(self, path):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    
+    def _write_file(self, path, data):
+        # write a file atomically
+        self._make_parent_dir(path)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.rename(tmp, path)
+        except:
+            os.remove(tmp)
+            raise
+    
+    def restore(self, key, dests, deps_hint=None):
+        """
+        Restore the outputs for the given base key, if they are in the cache.
+        
+        Arguments:
+          key       -- The base key (see key()).
+          dests     -- The list of output paths to restore. The number of outputs must be the same as when they were saved.
+          deps_hint -- A list of dependencies that are likely to be the current dependencies (eg the dependencies from the previous build).
+        
+        Returns the list of dependencies (absolute paths) for the restored outputs, or None if the outputs were not in the cache.
+        """
+        for deps in self._candidates(self._load_dep_lists(key), deps_hint):
+            abs_deps = self._absolute(deps)
+            try:
+                entry = self._entry_path(self._outputs_key(key, abs_deps))
+            except (IOError, OSError):
+                continue
+            if not os.path.isdir(entry):
+                continue
+            try:
+                for i, dest in enumerate(dests):
+                    shutil.copyfile(os.path.join(entry, str(i)), dest)
+                os.utime(entry, None)
+            except (IOError, OSError):
+                for dest in dests:
+                    if os.path.isfile(dest):
+                        os.remove(dest)
+                continue
+            log.debug("Restored %s from artifact cache entry %s", dests, entry)
+            return abs_deps
+        return None
+    
+    def save(self, key, outputs, deps):
+        """
+        Store the outputs for the given base key and dependency list in the cache.
+        
+        Arguments:
+          key     -- The base key (see key()).
+          outputs -- The list of output paths to store.
+          deps    -- The list of dependencies (absolute paths) that the outputs were built from (eg the header files).
+        """
+        try:
+            entry = self._entry_path(self._outputs_key(key, deps))
+            self._make_parent_dir(entry)
+            if not os.path.isdir(entry):
+                tmp = tempfile.mkdtemp(dir=os.path.dirname(entry))
+                size = 0
+                for i, output in enumerate(outputs):
+                    shutil.copyfile(output, os.path.join(tmp, str(i)))
+                    size += os.path.getsize(output)
+                try:
+                    os.rename(tmp, entry)
+                except OSError: # another process stored the same entry
+                    shutil.rmtree(tmp, ignore_errors=True)
+                    size = 0
+                self._add_size(size)
+            
+            dep_lists = self._load_dep_lists(key)
+            rel_deps = self._relocate(list(deps))
+            if rel_deps in dep_lists:
+                dep_lists.remove(rel_deps)
+            dep_lists.insert(0, rel_deps)
+            self._write_file(self._entry_path(key, ".deps"), pickle.dumps(dep_lists[:self.max_dep_lists], 2))
+        except (IOError, OSError) as e:
+            log.warning("Failed to store %s in artifact cache: %s", outputs, e)
+    
+    def _add_size(self, size):
+        size_path = os.path.join(self.path, "size")
+        with self._lock:
+            if self._size is None:
+                try:
+                    with open(size_path, "r") as f:
+                        self._size = int(f.read())
+                except (IOError, ValueError):
+                    self._size = self._cleanup()
+            self._size += size
+            if self._size > self.max_size:
+                self._size = self._cleanup()
+            self._write_file(size_path, str(self._size))
+    
+    def _cleanup(self):
+        # Remove the least recently used entries until the cache is 90% of the max size. Returns the new cache size.
+        entries = []
+        total = 0
+        for subdir in os.listdir(self.path):
+            subdir_path = os.path.join(self.path, subdir)
+            if not os.path.isdir(subdir_path):
+                continue
+            for name in os.listdir(subdir_path):
+                entry = os.path.join(subdir_path, name)
+                try:
+                    if os.path.isdir(entry):
+                        size = sum([os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry)])
+                    else:
+                        size = os.path.getsize(entry)
+                    entries.append((os.path.getmtime(entry), size, entry))
+                    total += size
+                except OSError:
+                    pass
+        
+        if total > self.max_size:
+            entries.sort()
+            limit = self.max_size * 9 // 10
+            for mtime, size, entry in entries:
+                if total <= limit:
+                    break
+                log.debug("Removing artifact cache entry %s", entry)
+                if os.path.isdir(entry):
+                    shutil.rmtree(entry, ignore_errors=True)
+                else:
+                    try:
+                        os.remove(entry)
+                    except OSError:
+                        pass
+                total -= size
+        return total
+
+class _RemoteArtifactCache(_ArtifactCacheBase):
+    """
+    A remote artifact cache that stores build artifacts on an HTTP server (eg the server started by 'emk :cache-server').
+    
+    The server is a simple key/value store with two namespaces:
+      GET/PUT <url>/ac/<key>     -- The action cache. For a base key, the value is a JSON list of the dependency lists that
+                                    have been stored for that key. For an outputs key (the base key combined with a dependency
+                                    list and the digests of those dependencies), the value is a JSON list of the content digests
+                                    of the outputs.
+      GET/PUT <url>/cas/<digest> -- The content-addressed store. The value is the file contents; the digest is its SHA-1 hex digest.
+    A GET for a missing key must return 404.
+    
+    Lookups are synchronous; uploads are done by a background thread so that they never slow down the build (emk waits
+    for pending uploads to finish before it exits). If the server cannot be reached, the remote cache is disabled for
+    retry_interval seconds so that the build is not slowed down by repeated timeouts.
+    
+    An optional local ArtifactCache can be used as a first-level cache; outputs downloaded from the server are stored
+    in the local cache.
+    
+    Properties:
+      url            -- The base URL of the server.
+      local          -- The local ArtifactCache instance, or None.
+      upload         -- Whether or not to upload outputs to the server.
+      timeout        -- The timeout for network operations, in seconds.
+      retry_interval -- The time (in seconds) to wait before trying to use the server again after it could not be reached.
+    """
+    max_dep_lists = 16 # maximum number of dependency lists stored for each base key
+    max_pending = 256 # maximum number of queued uploads; further uploads are dropped
+    
+    def __init__(self, url, local=None, upload=True, timeout=2.0, retry_interval=60.0):
+        """
+        Create a new RemoteArtifactCache instance.
+        
+        Arguments:
+          url            -- The base URL of the server (eg "http://buildcache:8765"). Only http and https are supported.
+          local          -- A local ArtifactCache instance to use as a first-level cache, or None.
+          upload         -- Whether or not to upload outputs to the server. For example, CI machines could fill the cache
+                            while developer machines only download from it. The default value is True.
+          timeout        -- The timeout for network operations, in seconds. The default value is 2.
+          retry_interval -- The time (in seconds) to wait before trying to use the server again after it could not be reached.
+                            The default value is 60.
+        """
+        super(_RemoteArtifactCache, self).__init__()
+        self.url = url.rstrip('/')
+        self.local = local
+        self.upload = upload
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        
+        parsed = urlparse.urlparse(self.url)
+        if parsed.scheme == "http":
+            self._conn_class = httplib.HTTPConnection
+        elif parsed.scheme == "https":
+            self._conn_class = httplib.HTTPSConnection
+        else:
+            raise emk.BuildError("Unsupported remote artifact cache URL %s" % (url))
+        self._netloc = parsed.netloc
+        self._base_path = parsed.path
+        
+        self._conns = threading.local()
+        self._unavailable_until = 0
+        self._uploads = None
+    
+    def _available(self):
+        return time.time() >= self._unavailable_until
+    
+    def _fail(self, e):
+        with self._lock:
+            if self._available():
+                log.warning("Remote artifact cache %s is unavailable (%s); not using it for %d seconds", self.url, e, self.retry_interval)
+                self._unavailable_until = time.time() + self.retry_interval
+        conn = getattr(self._conns, "conn", None)
+        if conn:
+            conn.close()
+            self._conns.conn = None
+    
+    def _request(self, method, kind, key, body=None):
+        # Returns (status, data), or (None, None) if the server could not be reached.
+        if not self._available():
+            return None, None
+        conn = getattr(self._conns, "conn", None)
+        if conn is None:
+            conn = self._conn_class(self._netloc, timeout=self.timeout)
+            self._conns.conn = conn
+        try:
+            headers = {}
+            if body is not None:
+                headers["Content-Type"] = "application/octet-stream"
+            conn.request(method, "%s/%s/%s" % (self._base_path, kind, key), body, headers)
+            response = conn.getresponse()
+            data = response.read()
+            if response.status >= 500:
+                raise httplib.HTTPException("HTTP status %d" % (response.status))
+            return response.status, data
+        except (socket.error, httplib.HTTPException) as e:
+            self._fail(e)
+            return None, None
+    
+    def _get_json(self, key):
+        status, data = self._request("GET", "ac", key)
+        if status != 200:
+            return None
+        try:
+            value = json.loads(data.decode("utf-8"))
+        except ValueError:
+            return None
+        if not isinstance(value, list):
+            return None
+        return value
+    
+    def _get_dep_lists(self, key):
+        dep_lists = self._get_json(key) or []
+        result = []
+        for deps in dep_lists:
+            if isinstance(deps, list):
+                result.append([str(dep) if sys.version_info[0] >= 3 else dep.encode("utf-8") for dep in deps])
+        return result
+    
+    def restore(self, key, dests, deps_hint=None):
+        """
+        Restore the outputs for the given base key, if they are in the local cache or on the server.
+        See ArtifactCache.restore() for a description of the arguments and return value.
+        """
+        if self.local:
+            deps = self.local.restore(key, dests, deps_hint)
+            if deps is not None:
+                return deps
+        if not self._available():
+            return None
+        
+        for deps in self._candidates(self._get_dep_lists(key), deps_hint):
+            abs_deps = self._absolute(deps)
+            try:
+                outputs_key = self._outputs_key(key, abs_deps)
+            except (IOError, OSError):
+                continue
+            digests = self._get_json(outputs_key)
+            if digests is None or len(digests) != len(dests):
+                continue
+            if self._download(digests, dests):
+                log.debug("Restored %s from remote artifact cache %s", dests, self.url)
+                if self.local:
+                    self.local.save(key, dests, abs_deps)
+                return abs_deps
+        return None
+    
+    def _download(self, digests, dests):
+        try:
+            for digest, dest in zip(digests, dests):
+                status, data = self._request("GET", "cas", digest)
+                if status != 200 or hashlib.sha1(data).hexdigest() != digest:
+                    raise IOError("missing or corrupt object %s" % (digest))
+                with open(dest, "wb") as f:
+                    f.write(data)
+            return True
+        except (IOError, OSError) as e:
+            log.debug("Failed to download %s from remote artifact cache: %s", dests, e)
+            for dest in dests:
+                if os.path.isfile(dest):
+                    os.remove(dest)
+            return False
+    
+    def save(self, key, outputs, deps):
+        """
+        Store the outputs for the given base key and dependency list in the local cache (if any), and queue them to be
+        uploaded to the server (if uploading is enabled). See ArtifactCache.save() for a description of the arguments.
+        """
+        if self.local:
+            self.local.save(key, outputs, deps)
+        if not self.upload or not self._available():
+            return
+        
+        try:
+            blobs = []
+            for output in outputs:
+                with open(output, "rb") as f:
+                    blobs.append(f.read())
+            item = (key, self._relocate(list(deps)), self._outputs_key(key, deps), blobs)
+        except (IOError, OSError) as e:
+            log.warning("Failed to read %s for remote artifact cache: %s", outputs, e)
+            return
+        
+        with self._lock:
+            if self._uploads is None:
+                self._uploads = queue.Queue(self.max_pending)
+                t = threading.Thread(target=self._upload_func)
+                t.daemon = True
+                t.start()
+                atexit.register(self._wait_for_uploads)
+        try:
+            self._uploads.put_nowait(item)
+        except queue.Full:
+            log.debug("Too many pending uploads to remote artifact cache; not uploading %s", outputs)
+    
+    def _upload_func(self):
+        while True:
+            item = self._uploads.get()
+            try:
+                if self._available():
+                    self._upload(*item)
+            except Exception as e:
+                log.warning("Failed to upload to remote artifact cache %s: %s", self.url, e)
+            finally:
+                self._uploads.task_done()
+    
+    def _upload(self, key, rel_deps, outputs_key, blobs):
+        digests = []
+        for data in blobs:
+            digest = hashlib.sha1(data).hexdigest()
+            status, unused = self._request("HEAD", "cas", digest)
+            if status == 404:
+                status, unused = self._request("PUT", "cas", digest, data)
+            if status not in (200, 201, 204):
+                return
+            digests.append(digest)
+        
+        status, unused = self._request("PUT", "ac", outputs_key, json.dumps(digests).encode("utf-8"))
+        if status not in (200, 201, 204):
+            return
+        
+        dep_lists = self._get_dep_lists(key)
+        if dep_lists and dep_lists[0] == rel_deps:
+            return
+        if rel_deps in dep_lists:
+            dep_lists.remove(rel_deps)
+        dep_lists.insert(0, rel_deps)
+        self._request("PUT", "ac", key, json.dumps(dep_lists[:self.max_dep_lists]).encode("utf-8"))
+    
+    def _wait_for_uploads(self):
+        if self._uploads is not None and self._uploads.unfinished_tasks:
+            log.info("Waiting for %d uploads to remote artifact cache %s", self._uploads.unfinished_tasks, self.url)
+            self._uploads.join()
+
+_depfile_target_regex = re.compile(r':(?:\s|$)')
+_depfile_token_regex = re.compile(r'(?:\\.|\S)+')
+
+def _parse_depfile(data):
+    """
+    Parse the contents of a make-style dependency file (as written by gcc -MD or -MMD).
+    
+    Returns the prerequisites of the first rule (in order, without duplicates). Line continuations, escaped spaces
+    and '#' characters ('\\ ' and '\\#') and '$$' are handled; backslashes in other positions (eg in Windows paths)
+    are kept. Later rules (such as the phony targets written by -MP) are ignored.
+    """
+    data = data.replace("\\\r\n", " ").replace("\\\n", " ")
+    line = data.partition("\n")[0]
+    m = _depfile_target_regex.search(line)
+    if not m:
+        return []
+    line = line[m.end():]
+    
+    if '\\' in line or '$' in line:
+        items = []
+        for token in _depfile_token_regex.findall(line):
+            if '\\' in token:
+                token = token.replace("\\ ", " ").replace("\\#", "#")
+            if '$' in token:
+                token = token.replace("$$", "$")
+            items.append(token)
+    else:
+        items = line.split()
+    
+    seen = set()
+    return [item for item in items if not (item in seen or seen.add(item))]
+
+_interned_paths = {}
+
+def _intern_path(path):
+    return _interned_paths.setdefault(path, path)
+
 class Module(object):
     """
     emk utility module - when you call emk.module("utils") you will get an instance of this class.
     """
     def __init__(self, scope):
         self._clean_rules = 0
+        self.ArtifactCache = _ArtifactCache
+        self.RemoteArtifactCache = _RemoteArtifactCache
     
     def new_scope(self, scope):
         return Module(scope)
@@ -53,6 +605,49 @@ class Module(object):
                 result.append(item)
         return result
     
+    def parse_depfile(self, data):
+        """
+        Parse the contents of a make-style dependency file (as written by gcc -MD or -MMD).
+        
+        Line continuations, escaped spaces and '#' characters, and '$$' are handled. Only the first rule is
+        used (so the phony targets written by -MP are ignored).
+        
+        Arguments:
+          data -- The contents of the dependency file.
+        
+        Returns the prerequisites of the first rule as a list of paths (as written in the file), without duplicates.
+        """
+        return _parse_depfile(data)
+    
+    def read_depfile(self, path):
+        """
+        Read a make-style dependency file, and convert the prerequisites of its first rule into canonical absolute paths.
+        
+        Relative paths are based on the current scope dir (and canonicalized like emk.abspath()). The returned paths are interned,
+        so identical paths in the dependency lists of different object files share memory.
+        
+        Arguments:
+          path -- The path of the dependency file.
+        
+        Returns a list of the canonical paths of the prerequisites, without duplicates. Raises IOError if the file cannot be read.
+        """
+        with open(path, "r") as f:
+            items = _parse_depfile(f.read())
+        abspath = emk.abspath
+        return self.unique_list([_intern_path(abspath(item)) for item in items])
+    
+    def intern_paths(self, paths):
+        """
+        Get a list of the given paths, using the same string object for each path as the other interned path lists
+        (eg dependency lists returned by read_depfile()). Use this for dependency lists that are kept for a whole build.
+        
+        Arguments:
+          paths -- The list of paths to intern.
+        
+        Returns a new list containing the interned paths.
+        """
+        return [_intern_path(p) for p in paths]
+
     def rm_list(self, thelist, item):
         """
         Remove an item from a list, if it is present. It is not an error if the item is not in the list.
@@ -248,7 +843,7 @@ class Module(object):
           produces -- The paths to mark as virtual when the rule is executed.
           requires -- The dependencies of the rule.
         """
-        emk.rule(self.mark_virtual, produces, requires, cwd_safe=True, ex_safe=True)
+        emk.rule(self.mark_virtual, produces, requires, cwd_safe=True, ex_safe=True, command=self.virtual_command)
         
     def mark_virtual(self, produces, requires):
         """
@@ -256,6 +851,12 @@ class Module(object):
         """
         emk.mark_virtual(produces)
     
+    def virtual_command(self, produces, requires, *args):
+        """
+        emk rule command function (see emk.rule()) for rules that only mark their products as virtual, so they do not run any commands.
+        """
+        return {"commands": []}
+    
     def copy_rule(self, source, dest):
         """
         Define an emk rule to copy a file.
@@ -268,7 +869,7 @@ class Module(object):
                     that rule will be executed before the copy rule is).
           dest   -- The path to copy the file to; must include the destination file name (ie not just the directory).
         """
-        emk.rule(self.copy_file, dest, [source, emk.ALWAYS_BUILD], cwd_safe=True, ex_safe=True)
+        emk.rule(self.copy_file, dest, [source, emk.ALWAYS_BUILD], cwd_safe=True, ex_safe=True, idempotent=True)
     
     def copy_file(self, produces, requires):
         """
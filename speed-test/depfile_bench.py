@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+# Microbenchmark for dependency file ingestion (the c and asm modules read a depfile after every compile).
+# Compares the old shlex/realpath approach with the utils depfile parser and emk's per-directory realpath cache.
+#
+# Usage: depfile_bench.py [num_headers] [iterations]
+
+from __future__ import print_function
+
+import os
+import sys
+import imp
+import shlex
+import shutil
+import tempfile
+import timeit
+
+emk_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, emk_dir)
+import emk
+utils = imp.load_source("emk_utils", os.path.join(emk_dir, "modules", "utils.py"))
+
+num_headers = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+def make_tree(root):
+    # include dirs of various depths, one of them reached through a symlink and one with a space in its name
+    dirs = []
+    for i in range(20):
+        d = os.path.join(root, "include", "lib_%d" % (i), "src", "api")
+        os.makedirs(d)
+        dirs.append(d)
+    os.makedirs(os.path.join(root, "with space"))
+    dirs.append(os.path.join(root, "with space"))
+    os.symlink(os.path.join(root, "include"), os.path.join(root, "linked"))
+    dirs.append(os.path.join(root, "linked", "lib_0", "src", "api"))
+
+    headers = []
+    for i in range(num_headers):
+        path = os.path.join(dirs[i % len(dirs)], "header_%d.h" % (i))
+        with open(path, "w") as f:
+            f.write("\n")
+        headers.append(path)
+    return headers
+
+def write_depfile(path, source, headers):
+    escaped = [h.replace(" ", "\\ ") for h in [source] + headers]
+    lines = ["obj.o: " + escaped[0]] + escaped[1:]
+    with open(path, "w") as f:
+        f.write(" \\\n  ".join(lines) + "\n")
+
+def old_ingest(dep_file):
+    with open(dep_file, "r") as f:
+        data = f.read()
+        data = data.replace("\\\n", "")
+        items = shlex.split(data)
+        return [os.path.realpath(item) for item in (set(items[2:]) - set([""]))]
+
+def new_ingest(dep_file, cache):
+    with open(dep_file, "r") as f:
+        items = utils._parse_depfile(f.read())[1:]
+    return [utils._intern_path(cache.realpath(item)) for item in items]
+
+def make_cache(file_symlinks=True):
+    cache = emk._RealpathCache()
+    cache.file_symlinks = file_symlinks
+    return cache
+
+root = tempfile.mkdtemp()
+try:
+    headers = make_tree(root)
+    dep_file = os.path.join(root, "obj.o.dep")
+    write_depfile(dep_file, os.path.join(root, "source.c"), headers)
+
+    old_result = set(old_ingest(dep_file))
+    new_result = set(new_ingest(dep_file, make_cache()))
+    if old_result != new_result:
+        print("Results differ: %d old vs %d new paths" % (len(old_result), len(new_result)))
+        sys.exit(1)
+
+    shared = make_cache()
+    trusted = make_cache(False)
+    results = [
+        ("shlex + realpath", timeit.timeit(lambda: old_ingest(dep_file), number=iterations)),
+        ("parser, new cache per file", timeit.timeit(lambda: new_ingest(dep_file, make_cache()), number=iterations)),
+        ("parser, build-wide cache", timeit.timeit(lambda: new_ingest(dep_file, shared), number=iterations)),
+        ("parser, file_symlinks=no", timeit.timeit(lambda: new_ingest(dep_file, trusted), number=iterations)),
+        ("parser only", timeit.timeit(lambda: utils._parse_depfile(open(dep_file).read()), number=iterations)),
+    ]
+    print("%d headers, %d iterations" % (num_headers, iterations))
+    for name, t in results:
+        print("  %-28s %8.2f ms per depfile" % (name, t * 1000.0 / iterations))
+finally:
+    shutil.rmtree(root)